@@ -26,6 +26,16 @@ export type Job = {
     rate: {
       average: number,
       last: number
+    },
+    // rolling timings in seconds of the analyzer's stages (decode, inference, write...)
+    stages?: Record<string, { p50: number, p95: number, max: number, total: number }>,
+    counters?: {
+      framesDecoded: number,
+      framesInferred: number,
+      bytesWritten: number,
+      boxes: number,
+      rss: number | null,
+      peakRss: number | null
     }
   } | null
 }
@@ -35,6 +45,55 @@ const jobList: Job[] = []
 let lastIndex = 0
 let currentJob: { id: number, process: ChildProcess | null } | null = null
 
+// the analyzer keeps running between the jobs, so that the models stay loaded
+let analyzer: ChildProcess | null = null
+const analyzerListeners = new Map<number, (message: any) => void>()
+
+// the cancel is only checked between batches, so a job stuck on reading the video gets its analyzer restarted
+const CANCEL_TIMEOUT = 15_000
+
+function getAnalyzer() {
+  if (analyzer)
+    return analyzer
+
+  const child = spawn('python3', [
+    'scripts/analyze-youtube.py',
+    '--serve'
+  ], { cwd: env.str('PROJECT_ROOT') })
+  analyzer = child
+
+  // there is only one job analyzed at a time, so the rest of the output belongs to it
+  child.stderr!.on('data', chunk => { if (currentJob) jobList[currentJob.id].logs.push(chunk) })
+
+  const logReader = createInterface(child.stdout!)
+  logReader.on('line', line => {
+    try {
+      if (line.trim().length == 0)
+        return
+
+      const data = JSON.parse(line)
+      jobList[data.job]?.logs.push(Buffer.from(line), Buffer.from('\n'))
+      analyzerListeners.get(data.job)?.(data)
+    } catch (err) {
+      if (currentJob)
+        jobList[currentJob.id].logs.push(Buffer.from(line), Buffer.from('\n'))
+      error('Failed to parse data from analyzer', line, err)
+    }
+  })
+
+  const onGone = (reason: string) => {
+    if (analyzer !== child)
+      return // it was replaced already, along with its job
+    analyzer = null
+    for (const listener of [...analyzerListeners.values()])
+      listener({ status: 'failed', error: reason })
+  }
+  child.once('error', err => onGone(`arbitrary spawning issue for analysis: ${JSON.stringify(err)}`))
+    .once('exit', (code, signal) => onGone(`analyzer exited with code=${code} signal=${signal}`))
+
+  return child
+}
+
 // call this whenever a job is added/cancelled/finished
 async function onJobUpdate(fromIndex: number) {
   if (currentJob)
@@ -64,43 +123,20 @@ async function onJobUpdate(fromIndex: number) {
   const folder = await mkdtemp(path.join(tmpdir(), 'pam-import-'))
   const filename = path.join(folder, 'temp.csv')
 
-  const child = spawn('python3', [
-    'scripts/analyze-youtube.py',
-    job.videoUrl,
-    '-m', (await database.models.get(job.modelId))!.modelPath,
-    '-o', filename,
-    '--json', '--conf', '0.6'
-  ], { cwd: env.str('PROJECT_ROOT') })
-  currentJob.process = child
-  child.stdout.on('data', chunk => jobList[idx].logs.push(chunk))
-  child.stderr.on('data', chunk => jobList[idx].logs.push(chunk))
-
-  const logReader = createInterface(child.stdout)
-  logReader.on('line', line => {
-    try {
-      if (line.trim().length == 0)
-        return
-
-      const data = JSON.parse(line)
-      jobList[idx].progress = data
-    } catch (err) {
-      jobList[idx].logs.push(Buffer.from(line), Buffer.from('\n'))
-      error('Failed to parse data from analyzer', line, err)
+  const analyzer = getAnalyzer()
+  analyzerListeners.set(idx, message => {
+    if (message.status === undefined) {
+      jobList[idx].progress = message
+      return
     }
-  })
+    if (message.status == 'started')
+      return
 
-  child.once('error', (err) => {
-    jobList[idx].end = Date.now()
-    jobList[idx].status = 'failed'
-    jobList[idx].logs.push(Buffer.from(`\n[pam/backend] Arbitrary spawning issue for analysis: ${JSON.stringify(err)}\n`))
-    currentJob = null
-    onJobUpdate(idx)
-  }).once('exit', (code, signal) => {
-    // update the job list
-    jobList[idx].logs.push(Buffer.from(`\n[pam/backend] Analysis exited with code=${code} signal=${signal}\n`))
+    analyzerListeners.delete(idx)
+    jobList[idx].logs.push(Buffer.from(`\n[pam/backend] Analysis ${message.status}${message.error ? `: ${message.error}` : ''}\n`))
 
     // on success, import the csv into the system
-    if (code == 0) {
+    if (message.status == 'finished') {
       jobList[idx].result = filename
       jobList[idx].status = 'importing'
       const importer = spawn('npm', [
@@ -125,12 +161,20 @@ async function onJobUpdate(fromIndex: number) {
       })
     } else {
       jobList[idx].end = Date.now()
-      jobList[idx].status = 'failed'
+      jobList[idx].status = message.status == 'cancelled' ? 'cancelled' : 'failed'
       currentJob = null
       onJobUpdate(idx)
     }
   })
 
+  analyzer.stdin!.write(JSON.stringify({
+    id: idx,
+    url: job.videoUrl,
+    model: (await database.models.get(job.modelId))!.modelPath,
+    output: filename,
+    conf: 0.6
+  }) + '\n')
+
   // TODO: remove the tomporary file/folder
 }
 
@@ -155,7 +199,27 @@ export const Runner = {
     return jobList[id]
   },
   kill() {
-    return currentJob?.process?.kill('SIGTERM')
+    if (!currentJob)
+      return false
+    if (currentJob.process) // importing
+      return currentJob.process.kill('SIGTERM')
+    if (!analyzer || !analyzerListeners.has(currentJob.id))
+      return false
+
+    const id = currentJob.id
+    const child = analyzer
+    child.stdin!.write(JSON.stringify({ cancel: id }) + '\n')
+    setTimeout(() => {
+      const listener = analyzerListeners.get(id)
+      if (!listener || analyzer !== child)
+        return // cancelled in time
+
+      // the next job spawns a new analyzer, the models get loaded again
+      analyzer = null
+      child.kill('SIGTERM')
+      listener({ status: 'cancelled', error: `did not stop within ${CANCEL_TIMEOUT / 1000}s, the analyzer was restarted` })
+    }, CANCEL_TIMEOUT)
+    return true
   }
 }
 export default Runner
\ No newline at end of file
@@ -1,5 +1,5 @@
 import { createReadStream } from 'fs'
-import { readFile } from 'fs/promises'
+import { open, readFile } from 'fs/promises'
 import db from '../libs/database'
 import * as schema from '../db/schema'
 import { createInterface } from 'readline/promises'
@@ -7,7 +7,7 @@ import { and, eq, or } from 'drizzle-orm'
 
 const argv = process.argv.slice(2)
 if (argv.length == 0) {
-  console.error(`usage: ${process.argv.slice(0, 2).join(' ')} <csv_file> <csv_file> ...`)
+  console.error(`usage: ${process.argv.slice(0, 2).join(' ')} <csv_or_binary_file> <csv_or_binary_file> ...`)
   process.exit(1)
 }
 
@@ -40,6 +40,91 @@ type VideoMetadata = {
     conf: number,
     iou: number,
     imgsz: number
+  },
+  frames?: number,
+  names?: Record<string, string>
+}
+
+// see scripts/detections.py for the binary format
+const BINARY_MAGIC = '#PAMD 1\n'
+const RECORD_SIZE = 26 // frame u32, class u16, confidence/x/y/w/h f32
+
+async function is_binary(path: string) {
+  const handle = await open(path, 'r')
+  try {
+    const magic = Buffer.alloc(BINARY_MAGIC.length)
+    await handle.read(magic, 0, magic.length, 0)
+    return magic.toString() == BINARY_MAGIC
+  } finally {
+    await handle.close()
+  }
+}
+
+function* binary_chunks(file: Buffer) {
+  // skip the magic and the metadata lines
+  let offset = file.indexOf('\n', file.indexOf('\n') + 1) + 1
+  while (offset + 8 <= file.length) {
+    const tag = file.toString('ascii', offset, offset + 4)
+    const length = file.readUInt32LE(offset + 4)
+    if (offset + 8 + length > file.length)
+      break // cut off while writing
+    yield { tag, payload: file.subarray(offset + 8, offset + 8 + length) }
+    offset += 8 + length
+  }
+}
+
+function get_binary_header(file: Buffer) {
+  const start = file.indexOf('\n') + 1
+  const line = file.toString('utf-8', start, file.indexOf('\n', start))
+  const metadata = line.startsWith('#$') ? JSON.parse(line.substring(2).trim()) as VideoMetadata : null
+
+  let count = 0
+  for (const { tag, payload } of binary_chunks(file))
+    if (tag == 'DETS')
+      count += payload.length / RECORD_SIZE
+  return { metadata, count }
+}
+
+function* binary_results(file: Buffer, metadata: VideoMetadata) {
+  const { frames, names } = metadata
+  if (!frames || !names)
+    throw new Error(`binary file has no frames or names in the metadata!`)
+
+  for (const { tag, payload } of binary_chunks(file)) {
+    if (tag != 'DETS')
+      continue
+    for (let offset = 0; offset < payload.length; offset += RECORD_SIZE) {
+      const result: Result = {
+        time: (payload.readUInt32LE(offset) / frames) * metadata.video.duration,
+        class: names[payload.readUInt16LE(offset + 4)],
+        confidence: payload.readFloatLE(offset + 6),
+        x: payload.readFloatLE(offset + 10),
+        y: payload.readFloatLE(offset + 14),
+        w: payload.readFloatLE(offset + 18),
+        h: payload.readFloatLE(offset + 22)
+      }
+      yield result
+    }
+  }
+}
+
+// rudimentary csv parser
+async function* csv_results(csvPath: string) {
+  const stream = createReadStream(csvPath)
+  const reader = createInterface({ input: stream })
+  let header: string[] = []
+  for await (const line of reader) {
+    if (line[0] == '#') continue
+    const split = line.split(/[;,]/)
+    if (header.length == 0) {
+      header = split
+      continue
+    }
+    const temp = split.reduce((acc, val, idx) => { acc[header[idx]] = val; return acc }, {} as Record<string, any>)
+    for (const key of ['time', 'confidence', 'x', 'y', 'w', 'h'])
+      temp[key] = parseFloat(temp[key])
+
+    yield temp as Result
   }
 }
 
@@ -61,7 +146,8 @@ async function get_json_header(csvPath: string) {
 
 async function main(csvPath: string) {
   // const metadata from the file
-  const { metadata, count } = await get_json_header(csvPath)
+  const binary = await is_binary(csvPath) ? await readFile(csvPath) : null
+  const { metadata, count } = binary ? get_binary_header(binary) : await get_json_header(csvPath)
   if (!metadata) throw new Error(`"${csvPath}" has no metadata header!`)
   console.error(`[i] ${csvPath} =`, metadata)
 
@@ -142,23 +228,9 @@ async function main(csvPath: string) {
       buffer = []
     }
 
-    // rudimentary csv parser
-    const stream = createReadStream(csvPath)
-    const reader = createInterface({ input: stream })
-    let header: string[] = []
-    for await (const line of reader) {
-      if (line[0] == '#') continue
-      const split = line.split(/[;,]/)
-      if (header.length == 0) {
-        header = split
-        continue
-      }
-      const temp = split.reduce((acc, val, idx) => { acc[header[idx]] = val; return acc }, {} as Record<string, any>)
-      for (const key of ['time', 'confidence', 'x', 'y', 'w', 'h'])
-        temp[key] = parseFloat(temp[key])
-
+    const results = binary ? binary_results(binary, metadata) : csv_results(csvPath)
+    for await (const result of results) {
       // for parsed results, push them to the buffer
-      const result: Result = temp as Result
       buffer.push(result)
 
       // mob not found, immediately add it to the database and update our mapping
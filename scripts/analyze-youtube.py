@@ -1,24 +1,51 @@
 import argparse
+import base64
 import json
+import os
 import sys
 import datetime
 import math
 import time
+import queue
+import threading
+import multiprocessing
+import collections
+import contextlib
+import traceback
+import cv2
+import numpy as np
+from detections import WRITERS, boxes_to_arrays, concatenate
+from capture import DECODERS, open_capture
 
-def get_argv():
+# flush the pending frames even when nothing needs predicting, so the progress keeps going
+MAX_PENDING_FRAMES = 256
+END_OF_FRAMES = object()
+END_OF_JOBS = object()
+
+# arguments which don't affect the output, so they aren't restored from the checkpoint
+RUNTIME_ARGS = [ 'json', 'verbose', 'show', 'resume', 'batch', 'summary', 'job', 'serve', 'models' ]
+
+# the progress lines of a job and the status lines of --serve come from different threads
+stdout_lock = threading.Lock()
+
+try:
+  import resource
+except ImportError:
+  resource = None # not on windows
+
+def get_parser():
   parser = argparse.ArgumentParser()
   parser.add_argument(
     '-m', '--model',
-    help='path to the weights',
-    required=True
+    help='path to the weights'
   )
   parser.add_argument(
-    '-o', '--output',
-    required=True
+    '-o', '--output'
   )
   parser.add_argument(
     'url',
-    help='youtube url'
+    help='youtube url, or a path to a local video file',
+    nargs='?'
   )
   parser.add_argument('--conf', default=0.8, type=float)
   parser.add_argument('--iou', default=0.5, type=float)
@@ -26,19 +53,496 @@ def get_argv():
   parser.add_argument('-v', '--verbose', default=False, action='store_true')
   parser.add_argument('--show', default=False, action='store_true')
   parser.add_argument('-j', '--json', default=False, action='store_true')
+  parser.add_argument(
+    '-b', '--batch',
+    help='how many frames to predict on at once, values above 1 decode the video on a separate thread',
+    default=1,
+    type=int
+  )
+  parser.add_argument(
+    '--sample-threshold',
+    help='only predict on frames whose downscaled grayscale differs from the last predicted frame by more than this (0.0-1.0), skipped frames reuse its detections (0.0 predicts on every frame)',
+    default=0.0,
+    type=float
+  )
+  parser.add_argument(
+    '--sample-stride',
+    help='with --sample-threshold, predict at least every N-th frame regardless of the difference',
+    default=60,
+    type=int
+  )
+  parser.add_argument(
+    '--sample-size',
+    help='with --sample-threshold, width of the downscaled frame used for the comparison',
+    default=64,
+    type=int
+  )
+  parser.add_argument(
+    '-f', '--format',
+    help='output format, csv, the compact binary or the tracks (convert them to csv with detections.py)',
+    choices=list(WRITERS.keys()),
+    default='csv'
+  )
+  parser.add_argument(
+    '--track-iou',
+    help='with --format tracks, minimal IoU of a box with the last box of a track to continue it',
+    default=0.3,
+    type=float
+  )
+  parser.add_argument(
+    '--track-gap',
+    help='with --format tracks, for how many frames a track can be missing before it is finished',
+    default=5,
+    type=int
+  )
+  parser.add_argument(
+    '--track-tolerance',
+    help='with --format tracks, how far (normalized) the boxes can be from the interpolation between keyframes',
+    default=0.005,
+    type=float
+  )
+  parser.add_argument(
+    '--checkpoint-interval',
+    help='every how many seconds of the video to flush the output and save a checkpoint next to it',
+    default=10,
+    type=float
+  )
+  parser.add_argument(
+    '--resume',
+    help='continue from the checkpoint of the output, if there is one (the analysis options are taken from the checkpoint)',
+    default=False,
+    action='store_true'
+  )
+  parser.add_argument(
+    '--summary',
+    help='where to write a JSON summary of the stage timings and counters once the analysis is done',
+    default=None
+  )
+  parser.add_argument(
+    '-w', '--workers',
+    help='split the video into this many consecutive ranges, each analyzed by its own process and model',
+    default=1,
+    type=int
+  )
+  parser.add_argument(
+    '--decoder',
+    help='opencv decodes the full frames, ffmpeg (has to be in PATH) scales them down to --imgsz while decoding',
+    choices=DECODERS,
+    default='opencv'
+  )
+  parser.add_argument(
+    '--job',
+    help='an id to include in every JSON progress line',
+    default=None
+  )
+  parser.add_argument(
+    '--serve',
+    help='keep running and read the jobs as JSON lines from stdin, see the readme',
+    default=False,
+    action='store_true'
+  )
+  parser.add_argument(
+    '--models',
+    help='with --serve, how many of the most recently used models to keep loaded',
+    default=2,
+    type=int
+  )
+  return parser
 
-  return parser.parse_args()
+def get_argv():
+  parser = get_parser()
+  argv = parser.parse_args()
+  if not argv.serve and (argv.url is None or argv.model is None or argv.output is None):
+    parser.error('the url, -m/--model and -o/--output are required, unless --serve is used')
+  if argv.workers > 1 and argv.resume:
+    parser.error('--resume is not supported with --workers')
+  return argv
 
-if __name__ == '__main__':
-  argv = get_argv()
-  video = None
+def get_job_value(action: argparse.Action, key: str, value):
+  '''
+  Checks a value of a job as the command line would, and converts it by the type of the option.
+  '''
+  if action.nargs == 0: # flags such as resume
+    if not isinstance(value, bool):
+      raise Exception(f'invalid "{key}": expected true or false, got {json.dumps(value)}')
+    return value
+  if value is None and action.default is None:
+    return None
+  if value is None or isinstance(value, (bool, list, dict)):
+    raise Exception(f'invalid "{key}": {json.dumps(value)}')
+
+  try:
+    value = action.type(str(value)) if action.type is not None else str(value)
+  except (TypeError, ValueError):
+    raise Exception(f'invalid "{key}": {json.dumps(value)} is not a valid {action.type.__name__}')
+  if action.choices is not None and value not in action.choices:
+    raise Exception(f'invalid "{key}": {json.dumps(value)}, expected one of {', '.join(action.choices)}')
+  return value
+
+def get_job_argv(parser: argparse.ArgumentParser, job: dict) -> argparse.Namespace:
+  '''
+  Turns a job of `--serve` into the arguments of a single analysis, any option
+  of the command line can be set by its name (e.g. `sample_threshold`).
+  '''
+  for key in [ 'id', 'url', 'model', 'output' ]:
+    if job.get(key) is None:
+      raise Exception(f'the job is missing "{key}"')
+
+  actions = { action.dest: action for action in parser._actions if action.dest != 'help' }
+  argv = parser.parse_args([])
+  for key, value in job.items():
+    if key in [ 'id', 'serve', 'models' ]:
+      continue
+    if key not in actions:
+      raise Exception(f'unknown option "{key}"')
+    setattr(argv, key, get_job_value(actions[key], key, value))
+  argv.job = job['id']
+  argv.json = True
+  argv.show = False
+
+  if argv.format not in WRITERS:
+    raise Exception(f'unknown format "{argv.format}"')
+  if argv.workers > 1 and argv.resume:
+    raise Exception('resume is not supported with workers')
+  return argv
+
+def load_model(path: str):
+  from ultralytics import YOLO
+  return YOLO(path)
+
+class ModelCache:
+  '''
+  Keeps up to `capacity` loaded models, the least recently used one is dropped first.
+  The models are keyed by their path and modification time, so retrained weights are reloaded.
+  Names which ultralytics downloads (for eg. `yolov8n.pt`) don't exist yet, so they're keyed by the name alone.
+  '''
+  def __init__(self, capacity: int):
+    self.capacity = max(1, capacity)
+    self.models: collections.OrderedDict = collections.OrderedDict()
+
+  def get(self, path: str):
+    key = (os.path.abspath(path), os.path.getmtime(path)) if os.path.exists(path) else (path, None)
+    if key in self.models:
+      self.models.move_to_end(key)
+      return self.models[key]
+
+    print(f'> Loading the model "{path}"', file=sys.stderr)
+    model = load_model(path)
+    self.models[key] = model
+    while len(self.models) > self.capacity:
+      self.models.popitem(last=False)
+    return model
+
+def emit(message: dict):
+  with stdout_lock:
+    sys.stdout.write(json.dumps(message) + '\n')
+    sys.stdout.flush()
+
+def open_video(argv: argparse.Namespace, url: str):
+  # a frame of the ffmpeg ring has to outlive the batch being predicted and the frames queued behind it
+  return open_capture(url, argv.decoder, argv.imgsz, ring=max(1, argv.batch) * 3 + 2)
+
+def get_rss():
+  '''
+  Returns the current and the peak resident memory of this process in bytes.
+  '''
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource is not None else None
+  try:
+    with open('/proc/self/statm', 'rt') as file:
+      return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'), peak
+  except OSError:
+    return peak, peak
+
+class Stats:
+  '''
+  Running totals of the analysis, along with the timings of each stage (in seconds)
+  of which the last `window` samples are kept for the percentiles.
+  '''
+  def __init__(self, window: int = 1000):
+    self.found_total = 0
+    self.frames = 0
+    self.avg_rate = 0.0
+    self.counters = { 'framesDecoded': 0, 'framesInferred': 0, 'bytesWritten': 0 }
+    self.window = window
+    self.timings: dict[str, collections.deque] = {}
+    self.totals: dict[str, float] = {}
+    self.lock = threading.Lock() # the decoder thread adds its timings too
+
+  def add(self, stage: str, seconds: float):
+    with self.lock:
+      if stage not in self.timings:
+        self.timings[stage] = collections.deque(maxlen=self.window)
+        self.totals[stage] = 0.0
+      self.timings[stage].append(seconds)
+      self.totals[stage] += seconds
+
+  @contextlib.contextmanager
+  def time(self, stage: str):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(stage, time.perf_counter() - start)
+
+  def report(self) -> dict:
+    with self.lock:
+      timings = { stage: np.array(samples) for stage, samples in self.timings.items() }
+      totals = dict(self.totals)
+
+    rss, peak_rss = get_rss()
+    return {
+      'stages': {
+        stage: {
+          'p50': float(np.percentile(samples, 50)),
+          'p95': float(np.percentile(samples, 95)),
+          'max': float(samples.max()),
+          'total': totals[stage]
+        } for stage, samples in timings.items()
+      },
+      'counters': {
+        **self.counters,
+        'boxes': self.found_total,
+        'rss': rss,
+        'peakRss': peak_rss
+      }
+    }
+
+def merge_reports(reports: list[dict]) -> dict:
+  '''
+  Combines the reports of the workers, counters are summed up, of the percentiles
+  the p50s are averaged and the p95s and maximums are the worst of them. The workers
+  which haven't reported yet (empty or None) are left out.
+  '''
+  reports = [ report for report in reports if report is not None ]
+  stages = {}
+  counters = {}
+  for report in reports:
+    for stage, timing in report['stages'].items():
+      stages.setdefault(stage, []).append(timing)
+    for key, value in report['counters'].items():
+      counters[key] = counters.get(key, 0) + (value or 0)
+
+  return {
+    'stages': {
+      stage: {
+        'p50': sum([ timing['p50'] for timing in timings ]) / len(timings),
+        'p95': max([ timing['p95'] for timing in timings ]),
+        'max': max([ timing['max'] for timing in timings ]),
+        'total': sum([ timing['total'] for timing in timings ])
+      } for stage, timings in stages.items()
+    },
+    'counters': counters
+  }
+
+class FrameSampler:
+  '''
+  Decides which frames are worth predicting on, by comparing a small grayscale
+  thumbnail of each frame with the thumbnail of the last predicted frame.
+
+  The decoder thread samples ahead of the predictions, so the sampler remembers the thumbnails
+  of the predicted frames until `state_at` is asked for the state at a checkpoint. That state
+  can be given back as `state`, so a resumed analysis samples the same frames.
+  '''
+  def __init__(self, threshold: float, stride: int, size: int, state: dict | None = None):
+    self.threshold = threshold
+    self.stride = stride
+    self.size = size
+    self.last = None
+    self.skipped = 0
+    if state is not None:
+      if state['last'] is not None:
+        self.last = np.frombuffer(base64.b64decode(state['last']), np.uint8).reshape(state['shape'])
+      self.skipped = state['skipped']
+
+    self.seen = 0
+    # `(index, thumbnail)` of the last predicted frame up to the checkpoint, and of the ones after it
+    self.base = (-1 - self.skipped, self.last)
+    self.inferred: collections.deque[tuple[int, np.ndarray]] = collections.deque()
+
+  def should_infer(self, frame) -> bool:
+    height, width = frame.shape[:2]
+    thumb = cv2.resize(
+      cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+      (self.size, max(1, self.size * height // width)),
+      interpolation=cv2.INTER_AREA
+    )
+
+    if self.last is not None and self.skipped + 1 < self.stride:
+      difference = cv2.norm(thumb, self.last, cv2.NORM_L1) / (thumb.size * 255.0)
+      if difference <= self.threshold:
+        self.skipped += 1
+        self.seen += 1
+        return False
+
+    self.last = thumb
+    self.skipped = 0
+    self.inferred.append((self.seen, thumb))
+    self.seen += 1
+    return True
+
+  def state_at(self, count: int) -> dict:
+    '''
+    Returns the state right after the first `count` frames were sampled, and forgets the thumbnails before them.
+    '''
+    while len(self.inferred) != 0 and self.inferred[0][0] < count:
+      self.base = self.inferred.popleft()
+    index, last = self.base
+    return {
+      'last': base64.b64encode(last.tobytes()).decode() if last is not None else None,
+      'shape': list(last.shape) if last is not None else None,
+      'skipped': count - 1 - index
+    }
+
+def read_frames(cap, count: int, sampler: FrameSampler | None, stats: Stats):
+  '''
+  Yields at most `count` frames, frames which the `sampler` skipped are yielded as `None`.
+  '''
+  for _ in range(count):
+    with stats.time('decode'):
+      ret, frame = cap.read()
+    if ret is False:
+      sys.stderr.write('> ??? we got no frame? literally no cap\n')
+      break
+    stats.counters['framesDecoded'] += 1
+
+    if sampler is not None:
+      with stats.time('sample'):
+        if not sampler.should_infer(frame):
+          frame = None
+    yield frame
+
+def decode_frames(cap, count: int, sampler: FrameSampler | None, stats: Stats, frames: queue.Queue, stop: threading.Event):
+  '''
+  Decoder thread, puts the frames from `read_frames` into the `frames` queue followed by `END_OF_FRAMES`.
+  If reading fails, the exception is queued before `END_OF_FRAMES`, so that the consumer raises it.
+  '''
+  try:
+    for frame in read_frames(cap, count, sampler, stats):
+      if stop.is_set():
+        break
+      frames.put(frame)
+  except Exception as err:
+    frames.put(err)
+  finally:
+    frames.put(END_OF_FRAMES)
+
+def iter_queue(frames: queue.Queue, stats: Stats):
+  '''
+  Yields the frames from the decoder thread, the time spent waiting for them is the `wait` stage.
+  '''
+  while True:
+    with stats.time('wait'):
+      frame = frames.get()
+    if frame is END_OF_FRAMES:
+      break
+    if isinstance(frame, Exception):
+      raise frame
+    yield frame
+
+def iter_batches(cap, count: int, batch: int, stats: Stats, sampler: FrameSampler | None = None):
+  '''
+  Yields lists of consecutive frames, at most `count` frames in total. Each list holds
+  at most `batch` frames to predict on, the skipped frames in between are `None`.
+
+  With `batch <= 1` the frames are read on the calling thread, otherwise a decoder
+  thread keeps a bounded queue filled while the caller is busy predicting.
+  '''
+  if batch <= 1:
+    frames = read_frames(cap, count, sampler, stats)
+  else:
+    queued = queue.Queue(maxsize=batch * 2)
+    stop = threading.Event()
+    decoder = threading.Thread(target=decode_frames, args=(cap, count, sampler, stats, queued, stop), daemon=True)
+    decoder.start()
+    frames = iter_queue(queued, stats)
+
+  try:
+    bucket = []
+    to_infer = 0
+    for frame in frames:
+      bucket.append(frame)
+      if frame is not None:
+        to_infer += 1
+      if to_infer == max(batch, 1) or len(bucket) >= MAX_PENDING_FRAMES:
+        yield bucket
+        bucket = []
+        to_infer = 0
+    if len(bucket) != 0:
+      yield bucket
+  finally:
+    if batch > 1:
+      stop.set()
+      # the decoder might be stuck on a full queue and it uses the capture until it returns
+      while decoder.is_alive():
+        with contextlib.suppress(queue.Empty):
+          queued.get(timeout=0.1)
+
+def add_to_ranges(ranges: list[list[int]], pos: int):
+  '''
+  Appends `pos` to a list of inclusive `[start, end]` ranges of increasing positions.
+  '''
+  if len(ranges) != 0 and ranges[-1][1] == pos - 1:
+    ranges[-1][1] = pos
+  else:
+    ranges.append([pos, pos])
+
+def get_checkpoint_path(output: str):
+  return f'{output}.checkpoint'
+
+def save_checkpoint(output: str, checkpoint: dict):
+  '''
+  Replaces the checkpoint atomically, so a crash never leaves a half-written one behind.
+  '''
+  checkpoint_path = get_checkpoint_path(output)
+  with open(f'{checkpoint_path}.tmp', 'wt') as file:
+    json.dump(checkpoint, file)
+  os.replace(f'{checkpoint_path}.tmp', checkpoint_path)
+
+def load_checkpoint(output: str):
+  checkpoint_path = get_checkpoint_path(output)
+  if not os.path.exists(checkpoint_path) or not os.path.exists(output):
+    return None
+  with open(checkpoint_path, 'rt') as file:
+    return json.load(file)
+
+def get_video(url: str) -> dict | None:
+  '''
+  Returns the information about the video, `video['format']['url']` is what gets opened.
+  A path to a local file is opened directly, anything else goes through yt_dlp.
+  '''
+  if os.path.isfile(url):
+    cap = cv2.VideoCapture(url)
+    if not cap.isOpened():
+      return None
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    name = os.path.basename(url)
+    video = {
+      'title': name,
+      'id': os.path.splitext(name)[0],
+      'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+      'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+      'fps': fps,
+      'channel': 'local',
+      'duration': cap.get(cv2.CAP_PROP_FRAME_COUNT) / fps,
+      'uploader_id': None,
+      'channel_id': 'local',
+      'format': {
+        'format': 'local',
+        'format_note': 'local file',
+        'format_id': 'local',
+        'url': url
+      }
+    }
+    cap.release()
+    print(f'> Analyzing local "{url}" ({video['width']}x{video['height']} @ {video['fps']}), long {video['duration']} seconds', file=sys.stderr)
+    return video
 
   from yt_dlp import YoutubeDL
   with YoutubeDL({ 'quiet': 'please', 'format': 'bestvideo[height<=1080][ext=mp4][vcodec^=avc]' }) as ytdl:
-    info = ytdl.extract_info(argv.url, download=False)
+    info = ytdl.extract_info(url, download=False)
     if info is None:
       print(f'> YouTube didn\'t return a video result, sad tako...', file=sys.stderr)
-      exit(1)
+      return None
 
     video = {}
     for key in ['title', 'id', 'width', 'height', 'fps', 'channel', 'duration', 'uploader_id', 'channel_id']:
@@ -57,111 +561,404 @@ if __name__ == '__main__':
     print(f'> Using format_id={fmt['format_id']} aka {fmt['format_note']}', file=sys.stderr)
     video['format'] = fmt
 
-  if video is None:
-    print('Received no video... the hell?', file=sys.stderr)
-    exit(1)
+  return video
 
-  import cv2
-  from ultralytics import YOLO
-  yoloModel = YOLO(argv.model)
-
-  cap = cv2.VideoCapture(video['format']['url'])
-  vWidth = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-  vHeight = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-  vFrames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-  vFPS = int(cap.get(cv2.CAP_PROP_FPS))
+def write_summary(path: str, frames: int, elapsed: float, report: dict):
+  with open(path, 'wt') as file:
+    json.dump({
+      'frames': frames,
+      'elapsed': elapsed,
+      'fps': frames / elapsed if elapsed > 0 else None,
+      **report
+    }, file, indent=2)
 
-  vFramesStr = datetime.timedelta(seconds=vFrames/vFPS)
-
-  with open(argv.output, 'wt') as file:
-    frame_pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES)) # should be 0, but just to be sure
-    found_total = 0
-    avg_rate = 0
-    last_time = time.time()
-
-    metadata = {
-      "video": {
-        'title': video['title'],
-        'id': video['id'],
-        'width': video['width'],
-        'height': video['height'],
-        'fps': video['fps'],
-        'channel': video['channel'],
-        'duration': video['duration'],
-        'format': video['format']['format'],
-        'uploader_id': video['uploader_id'],
-        'channel_id': video['channel_id']
+def print_progress(argv: argparse.Namespace, frame_pos: int, vFrames: int, vFPS: int, found_total: int, avg_rate: float, time_diff: float, report: dict | None = None):
+  if argv.json:
+    emit({
+      **({ 'job': argv.job } if argv.job is not None else {}),
+      'currentFrame': frame_pos,
+      'totalFrames': vFrames,
+      'rate': {
+        'average': avg_rate,
+        'last': time_diff
       },
-      "argv": vars(argv)
-    }
-    file.write(f"#$ {json.dumps(metadata)}\n")
-    file.write(f'time;class;confidence;x;y;w;h\n')
-    while cap.isOpened():
-      ret, frame = cap.read()
+      **(report or {})
+    })
+  else:
+    vFramesStr = datetime.timedelta(seconds=vFrames/vFPS)
+    # both rates are still 0 if no frame was analyzed, for eg. when resuming at the end
+    fps = 1.0 / time_diff if time_diff else 0.0
+    avg_fps = 1.0 / avg_rate if avg_rate else 0.0
+    sys.stderr.write(f'\r{(frame_pos/vFrames*100.0):.2f}% | {datetime.timedelta(seconds=math.floor(frame_pos / vFPS))} - {vFramesStr} | {frame_pos}/{vFrames} | {found_total} | {fps:.2f} FPS ({time_diff:.1f} ms) | {avg_fps:.2f} aFPS ({avg_rate:.1f} ms) | ETA: {datetime.timedelta(seconds=math.floor((vFrames - frame_pos) * avg_rate))}         ')
 
-      if ret is False:
-        sys.stderr.writable('> ??? we got no frame? literally no cap')
-        break
+def analyze_frames(argv: argparse.Namespace, yoloModel, cap, writer, frame_pos: int, end: int, vFPS: int, stats: Stats, on_progress, on_checkpoint=None, stop: threading.Event | None = None, state: dict | None = None):
+  '''
+  Predicts on the frames from `frame_pos` up to `end` (exclusive) and writes their detections into the `writer`.
+
+  `stats` holds the running totals and timings. `on_progress(pos, time_diff)` is called
+  every second of the video and `on_checkpoint(frame_pos, state)` every `--checkpoint-interval` seconds,
+  right after everything before `frame_pos` was written. Passing that `state` back continues the
+  sampling exactly where it was. Once `stop` is set, the analysis ends after the current batch.
+  Returns the position after the last frame.
+  '''
+  checkpoint_every = max(1, int(vFPS * argv.checkpoint_interval))
+  start_pos = frame_pos
+  sampler = None
+  if argv.sample_threshold > 0:
+    sampler = FrameSampler(argv.sample_threshold, argv.sample_stride, argv.sample_size, state['sampler'] if state is not None else None)
+  inferred_ranges: list[list[int]] = []
+  last_detections = None
+  if state is not None and state['detections'] is not None:
+    classes, confidences, xywh = state['detections']
+    last_detections = (np.array(classes, np.uint16), np.array(confidences, np.float32), np.array(xywh, np.float64).reshape(-1, 4))
+  time_diff = 0
+  last_time = time.time()
 
-      for result in yoloModel.predict(
-        source=frame,
+  batches = iter_batches(cap, end - frame_pos, argv.batch, stats, sampler)
+  for frames in batches:
+    if stop is not None and stop.is_set():
+      batches.close()
+      break
+
+    to_infer = [ frame for frame in frames if frame is not None ]
+    results = iter(())
+    if len(to_infer) != 0:
+      # a lone frame is passed as is, so the per-frame path predicts exactly like before
+      results = list(yoloModel.predict(
+        source=to_infer if len(to_infer) > 1 else to_infer[0],
         conf=argv.conf,
         iou=argv.iou,
         imgsz=argv.imgsz,
         stream=True,
         verbose=argv.verbose,
         show=argv.show,
-      ):
+      ))
+      stats.counters['framesInferred'] += len(to_infer)
+
+      # ultralytics measures these per frame in milliseconds
+      for result in results:
+        stats.add('preprocess', result.speed['preprocess'] / 1000.0)
+        stats.add('inference', result.speed['inference'] / 1000.0)
+        stats.add('nms', result.speed['postprocess'] / 1000.0)
+      results = iter(results)
+
+    for frame in frames:
+      # skipped frames carry the detections of the last predicted frame forward
+      if frame is not None:
+        result = next(results)
+        add_to_ranges(inferred_ranges, frame_pos)
         if result.boxes is None:
-          sys.stderr.write(f'> ??? result.boxes is None?\n', file=sys.stderr)
-          continue
+          sys.stderr.write(f'> ??? result.boxes is None?\n')
+          last_detections = None
+        else:
+          with stats.time('boxes'):
+            last_detections = boxes_to_arrays(result.boxes)
+
+      if last_detections is not None:
+        with stats.time('write'):
+          writer.write(frame_pos, *last_detections)
+        stats.found_total += len(last_detections[0])
+
+      frame_pos += 1
+
+    # the batch is predicted all at once, so its time is spread evenly over its frames
+    now_time = time.time()
+    time_diff = (now_time - last_time) / len(frames)
+    last_time = now_time
+    should_checkpoint = False
+    for pos in range(frame_pos - len(frames), frame_pos):
+      stats.frames += 1
+      stats.avg_rate = stats.avg_rate + (time_diff - stats.avg_rate) / stats.frames
+      if pos % vFPS == 0:
+        stats.counters['bytesWritten'] = writer.size()
+        on_progress(pos, time_diff)
 
-        for box in result.boxes:
-          name = result.names[int(box.cls[0])]
-          confidence = float(box.conf[0])
-          x, y, w, h = [ float(i) for i in box.xywhn[0] ]
-          x = x - w/2.0
-          y = y - h/2.0
-          file.write(f'{(frame_pos / vFrames) * video['duration']};{name};{confidence};{x};{y};{w};{h}\n')
-          found_total += 1
+      if pos % checkpoint_every == 0:
+        should_checkpoint = True
 
+    if should_checkpoint:
+      if sampler is not None:
+        writer.comment({ 'inferred': inferred_ranges })
+        inferred_ranges = []
+      with stats.time('flush'):
+        # the frames skipped right after a resume need the detections they carry forward
+        checkpoint_state = {
+          'sampler': sampler.state_at(frame_pos - start_pos) if sampler is not None else None,
+          'detections': [ v.tolist() for v in last_detections ] if sampler is not None and last_detections is not None else None
+        }
+        if on_checkpoint is not None:
+          on_checkpoint(frame_pos, checkpoint_state)
+        else:
+          writer.flush()
+
+  if sampler is not None and len(inferred_ranges) != 0:
+    writer.comment({ 'inferred': inferred_ranges })
+  stats.counters['bytesWritten'] = writer.flush()
+  on_progress(frame_pos, time_diff)
+  return frame_pos
+
+def analyze_segment(argv: argparse.Namespace, video: dict, metadata: dict, start: int, end: int, output: str, progress, index: int):
+  '''
+  Worker process for `--workers`, analyzes the frames from `start` up to `end` into its own `output`.
+  Puts `(index, frames_done, found_total, report, finished)` into the `progress` queue.
+  '''
+  from ultralytics import YOLO
+  yoloModel = YOLO(argv.model)
+
+  cap = open_video(argv, video['format']['url'])
+  cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+  if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != start:
+    sys.stderr.write(f'> !!! worker {index} wanted to seek to frame {start}, but got to {int(cap.get(cv2.CAP_PROP_POS_FRAMES))}\n')
+
+  stats = Stats()
+  with WRITERS[argv.format](output, metadata) as writer:
+    frame_pos = analyze_frames(
+      argv, yoloModel, cap, writer, start, end, int(metadata['video']['fps']), stats,
+      on_progress=lambda pos, time_diff: progress.put((index, pos - start, stats.found_total, stats.report(), False))
+    )
+  cap.release()
+  progress.put((index, frame_pos - start, stats.found_total, stats.report(), True))
+
+def analyze_parallel(argv: argparse.Namespace, video: dict, metadata: dict, vFrames: int, vFPS: int, stop: threading.Event | None = None):
+  '''
+  Splits the video into `--workers` consecutive frame ranges, analyzes them in separate processes
+  and concatenates their outputs in order, which keeps the output sorted by time.
+  Returns the merged report of the workers, or None when `stop` was set in the meantime.
+  '''
+  context = multiprocessing.get_context('spawn') # torch does not like being forked
+  progress = context.Queue()
+  bounds = [ vFrames * i // argv.workers for i in range(argv.workers + 1) ]
+  partials = [ f'{argv.output}.part{i}' for i in range(argv.workers) ]
+  workers = [
+    context.Process(target=analyze_segment, args=(argv, video, metadata, bounds[i], bounds[i+1], partials[i], progress, i))
+    for i in range(argv.workers)
+  ]
+  for worker in workers:
+    worker.start()
+
+  done = [ 0 ] * argv.workers
+  found = [ 0 ] * argv.workers
+  reports = [ { 'stages': {}, 'counters': {} } ] * argv.workers
+  finished = 0
+  start_time = last_time = time.time()
+  last_done = 0
+  while finished < argv.workers:
+    if stop is not None and stop.is_set():
+      for worker in workers:
+        worker.kill()
+        worker.join()
+      for partial in partials:
+        if os.path.exists(partial):
+          os.remove(partial)
+      return None
+
+    try:
+      index, frames, found_total, report, is_finished = progress.get(timeout=1.0)
+    except queue.Empty:
+      if any(worker.exitcode not in (None, 0) for worker in workers):
+        for worker in workers:
+          worker.kill()
+        raise Exception('One of the workers died, giving up')
+      continue
+
+    done[index] = frames
+    found[index] = found_total
+    reports[index] = report
+    finished += 1 if is_finished else 0
+
+    total_done = sum(done)
+    if total_done // vFPS != last_done // vFPS or (finished == argv.workers and total_done != last_done):
       now_time = time.time()
-      time_diff = now_time - last_time
+      time_diff = (now_time - last_time) / max(1, total_done - last_done)
+      avg_rate = (now_time - start_time) / max(1, total_done)
+      print_progress(argv, total_done, vFrames, vFPS, sum(found), avg_rate, time_diff, merge_reports(reports))
       last_time = now_time
-      avg_rate = avg_rate + (time_diff - avg_rate) / (frame_pos+1)
-      if frame_pos % vFPS == 0:
-        if argv.json:
-          sys.stdout.write(json.dumps({
-            'currentFrame': frame_pos,
-            'totalFrames': vFrames,
-            'rate': {
-              'average': avg_rate,
-              'last': time_diff
-            }
-          }) + '\n')
-          sys.stdout.flush()
-        else:
-          sys.stderr.write(f'\r{(frame_pos/vFrames*100.0):.2f}% | {datetime.timedelta(seconds=math.floor(frame_pos / vFPS))} - {vFramesStr} | {frame_pos}/{vFrames} | {found_total} | {(1.0 / time_diff):.2f} FPS ({time_diff:.1f} ms) | {(1.0 / avg_rate):.2f} aFPS ({avg_rate:.1f} ms) | ETA: {datetime.timedelta(seconds=math.floor((vFrames - frame_pos) * avg_rate))}         ')
+      last_done = total_done
 
-      if frame_pos % (vFPS * 100) == 0:
-        file.flush()
+  for worker in workers:
+    worker.join()
 
-      frame_pos += 1
-      if frame_pos == vFrames:
-        if argv.json:
-          sys.stdout.write(json.dumps({
-            'currentFrame': frame_pos,
-            'totalFrames': vFrames,
-            'rate': {
-              'average': avg_rate,
-              'last': time_diff
-            }
-          }) + '\n')
-          sys.stdout.flush()
+  concatenate(partials, argv.output)
+  for partial in partials:
+    os.remove(partial)
+  return merge_reports(reports)
+
+def analyze(argv: argparse.Namespace, get_model, stop: threading.Event | None = None) -> bool:
+  '''
+  Analyzes `argv.url` into `argv.output`, `get_model(path)` returns the loaded weights.
+  Returns False when `stop` was set before the end, the last checkpoint is then kept for `--resume`.
+  '''
+  checkpoint = load_checkpoint(argv.output) if argv.resume else None
+  if checkpoint is not None:
+    for key, value in checkpoint['metadata']['argv'].items():
+      if key not in RUNTIME_ARGS:
+        setattr(argv, key, value)
+    print(f'> Resuming from frame {checkpoint['frame']} of {checkpoint['metadata']['frames']}', file=sys.stderr)
+  elif argv.resume:
+    print(f'> No checkpoint found for "{argv.output}", starting from the beginning', file=sys.stderr)
+
+  video = get_video(argv.url)
+  if video is None:
+    raise Exception('Received no video... the hell?')
+
+  yoloModel = get_model(argv.model)
+
+  cap = open_video(argv, video['format']['url'])
+  vFrames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+  vFPS = int(cap.get(cv2.CAP_PROP_FPS))
+
+  metadata = {
+    "video": {
+      'title': video['title'],
+      'id': video['id'],
+      'width': video['width'],
+      'height': video['height'],
+      'fps': video['fps'],
+      'channel': video['channel'],
+      'duration': video['duration'],
+      'format': video['format']['format'],
+      'uploader_id': video['uploader_id'],
+      'channel_id': video['channel_id']
+    },
+    "argv": vars(argv),
+    "frames": vFrames,
+    "names": yoloModel.names
+  }
+
+  start_time = time.time()
+  if argv.workers > 1:
+    # the workers load their own models and open their own captures
+    cap.release()
+    report = analyze_parallel(argv, video, metadata, vFrames, vFPS, stop)
+    if report is None:
+      return False
+    if argv.summary is not None:
+      write_summary(argv.summary, vFrames, time.time() - start_time, report)
+    return True
+
+  frame_pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES)) # should be 0, but just to be sure
+  stats = Stats()
+  offset = None
+  writer_state = None
+  if checkpoint is not None:
+    # the timestamps depend on the frame count, so stick with the one the output was started with
+    metadata = checkpoint['metadata']
+    vFrames = metadata['frames']
+    frame_pos = checkpoint['frame']
+    stats.found_total = checkpoint['found_total']
+    stats.frames = frame_pos
+    stats.avg_rate = checkpoint['avg_rate']
+    offset = checkpoint['offset']
+    writer_state = checkpoint.get('writer')
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_pos)
+
+  with WRITERS[argv.format](argv.output, metadata, offset=offset, state=writer_state) as writer:
+    def on_checkpoint(frame_pos: int, state: dict):
+      # every frame before frame_pos is written by now, so that is where a resume continues from
+      save_checkpoint(argv.output, {
+        'frame': frame_pos,
+        'offset': writer.flush(),
+        'writer': writer.state(),
+        'sampling': state,
+        'found_total': stats.found_total,
+        'avg_rate': stats.avg_rate,
+        'metadata': metadata
+      })
+
+    end_pos = analyze_frames(
+      argv, yoloModel, cap, writer, frame_pos, vFrames, vFPS, stats,
+      on_progress=lambda pos, time_diff: print_progress(argv, pos, vFrames, vFPS, stats.found_total, stats.avg_rate, time_diff, stats.report()),
+      on_checkpoint=on_checkpoint,
+      stop=stop,
+      state=checkpoint.get('sampling') if checkpoint is not None else None
+    )
+    cap.release()
+
+  if stop is not None and stop.is_set():
+    return False
+
+  if argv.summary is not None:
+    write_summary(argv.summary, end_pos - frame_pos, time.time() - start_time, stats.report())
+
+  # the output is complete, nothing to resume anymore
+  if os.path.exists(get_checkpoint_path(argv.output)):
+    os.remove(get_checkpoint_path(argv.output))
+  return True
+
+def serve(argv: argparse.Namespace):
+  '''
+  Reads the jobs as JSON lines from stdin and analyzes them one after another, keeping
+  the last `--models` models loaded in between. `{"cancel": id}` stops a job, whether it
+  is running or still waiting. Ends once stdin is closed and the waiting jobs are done.
+  '''
+  parser = get_parser()
+  models = ModelCache(argv.models)
+  jobs = queue.Queue()
+  waiting = collections.Counter() # ids of the queued jobs, so only their cancels are kept
+  cancelled = set()
+  current = None # (id, stop) of the running job
+  lock = threading.Lock()
+
+  def run_jobs():
+    nonlocal current
+    while (job := jobs.get()) is not END_OF_JOBS:
+      with lock:
+        waiting[job['id']] -= 1
+        if waiting[job['id']] <= 0:
+          del waiting[job['id']]
+        if job['id'] in cancelled:
+          cancelled.discard(job['id'])
+          emit({ 'job': job['id'], 'status': 'cancelled' })
+          continue
+        stop = threading.Event()
+        current = (job['id'], stop)
+
+      emit({ 'job': job['id'], 'status': 'started' })
+      try:
+        finished = analyze(get_job_argv(parser, job), models.get, stop)
+        emit({ 'job': job['id'], 'status': 'finished' if finished else 'cancelled' })
+      except (Exception, SystemExit) as err: # argparse exits on invalid values
+        traceback.print_exc()
+        emit({ 'job': job['id'], 'status': 'failed', 'error': str(err) })
+      finally:
+        with lock:
+          current = None
+          cancelled.discard(job['id'])
+
+  runner = threading.Thread(target=run_jobs)
+  runner.start()
+  print(f'> Waiting for jobs on stdin', file=sys.stderr)
+
+  for line in sys.stdin:
+    if len(line.strip()) == 0:
+      continue
+    try:
+      request = json.loads(line)
+      if not isinstance(request, dict) or request.get('id', request.get('cancel')) is None:
+        raise ValueError('expected an object with either "id" or "cancel"')
+    except ValueError as err:
+      emit({ 'job': None, 'status': 'failed', 'error': f'invalid request: {err}' })
+      continue
+
+    if 'cancel' in request:
+      with lock:
+        if current is not None and current[0] == request['cancel']:
+          current[1].set()
+        elif request['cancel'] in waiting:
+          cancelled.add(request['cancel'])
         else:
-          sys.stderr.write(f'\r{(frame_pos/vFrames*100.0):.2f}% | {datetime.timedelta(seconds=math.floor(frame_pos / vFPS))} - {vFramesStr} | {frame_pos}/{vFrames} | {found_total} | {(1.0 / time_diff):.2f} FPS ({time_diff:.1f} ms) | {(1.0 / avg_rate):.2f} aFPS ({avg_rate:.1f} ms) | ETA: {datetime.timedelta(seconds=math.floor((vFrames - frame_pos) * avg_rate))}         ')
+          print(f'> Ignoring the cancel of {request['cancel']}, no such job is waiting or running', file=sys.stderr)
+    else:
+      with lock:
+        waiting[request['id']] += 1
+      jobs.put(request)
 
-        cap.release()
-        break
+  jobs.put(END_OF_JOBS)
+  runner.join()
 
-    file.flush()
+if __name__ == '__main__':
+  argv = get_argv()
+  if argv.serve:
+    serve(argv)
+  else:
+    analyze(argv, load_model)
@@ -0,0 +1,149 @@
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+import cv2
+import numpy as np
+
+ANALYZER = path.join(path.dirname(path.abspath(__file__)), 'analyze-youtube.py')
+
+def get_argv():
+  parser = argparse.ArgumentParser(description='measures the throughput of analyze-youtube.py on synthetic local videos')
+  parser.add_argument(
+    '-m', '--model',
+    help='path to the weights',
+    required=True
+  )
+  parser.add_argument(
+    '-o', '--output',
+    help='where to write the JSON results, defaults to stdout',
+    default=None
+  )
+  parser.add_argument(
+    '-r', '--resolution',
+    help='resolutions of the generated videos, as WIDTHxHEIGHT',
+    nargs='+',
+    default=['1920x1080']
+  )
+  parser.add_argument('--fps', help='framerate of the generated videos', default=60, type=int)
+  parser.add_argument('-l', '--length', help='length of the generated videos in seconds', default=10, type=float)
+  parser.add_argument('--imgsz', nargs='+', default=[736], type=int)
+  parser.add_argument('-b', '--batch', nargs='+', default=[1], type=int)
+  parser.add_argument(
+    '-s', '--sample',
+    help='values of --sample-threshold to try (0.0 predicts on every frame)',
+    nargs='+',
+    default=[0.0],
+    type=float
+  )
+  parser.add_argument('-f', '--format', nargs='+', default=['csv'], choices=['csv', 'binary', 'tracks'])
+  parser.add_argument('--decoder', nargs='+', default=['opencv'], choices=['opencv', 'ffmpeg'])
+  parser.add_argument('--conf', default=0.8, type=float)
+  parser.add_argument(
+    '-d', '--workdir',
+    help='where to keep the generated videos and outputs, they are reused between runs (defaults to a temporary folder)',
+    default=None
+  )
+  parser.add_argument('--seed', default=42, type=int)
+  return parser.parse_args()
+
+def generate_video(filepath: str, width: int, height: int, fps: int, length: float, seed: int):
+  '''
+  Writes a video of coloured boxes moving over a noisy gradient, with every other
+  few seconds being completely still, so that the adaptive sampling has something to skip.
+  '''
+  rng = np.random.default_rng(seed)
+  writer = cv2.VideoWriter(filepath, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+
+  background = np.zeros((height, width, 3), np.uint8)
+  background[:, :, 0] = np.linspace(0, 255, width, dtype=np.uint8)[None, :]
+  background[:, :, 1] = np.linspace(0, 255, height, dtype=np.uint8)[:, None]
+  background[:, :, 2] = rng.integers(0, 64, (height, width), dtype=np.uint8)
+
+  n_boxes = 8
+  positions = rng.random((n_boxes, 2)) * [ width, height ]
+  velocities = (rng.random((n_boxes, 2)) - 0.5) * [ width, height ] / fps
+  sizes = (rng.random((n_boxes, 2)) * 0.15 + 0.05) * [ width, height ]
+  colors = rng.integers(0, 255, (n_boxes, 3))
+
+  frame = background.copy()
+  for idx in range(int(length * fps)):
+    still = (idx // (fps * 3)) % 2 == 1
+    if not still:
+      positions = (positions + velocities) % [ width, height ]
+      frame = background.copy()
+      for (x, y), (w, h), color in zip(positions.astype(int), sizes.astype(int), colors.tolist()):
+        cv2.rectangle(frame, (x, y), (x + w, y + h), color, thickness=cv2.FILLED)
+    writer.write(frame)
+  writer.release()
+
+def run_analyzer(argv: argparse.Namespace, video: str, output: str, imgsz: int, batch: int, sample: float, format: str, decoder: str):
+  summary = f'{output}.summary.json'
+  command = [
+    sys.executable, ANALYZER, video,
+    '-m', argv.model,
+    '-o', output,
+    '--conf', str(argv.conf),
+    '--imgsz', str(imgsz),
+    '--batch', str(batch),
+    '--sample-threshold', str(sample),
+    '--format', format,
+    '--decoder', decoder,
+    '--summary', summary,
+    '--json'
+  ]
+
+  start = time.time()
+  process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  wall = time.time() - start
+  if process.returncode != 0:
+    sys.stderr.write(process.stderr.decode(errors='replace'))
+    raise Exception(f'analyzer failed with code {process.returncode}: {' '.join(command)}')
+
+  with open(summary, 'rt') as file:
+    result = json.load(file)
+  result['wall'] = wall # includes the startup and the model loading
+  result['outputBytes'] = os.path.getsize(output)
+  return result
+
+if __name__ == '__main__':
+  argv = get_argv()
+  workdir = argv.workdir if argv.workdir is not None else tempfile.mkdtemp(prefix='pam-bench-')
+  os.makedirs(workdir, exist_ok=True)
+
+  results = []
+  for resolution in argv.resolution:
+    width, height = [ int(v) for v in resolution.split('x') ]
+    video = path.join(workdir, f'synthetic_{width}x{height}_{argv.fps}_{argv.length}_{argv.seed}.mp4')
+    if not path.exists(video):
+      print(f'[i] generating {video}', file=sys.stderr)
+      generate_video(video, width, height, argv.fps, argv.length, argv.seed)
+
+    for imgsz, batch, sample, format, decoder in itertools.product(argv.imgsz, argv.batch, argv.sample, argv.format, argv.decoder):
+      print(f'[i] {resolution} imgsz={imgsz} batch={batch} sample={sample} format={format} decoder={decoder}', file=sys.stderr)
+      output = path.join(workdir, f'out_{width}x{height}_{imgsz}_{batch}_{sample}_{decoder}.{format}')
+      result = run_analyzer(argv, video, output, imgsz, batch, sample, format, decoder)
+      print(f'[i] -> {result['fps']:.2f} FPS, peak {(result['counters']['peakRss'] or 0) / 1024**2:.0f} MiB', file=sys.stderr)
+      results.append({
+        'resolution': resolution,
+        'fps': argv.fps,
+        'length': argv.length,
+        'imgsz': imgsz,
+        'batch': batch,
+        'sample': sample,
+        'format': format,
+        'decoder': decoder,
+        'result': result
+      })
+
+  report = json.dumps({ 'model': argv.model, 'runs': results }, indent=2)
+  if argv.output is not None:
+    with open(argv.output, 'wt') as file:
+      file.write(report)
+  else:
+    print(report)
@@ -0,0 +1,243 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+from os import path
+import cv2
+import numpy as np
+import utils
+
+def get_argv():
+  parser = argparse.ArgumentParser(description='measures annotate_file and annotate_layer_file on synthetic screenshots, and checks them against the reference implementations')
+  parser.add_argument(
+    '-o', '--output',
+    help='where to write the JSON results, defaults to stdout',
+    default=None
+  )
+  parser.add_argument(
+    '-r', '--resolution',
+    help='resolutions of the whole quadrant screenshots (and the tifs), as WIDTHxHEIGHT',
+    nargs='+',
+    default=['1920x1080']
+  )
+  parser.add_argument('-e', '--entities', help='number of entities per screenshot', nargs='+', default=[10, 60], type=int)
+  parser.add_argument('-b', '--blob', help='typical size of an entity in pixels', nargs='+', default=[24, 96], type=int)
+  parser.add_argument(
+    '-m', '--modifiers',
+    help='filename modifiers of the screenshots (see get_modifiers_from_filename), "-" for none',
+    nargs='+',
+    default=['-', 's', 'm8.e2.d3']
+  )
+  parser.add_argument('-l', '--layers', help='number of entity layers of the tifs, 0 to skip them', nargs='+', default=[8, 32], type=int)
+  parser.add_argument('-w', '--workers', help='process counts to measure the throughput with', nargs='+', default=[1, os.cpu_count() or 1], type=int)
+  parser.add_argument('-n', '--images', help='images per case', default=4, type=int)
+  parser.add_argument(
+    '-d', '--workdir',
+    help='where to keep the generated images, they are reused between runs (defaults to a temporary folder)',
+    default=None
+  )
+  parser.add_argument('--seed', default=42, type=int)
+  return parser.parse_args()
+
+def draw_entities(rng: np.random.Generator, height: int, width: int, count: int, blob: int) -> np.ndarray:
+  '''
+  Returns an image of entity IDs with `count` distinct entities, each made of a few overlapping
+  and nearby ellipses around `blob` pixels big, so that the closing has gaps to fill.
+  '''
+  entities = np.zeros((height, width), np.uint16)
+  for id in rng.choice(np.arange(1, 512), size=count, replace=False):
+    cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+    for _ in range(int(rng.integers(1, 4))):
+      x = cx + int(rng.normal(0, blob / 2))
+      y = cy + int(rng.normal(0, blob / 2))
+      axes = (max(1, int(rng.uniform(0.2, 0.6) * blob)), max(1, int(rng.uniform(0.2, 0.6) * blob)))
+      cv2.ellipse(entities, (x, y), axes, float(rng.uniform(0, 180)), 0, 360, int(id), thickness=cv2.FILLED)
+  return entities
+
+def encode_bitplanes(entities: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  The inverse of `utils.BitplaneDecoder`, every bit of the IDs becomes a saturated channel.
+  '''
+  bitplanes = []
+  for shift in (6, 3, 0):
+    bitplane = np.zeros((*entities.shape, 3), np.uint8)
+    for channel in range(3):
+      bitplane[:, :, channel] = ((entities >> (shift + channel)) & 1) * 255
+    bitplanes.append(bitplane)
+  return tuple(bitplanes)
+
+def make_background(rng: np.random.Generator, height: int, width: int) -> np.ndarray:
+  background = np.zeros((height, width, 3), np.uint8)
+  background[:, :, 0] = np.linspace(0, 255, width, dtype=np.uint8)[None, :]
+  background[:, :, 1] = np.linspace(0, 255, height, dtype=np.uint8)[:, None]
+  background[:, :, 2] = rng.integers(0, 64, (height, width), dtype=np.uint8)
+  return background
+
+def generate_screenshot(filepath: str, width: int, height: int, count: int, blob: int, seed: int):
+  '''
+  Writes a quadrant screenshot as the shader renders it: the image in TL, and the bitplanes of the entity IDs in TR, BL and BR.
+  '''
+  rng = np.random.default_rng(seed)
+  h, w = height // 2, width // 2
+  bitplane1, bitplane2, bitplane3 = encode_bitplanes(draw_entities(rng, h, w, count, blob))
+  image = np.zeros((h * 2, w * 2, 3), np.uint8)
+  image[0:h, 0:w] = make_background(rng, h, w)
+  image[0:h, w:] = bitplane1
+  image[h:, 0:w] = bitplane2
+  image[h:, w:] = bitplane3
+  cv2.imwrite(filepath, image)
+
+def generate_layers(filepath: str, width: int, height: int, layers: int, blob: int, seed: int):
+  '''
+  Writes a layered tif: the image, then one page per layer with a few blobs in random colours on black.
+  '''
+  rng = np.random.default_rng(seed)
+  pages = [ make_background(rng, height, width) ]
+  for _ in range(layers):
+    layer = np.zeros((height, width, 3), np.uint8)
+    for _ in range(int(rng.integers(1, 4))):
+      center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+      axes = (max(1, int(rng.uniform(0.2, 0.6) * blob)), max(1, int(rng.uniform(0.2, 0.6) * blob)))
+      cv2.ellipse(layer, center, axes, float(rng.uniform(0, 180)), 0, 360, [ int(c) for c in rng.integers(1, 256, 3) ], thickness=cv2.FILLED)
+    pages.append(layer)
+  cv2.imwritemulti(filepath, pages)
+
+def same_contours(a: list[tuple[int, list]], b: list[tuple[int, list]]) -> bool:
+  if [ id for id, _ in a ] != [ id for id, _ in b ]:
+    return False
+  for (_, contours_a), (_, contours_b) in zip(a, b):
+    if len(contours_a) != len(contours_b):
+      return False
+    if not all([ np.array_equal(x, y) for x, y in zip(contours_a, contours_b) ]):
+      return False
+  return True
+
+def timed(function, *args):
+  start = time.perf_counter()
+  result = function(*args)
+  return result, time.perf_counter() - start
+
+def annotate_screenshot(filepath: str):
+  return utils.annotate_file(filepath, format='center')[1]
+
+def annotate_tif(filepath: str):
+  return utils.annotate_layer_file(filepath, format='center')[1]
+
+def measure_throughput(function, files: list[str], workers: int) -> float:
+  '''
+  Returns the files per second of annotating all of them with `workers` processes (started beforehand).
+  '''
+  with Pool(processes=workers) as pool:
+    pool.map(function, files[:workers]) # warm up the processes
+    start = time.perf_counter()
+    pool.map(function, files, chunksize=1)
+    return len(files) / (time.perf_counter() - start)
+
+def bench_screenshots(argv: argparse.Namespace, files: list[str]) -> dict:
+  '''
+  Times the stages of `annotate_file` and of their references on every file, and checks that they agree.
+  '''
+  stages = { key: [] for key in [ 'read', 'decode', 'decodeReference', 'labeling', 'labelingReference', 'contours', 'contoursReference', 'annotate' ] }
+  identical = True
+  decoder = utils.BitplaneDecoder()
+  for filepath in files:
+    image, elapsed = timed(cv2.imread, filepath, cv2.IMREAD_COLOR)
+    stages['read'].append(elapsed)
+    _, bitplane1, bitplane2, bitplane3 = utils.split_quadrants(image, filepath)
+    modifier = utils.get_modifiers_from_filename('.'.join(path.basename(filepath).split('.')[:-1]))
+
+    decoder.decode(bitplane1, bitplane2, bitplane3) # allocates the buffers, as after the first image of a worker
+    entities, elapsed = timed(decoder.decode, bitplane1, bitplane2, bitplane3)
+    stages['decode'].append(elapsed)
+    reference, elapsed = timed(utils.decode_bitplanes_per_channel, bitplane1, bitplane2, bitplane3)
+    stages['decodeReference'].append(elapsed)
+    identical = identical and np.array_equal(entities, reference)
+
+    bounds, elapsed = timed(utils.get_entity_bounds, entities)
+    stages['labeling'].append(elapsed)
+    ids, elapsed = timed(np.unique, entities)
+    stages['labelingReference'].append(elapsed)
+    identical = identical and np.array_equal(bounds[0], ids[ids != 0])
+
+    contours, elapsed = timed(utils.find_entity_contours, entities, modifier)
+    stages['contours'].append(elapsed)
+    reference, elapsed = timed(utils.find_entity_contours_per_id, entities, modifier)
+    stages['contoursReference'].append(elapsed)
+    identical = identical and same_contours(contours, reference)
+
+    _, elapsed = timed(utils.annotate_file, filepath, 'center', False, 0.0, image.copy(), decoder)
+    stages['annotate'].append(elapsed)
+
+  return {
+    'identical': bool(identical),
+    'ms': { key: float(np.median(values) * 1000.0) for key, values in stages.items() },
+    'throughput': { str(workers): measure_throughput(annotate_screenshot, files, workers) for workers in argv.workers }
+  }
+
+def bench_layers(argv: argparse.Namespace, files: list[str]) -> dict:
+  stages = { key: [] for key in [ 'annotate', 'annotateReference' ] }
+  identical = True
+  for filepath in files:
+    (image, boxes), elapsed = timed(utils.annotate_layer_file, filepath, 'center')
+    stages['annotate'].append(elapsed)
+    (reference_image, reference_boxes), elapsed = timed(utils.annotate_layer_file_all_pages, filepath, 'center')
+    stages['annotateReference'].append(elapsed)
+    identical = identical and boxes == reference_boxes and np.array_equal(image, reference_image)
+
+  return {
+    'identical': bool(identical),
+    'ms': { key: float(np.median(values) * 1000.0) for key, values in stages.items() },
+    'throughput': { str(workers): measure_throughput(annotate_tif, files, workers) for workers in argv.workers }
+  }
+
+if __name__ == '__main__':
+  argv = get_argv()
+  workdir = argv.workdir if argv.workdir is not None else tempfile.mkdtemp(prefix='pam-bench-annotate-')
+  os.makedirs(workdir, exist_ok=True)
+
+  results = []
+  for resolution in argv.resolution:
+    width, height = [ int(v) for v in resolution.split('x') ]
+
+    for count, blob, modifiers in itertools.product(argv.entities, argv.blob, argv.modifiers):
+      suffix = '' if modifiers == '-' else f'.{modifiers}'
+      files = []
+      for idx in range(argv.images):
+        # the ID of the layered tifs is in the name too, "x" keeps the name from being a modifier
+        filepath = path.join(workdir, f'x{width}x{height}_{count}_{blob}_{argv.seed + idx}{suffix}.png')
+        if not path.exists(filepath):
+          generate_screenshot(filepath, width, height, count, blob, argv.seed + idx)
+        files.append(filepath)
+
+      print(f'[i] {resolution} entities={count} blob={blob} modifiers={modifiers}', file=sys.stderr)
+      result = bench_screenshots(argv, files)
+      print(f'[i] -> {result['ms']['annotate']:.1f} ms per image, contours {result['ms']['contours']:.1f} ms (reference {result['ms']['contoursReference']:.1f} ms), identical: {result['identical']}', file=sys.stderr)
+      results.append({ 'kind': 'screenshot', 'resolution': resolution, 'entities': count, 'blob': blob, 'modifiers': modifiers, 'result': result })
+
+    for layers, blob in itertools.product([ layers for layers in argv.layers if layers > 0 ], argv.blob):
+      files = []
+      for idx in range(argv.images):
+        filepath = path.join(workdir, f'x{width}x{height}_{layers}_{blob}_{argv.seed + idx}.i{idx + 1}.tif')
+        if not path.exists(filepath):
+          generate_layers(filepath, width, height, layers, blob, argv.seed + idx)
+        files.append(filepath)
+
+      print(f'[i] {resolution} layers={layers} blob={blob}', file=sys.stderr)
+      result = bench_layers(argv, files)
+      print(f'[i] -> {result['ms']['annotate']:.1f} ms per tif (reference {result['ms']['annotateReference']:.1f} ms), identical: {result['identical']}', file=sys.stderr)
+      results.append({ 'kind': 'layers', 'resolution': resolution, 'layers': layers, 'blob': blob, 'result': result })
+
+  report = json.dumps({ 'runs': results }, indent=2)
+  if argv.output is not None:
+    with open(argv.output, 'wt') as file:
+      file.write(report)
+  else:
+    print(report)
+
+  if not all([ run['result']['identical'] for run in results ]):
+    print('[e] some of the implementations disagree, see "identical" in the results', file=sys.stderr)
+    exit(1)
@@ -0,0 +1,165 @@
+import shutil
+import subprocess
+import cv2
+import numpy as np
+
+DECODERS = [ 'opencv', 'ffmpeg' ]
+
+def get_scaled_size(width: int, height: int, imgsz: int | None) -> tuple[int, int]:
+  '''
+  Returns the size of the frame with its longer side shrunk to `imgsz`, keeping the aspect ratio.
+  Frames which are already small enough are left as they are.
+  '''
+  if imgsz is None or max(width, height) <= imgsz:
+    return width, height
+  scale = imgsz / max(width, height)
+  return max(1, round(width * scale)), max(1, round(height * scale))
+
+class FFmpegCapture:
+  '''
+  Mimics the parts of `cv2.VideoCapture` the scripts use, but lets ffmpeg decode the video
+  and scale it down to `imgsz` (see `get_scaled_size`), then reads the raw BGR frames from
+  its pipe into a ring of `ring` preallocated frames. No frame is allocated while reading,
+  so a frame returned by `read()` is only valid until `ring - 1` more frames are read.
+
+  The whole frame is scaled, so the normalized coordinates are still relative to the original video.
+  Seeking restarts ffmpeg at the timestamp of the frame.
+  '''
+  def __init__(self, url: str, imgsz: int | None = None, ring: int = 4, executable: str = 'ffmpeg'):
+    self.url = url
+    self.executable = shutil.which(executable) or executable
+    self.process = None
+
+    # ffmpeg is only asked for the frames, the properties are taken from opencv
+    probe = cv2.VideoCapture(url)
+    self.opened = probe.isOpened()
+    self.source_size = (int(probe.get(cv2.CAP_PROP_FRAME_WIDTH)), int(probe.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    self.fps = probe.get(cv2.CAP_PROP_FPS)
+    self.frames = int(probe.get(cv2.CAP_PROP_FRAME_COUNT))
+    probe.release()
+
+    self.width, self.height = get_scaled_size(*self.source_size, imgsz)
+    self.ring = np.empty((max(1, ring), self.height, self.width, 3), np.uint8)
+    self.index = 0
+    self.position = 0
+
+  def start(self):
+    self.stop()
+    command = [ self.executable, '-hide_banner', '-loglevel', 'error', '-nostdin' ]
+    if self.position > 0:
+      # input seeking decodes from the previous keyframe and drops everything before the timestamp,
+      # half a frame earlier so that rounding doesn't drop the wanted frame too
+      command += [ '-ss', f'{(self.position - 0.5) / self.fps:.6f}' ]
+    command += [ '-i', self.url, '-an', '-sn', '-map', '0:v:0' ]
+    if (self.width, self.height) != self.source_size:
+      command += [ '-vf', f'scale={self.width}:{self.height}:flags=bilinear' ]
+    command += [ '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1' ]
+    self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=self.ring[0].nbytes)
+
+  def stop(self):
+    if self.process is not None:
+      self.process.kill()
+      self.process.stdout.close()
+      self.process.wait()
+      self.process = None
+
+  def isOpened(self) -> bool:
+    return self.opened
+
+  def read(self):
+    if not self.opened:
+      return False, None
+    if self.process is None:
+      self.start()
+
+    frame = self.ring[self.index]
+    view = memoryview(frame.reshape(-1))
+    filled = 0
+    while filled < len(view):
+      count = self.process.stdout.readinto(view[filled:])
+      if not count:
+        return False, None
+      filled += count
+
+    self.index = (self.index + 1) % len(self.ring)
+    self.position += 1
+    return True, frame
+
+  def get(self, prop: int) -> float:
+    if prop == cv2.CAP_PROP_POS_FRAMES:
+      return self.position
+    if prop == cv2.CAP_PROP_FRAME_COUNT:
+      return self.frames
+    if prop == cv2.CAP_PROP_FPS:
+      return self.fps
+    if prop == cv2.CAP_PROP_FRAME_WIDTH:
+      return self.width
+    if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+      return self.height
+    return 0.0
+
+  def set(self, prop: int, value: float) -> bool:
+    if prop != cv2.CAP_PROP_POS_FRAMES:
+      return False
+    self.stop()
+    self.position = max(0, int(value))
+    return True
+
+  def release(self):
+    self.stop()
+    self.opened = False
+
+  def __del__(self):
+    self.stop()
+
+class ScreenCapture:
+  '''
+  Grabs a monitor (or the `region` of it, as `(left, top, width, height)` relative to the monitor) with mss,
+  and converts the BGRA pixels into a contiguous BGR frame in one pass. With `imgsz`, the frame is shrunk
+  (see `get_scaled_size`) before the conversion, so only the small frame is ever converted.
+
+  `read(frame)` writes into the given frame if it has the right shape, so the caller can reuse its buffers.
+  `copied` is the number of bytes the last `read` wrote.
+  '''
+  def __init__(self, monitor: int, region: tuple[int, int, int, int] | None = None, imgsz: int | None = None):
+    import mss # only the screen capture needs it
+    self.mss = mss.mss()
+    bounds = self.mss.monitors[monitor]
+    if region is not None:
+      left, top, width, height = region
+      left, top = max(0, left), max(0, top)
+      width, height = min(width, bounds['width'] - left), min(height, bounds['height'] - top)
+      if width <= 0 or height <= 0:
+        raise Exception(f'The region {region} is outside of the monitor {monitor} ({bounds['width']}x{bounds['height']})')
+      bounds = { 'left': bounds['left'] + left, 'top': bounds['top'] + top, 'width': width, 'height': height }
+    self.bounds = bounds
+    self.width, self.height = get_scaled_size(bounds['width'], bounds['height'], imgsz)
+    self.scaled = np.empty((self.height, self.width, 4), np.uint8) if (self.width, self.height) != (bounds['width'], bounds['height']) else None
+    self.copied = 0
+
+  def isOpened(self) -> bool:
+    return True
+
+  def read(self, frame: np.ndarray | None = None):
+    # the screenshot exposes its buffer, so this is a view and not a copy
+    bgra = np.asarray(self.mss.grab(self.bounds))
+    self.copied = 0
+    if self.scaled is not None:
+      bgra = cv2.resize(bgra, (self.width, self.height), dst=self.scaled, interpolation=cv2.INTER_AREA)
+      self.copied += bgra.nbytes
+    if frame is None or frame.shape != (self.height, self.width, 3):
+      frame = np.empty((self.height, self.width, 3), np.uint8)
+    cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=frame)
+    self.copied += frame.nbytes
+    return True, frame
+
+  def release(self):
+    self.mss.close()
+
+def open_capture(url: str, decoder: str = 'opencv', imgsz: int | None = None, ring: int = 4):
+  '''
+  Opens the video with the given `decoder` (one of `DECODERS`), `imgsz` and `ring` only apply to ffmpeg.
+  '''
+  if decoder == 'ffmpeg':
+    return FFmpegCapture(url, imgsz, ring)
+  return cv2.VideoCapture(url)
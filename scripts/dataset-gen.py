@@ -2,16 +2,35 @@ import os
 import argparse
 from os import path
 from utils import annotate_file, get_entity_bidict, annotate_layer_file
+from shards import ShardWriter, labels_to_array, write_index
+from dedup import BKTree, difference_hash
+from labelindex import INDEX_NAME, LabelIndex, balanced_split, build_index, read_label_file
 import cv2 as cv
-from multiprocessing import Pool
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import contextlib
+import queue
+import threading
+import time
 import random
 import sys
-import shutil
+import json
+import hashlib
+import numpy as np
 
 RANDOM_TRAIN_RATIO=0.76
 RANDOM_VALID_RATIO=0.25
 RANDOM_TEST_RATIO=0.1 # ignored btw
 
+MANIFEST_NAME='manifest.json'
+DUPLICATES_NAME='duplicates.json'
+MANIFEST_VERSION=1
+
+# arguments which change what gets generated from a source, changing them regenerates everything
+OUTPUT_ARGS=['format', 'extension', 'area_threshold', 'debug', 'type', 'seed']
+
 def get_argv():
   parser = argparse.ArgumentParser()
   parser.add_argument(
@@ -31,9 +50,10 @@ def get_argv():
   )
   parser.add_argument(
     '-t', '--type',
-    help='should this be a train, validation or test dataset. or sort/random_sort, which will spread them around in 70:20:10 ratio. random will randomize the order!',
+    help='should this be a train, validation or test dataset. or sort/random_sort, which will spread them around in 70:20:10 ratio. random will randomize the order! '
+         'balanced spreads every class in that ratio, once the screenshots are annotated',
     default='random_sort',
-    choices=['train', 'valid', 'test', 'sort', 'random_sort']
+    choices=['train', 'valid', 'test', 'sort', 'random_sort', 'balanced']
   )
   parser.add_argument(
     '-f', '--format',
@@ -44,7 +64,13 @@ def get_argv():
   )
   parser.add_argument(
     '-n', '--ncpu',
-    help='how many threads to use for the conversion',
+    help='how many processes to use for the annotation',
+    type=int
+  )
+  parser.add_argument(
+    '-j', '--io-threads',
+    help='how many threads read and decode the screenshots, and how many encode and write the images',
+    default=4,
     type=int
   )
   parser.add_argument(
@@ -68,42 +94,441 @@ def get_argv():
     help='if type is set to random_sort, this seed is used to shuffle it around',
     default='seed deez nuts'
   )
-  return parser.parse_args()
+  parser.add_argument(
+    '-I', '--incremental',
+    help=f'update an existing output using its {MANIFEST_NAME}, only new and changed screenshots are generated and the outputs of removed ones are deleted',
+    action='store_true'
+  )
+  parser.add_argument(
+    '--shards',
+    help='instead of the folders of images and labels, pack the dataset into tar shards of about this many megabytes (export them back with shards.py)',
+    type=float,
+    default=None
+  )
 
-def create_from_image(filepath: str, _type: str, argv: argparse.Namespace):
+  parser.add_argument(
+    '--dedup',
+    help=f'skip screenshots whose RGB quadrant is at most this many bits (of 64) of perceptual hash away from an already kept one, they are listed in {DUPLICATES_NAME}',
+    type=int,
+    default=None
+  )
+
+  argv = parser.parse_args()
+  if argv.shards is not None and argv.incremental:
+    parser.error('--incremental is not supported with --shards')
+  if argv.shards is not None and argv.type == 'balanced':
+    parser.error('--type balanced is not supported with --shards')
+  return argv
+
+def get_external_annotations(filepath: str):
   name = '.'.join(path.basename(filepath).split('.')[:-1])
-  extname = filepath.split('.')[-1].lower()
-
-  # if external exists
-  external_annotations = path.join(path.dirname(filepath), f'{name}.txt')
-  if os.path.exists(external_annotations):
-    temp = cv.imread(filepath) # convert the image
-    cv.imwrite(path.join(argv.output, _type, 'images', f'external_{name}.{argv.extension}'), temp)
-    
-    found_entities = set()
-    shutil.copy(external_annotations, path.join(argv.output, _type, 'labels', f'external_{name}.txt'))
-    with open(external_annotations, 'rt') as tempFile:
-      for line in tempFile:
-        _id, _x, _y, _w, _h = line.rstrip().split()
-        found_entities.add(int(_id))
-    return filepath, found_entities
-
-  if extname == 'tif':
-    image, labels = annotate_layer_file(filepath, format=argv.format, debug_draw=argv.debug)
-  else:
-    image, labels = annotate_file(filepath, format=argv.format, debug_draw=argv.debug, area_threshold=argv.area_threshold)
-
-  basename = f'{len(labels)}x_{name}'
-  cv.imwrite(path.join(argv.output, _type, 'images', f'{basename}.{argv.extension}'), image)
-  with open(path.join(argv.output, _type, 'labels', f'{basename}.txt'), 'w') as hfile:
-    hfile.write('\n'.join([ ' '.join([ str(w) for w in v ]) for v in labels ]))
-
-  found_entities = set([ int(t[0]) for t in labels ])
-  return filepath, found_entities
-
-def create_from_image_tuple(data: tuple[str, str, argparse.Namespace]):
-  filepath, _type, argv = data
-  return create_from_image(filepath, _type, argv)
+  return path.join(path.dirname(filepath), f'{name}.txt')
+
+def get_source_stat(filepath: str):
+  '''
+  Returns the sizes and modification times of the screenshot and of its external annotations (if any),
+  if they match the manifest, the source is considered unchanged without hashing it.
+  '''
+  stat = []
+  for file in [ filepath, get_external_annotations(filepath) ]:
+    if path.exists(file):
+      info = os.stat(file)
+      stat += [ info.st_size, info.st_mtime_ns ]
+  return stat
+
+def hash_source(filepath: str, content: bytes | None = None):
+  if content is None:
+    with open(filepath, 'rb') as file:
+      content = file.read()
+  digest = hashlib.sha1(content)
+  external_annotations = get_external_annotations(filepath)
+  if path.exists(external_annotations):
+    with open(external_annotations, 'rb') as file:
+      digest.update(file.read())
+  return digest.hexdigest()
+
+def save_image(argv: argparse.Namespace, image_path: str, image: cv.typing.MatLike):
+  '''
+  Writes the image into the output, or with `--shards` returns it encoded, so that it can be added to a shard.
+  '''
+  if argv.shards is None:
+    cv.imwrite(path.join(argv.output, image_path), image)
+    return None
+  ok, encoded = cv.imencode(f'.{argv.extension}', image)
+  if not ok:
+    raise Exception(f'Could not encode {image_path}')
+  return encoded.tobytes()
+
+def write_label(path: str, labels: list[tuple], remapper: dict[int, int]):
+  with open(path, 'w') as hfile:
+    hfile.write('\n'.join([ ' '.join([ str(remapper[int(v[0])]), *[ str(w) for w in v[1:] ] ]) for v in labels ]))
+
+class StageCounter:
+  '''
+  Counts the items a stage of the pipeline finished and the time its `workers` spent on them.
+  The busiest stage (relative to its workers) is the one holding the others back.
+  '''
+  def __init__(self, name: str, workers: int):
+    self.name = name
+    self.workers = max(1, workers)
+    self.count = 0
+    self.busy = 0.0
+    self.lock = threading.Lock()
+
+  def add(self, seconds: float):
+    with self.lock:
+      self.count += 1
+      self.busy += seconds
+
+  @contextlib.contextmanager
+  def time(self):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(time.perf_counter() - start)
+
+  def report(self, elapsed: float):
+    return f'{self.name} {self.count / max(elapsed, 1e-9):.1f}/s {self.busy / max(elapsed * self.workers, 1e-9) * 100.0:.0f}%'
+
+class SharedSlots:
+  '''
+  A fixed number of shared memory blocks which carry the decoded screenshots to the annotating
+  processes and back, so the pixels are never pickled. A block is only replaced when an image doesn't fit.
+  '''
+  def __init__(self, count: int):
+    self.free = queue.Queue()
+    for _ in range(count):
+      self.free.put(None)
+
+  def acquire(self, nbytes: int) -> SharedMemory:
+    block = self.free.get()
+    if block is None or block.size < nbytes:
+      if block is not None:
+        block.close()
+        block.unlink()
+      block = SharedMemory(create=True, size=nbytes)
+    return block
+
+  def release(self, block: SharedMemory):
+    self.free.put(block)
+
+  def close(self):
+    while not self.free.empty():
+      block = self.free.get()
+      if block is not None:
+        block.close()
+        block.unlink()
+
+# set once per annotating process by `init_worker`, instead of pickling the arguments with every screenshot
+worker_argv: argparse.Namespace | None = None
+worker_blocks: collections.OrderedDict = collections.OrderedDict()
+
+def init_worker(argv: argparse.Namespace):
+  global worker_argv
+  worker_argv = argv
+
+def annotate_shared(filepath: str, block_name: str, shape: tuple[int, int, int]):
+  '''
+  Annotates the screenshot decoded in the shared memory block, returns its labels and how long it took.
+  The cropped image is left in the block (with the boxes drawn in it if debugging).
+  '''
+  block = worker_blocks.get(block_name)
+  if block is None:
+    block = worker_blocks[block_name] = SharedMemory(name=block_name)
+    # the blocks get replaced by bigger ones every now and then, don't hold onto the old ones
+    while len(worker_blocks) > 64:
+      worker_blocks.popitem(last=False)[1].close()
+
+  start = time.perf_counter()
+  image = np.ndarray(shape, np.uint8, buffer=block.buf)
+  _, labels = annotate_file(filepath, format=worker_argv.format, debug_draw=worker_argv.debug, area_threshold=worker_argv.area_threshold, image=image)
+  del image, _ # the block can't be closed while there are views of it
+  return labels, time.perf_counter() - start
+
+def annotate_layers(filepath: str):
+  start = time.perf_counter()
+  image, labels = annotate_layer_file(filepath, format=worker_argv.format, debug_draw=worker_argv.debug)
+  return image, labels, time.perf_counter() - start
+
+def generate(argv: argparse.Namespace, to_generate: list[tuple[str, str]]):
+  '''
+  Generates the images of the `(filepath, type)` sources in a pipeline of stages, at most a few sources per process are between them:
+
+  - `read`: threads read the files, hash them and decode the screenshots into shared memory
+  - `annotate`: the process pool finds the entities in them
+  - `write`: threads encode the cropped images and write them (or hand them over for the shards)
+
+  Yields `(filepath, found_entities, source_hash, image, label, labels, data)` as they are done, in any order,
+  the `image` and `label` are relative to the output. The `labels` (tuples of the raw entity ID and the coordinates)
+  are not written, see `write_label`. With `--shards`, `data` is the encoded image, which is not written either.
+  '''
+  ncpu = argv.ncpu or os.cpu_count() or 1
+  counters = {
+    'read': StageCounter('read', argv.io_threads),
+    'annotate': StageCounter('annotate', ncpu),
+    'write': StageCounter('write', argv.io_threads)
+  }
+  # bounds everything between reading a source and the main thread taking its result
+  in_flight = threading.Semaphore(ncpu * 2 + argv.io_threads)
+  stopped = threading.Event()
+  slots = SharedSlots(ncpu * 2 + argv.io_threads)
+  results = queue.Queue()
+  # the workers have to share the tracker of the shared memory, otherwise each would start its own and
+  # "clean up" the blocks it attached to when it exits
+  resource_tracker.ensure_running()
+  pool = Pool(processes=ncpu, initializer=init_worker, initargs=(argv,))
+  readers = ThreadPoolExecutor(argv.io_threads)
+  writers = ThreadPoolExecutor(argv.io_threads)
+
+  def write(filepath: str, _type: str, source_hash: str, image, labels: list[tuple], external: bool, block: SharedMemory | None = None):
+    try:
+      with counters['write'].time():
+        name = '.'.join(path.basename(filepath).split('.')[:-1])
+        basename = f'external_{name}' if external else f'{len(labels)}x_{name}'
+        image_path = path.join(_type, 'images', f'{basename}.{argv.extension}')
+        label_path = path.join(_type, 'labels', f'{basename}.txt')
+        data = save_image(argv, image_path, image)
+        del image
+      if block is not None:
+        slots.release(block)
+
+      found_entities = set([ int(t[0]) for t in labels ])
+      results.put((filepath, found_entities, source_hash, image_path, label_path, labels, data))
+    except Exception as err:
+      results.put(err)
+
+  def annotated(filepath: str, _type: str, source_hash: str, block: SharedMemory, shape: tuple[int, int, int], labels: list[tuple]):
+    height, width, _ = shape
+    rgb = np.ndarray(shape, np.uint8, buffer=block.buf)[0:height//2, 0:width//2] # TL, as in split_quadrants
+    writers.submit(write, filepath, _type, source_hash, rgb, labels, False, block)
+
+  def read(filepath: str, _type: str):
+    while not in_flight.acquire(timeout=0.1):
+      if stopped.is_set():
+        return
+    try:
+      started = time.perf_counter()
+      with open(filepath, 'rb') as file:
+        content = file.read()
+      source_hash = hash_source(filepath, content)
+
+      # if external exists
+      external_annotations = get_external_annotations(filepath)
+      if os.path.exists(external_annotations):
+        labels = []
+        with open(external_annotations, 'rt') as tempFile:
+          for line in tempFile:
+            _id, _x, _y, _w, _h = line.rstrip().split()
+            labels.append((int(_id), _x, _y, _w, _h))
+        image = cv.imdecode(np.frombuffer(content, np.uint8), cv.IMREAD_COLOR) # convert the image
+        counters['read'].add(time.perf_counter() - started)
+        writers.submit(write, filepath, _type, source_hash, image, labels, True)
+        return
+
+      if filepath.split('.')[-1].lower() == 'tif':
+        counters['read'].add(time.perf_counter() - started)
+        def on_layers_annotated(result: tuple):
+          image, labels, seconds = result
+          counters['annotate'].add(seconds)
+          writers.submit(write, filepath, _type, source_hash, image, labels, False)
+        pool.apply_async(annotate_layers, (filepath,), callback=on_layers_annotated, error_callback=results.put)
+        return
+
+      decoded = cv.imdecode(np.frombuffer(content, np.uint8), cv.IMREAD_COLOR)
+      if decoded is None:
+        raise Exception(f'Could not decode {filepath}')
+      counters['read'].add(time.perf_counter() - started)
+
+      block = slots.acquire(decoded.nbytes)
+      np.copyto(np.ndarray(decoded.shape, np.uint8, buffer=block.buf), decoded)
+      shape = decoded.shape
+      del decoded
+
+      def on_annotated(result: tuple):
+        labels, seconds = result
+        counters['annotate'].add(seconds)
+        annotated(filepath, _type, source_hash, block, shape, labels)
+      pool.apply_async(annotate_shared, (filepath, block.name, shape), callback=on_annotated, error_callback=results.put)
+    except Exception as err:
+      results.put(err)
+
+  start_time = time.time()
+  try:
+    for filepath, _type in to_generate:
+      readers.submit(read, filepath, _type)
+
+    for counter in range(len(to_generate)):
+      result = results.get()
+      in_flight.release()
+      if isinstance(result, BaseException):
+        raise result
+      yield result
+
+      if counter + 1 == len(to_generate) or (counter + 1) % 100 == 0:
+        elapsed = time.time() - start_time
+        sys.stdout.write(f'\r[i] {' | '.join([ stage.report(elapsed) for stage in counters.values() ])}   ')
+  finally:
+    stopped.set()
+    readers.shutdown(cancel_futures=True)
+    pool.terminate()
+    writers.shutdown(cancel_futures=True)
+    slots.close()
+    print()
+
+def load_manifest(output: str):
+  manifest_path = path.join(output, MANIFEST_NAME)
+  if not path.exists(manifest_path):
+    return None
+  with open(manifest_path, 'rt') as file:
+    manifest = json.load(file)
+  if manifest.get('version') != MANIFEST_VERSION:
+    raise Exception(f'Unsupported manifest version {manifest.get('version')} in "{manifest_path}"')
+  return manifest
+
+def save_manifest(output: str, manifest: dict):
+  '''
+  Replaces the manifest atomically, so an interrupted run leaves the previous one in place.
+  '''
+  manifest_path = path.join(output, MANIFEST_NAME)
+  with open(f'{manifest_path}.tmp', 'wt') as file:
+    json.dump(manifest, file)
+  os.replace(f'{manifest_path}.tmp', manifest_path)
+
+def remove_outputs(output: str, entry: dict):
+  for key in [ 'image', 'label' ]:
+    if path.exists(path.join(output, entry[key])):
+      os.remove(path.join(output, entry[key]))
+
+def get_changes(argv: argparse.Namespace, files: list[tuple[str, str]], manifest: dict, params: dict):
+  '''
+  Compares the screenshots with the manifest, returns `(unchanged, to_generate, removed)`, where
+  `unchanged` are the kept manifest entries by the source, `to_generate` the `(filepath, type)`
+  to generate and `removed` the manifest entries whose outputs are not valid anymore.
+
+  A source is unchanged if its size and modification time match, or if its content hash does.
+  Regenerated sources keep the split they had.
+  '''
+  previous = manifest['files']
+  unchanged: dict[str, dict] = {}
+  to_generate: list[tuple[str, str]] = []
+  removed: list[dict] = []
+
+  for filepath, _type in files:
+    key = path.relpath(filepath, argv.input)
+    entry = previous.get(key)
+    if entry is not None and entry['params'] == params:
+      stat = get_source_stat(filepath)
+      if entry['stat'] == stat or entry['hash'] == hash_source(filepath):
+        entry['stat'] = stat
+        unchanged[key] = entry
+        continue
+      _type = entry['type']
+
+    if entry is not None:
+      removed.append(entry)
+    to_generate.append((filepath, _type))
+
+  generated = set([ path.relpath(filepath, argv.input) for filepath, _ in to_generate ])
+  for key, entry in previous.items():
+    if key not in unchanged and key not in generated:
+      removed.append(entry)
+
+  return unchanged, to_generate, removed
+
+def get_perceptual_hash(filepath: str) -> int:
+  '''
+  Returns the difference hash of what would end up in the dataset: the RGB quadrant of a screenshot,
+  or the whole image of the ones with external annotations and of the layered tifs.
+  '''
+  gray = cv.imread(filepath, cv.IMREAD_REDUCED_GRAYSCALE_4) # the hash only looks at 9x8 pixels anyway
+  if gray is None:
+    raise Exception(f'Could not read {filepath}')
+  if filepath.split('.')[-1].lower() != 'tif' and not path.exists(get_external_annotations(filepath)):
+    height, width = gray.shape
+    gray = gray[0:height//2, 0:width//2] # TL, as in split_quadrants
+  return difference_hash(gray)
+
+def deduplicate(argv: argparse.Namespace, unchanged: dict[str, dict], to_generate: list[tuple[str, str]]):
+  '''
+  Drops the near-duplicate sources, both the kept manifest entries and the ones to generate. The sources
+  are visited in the order of their paths, and each is dropped if a visited one within `--dedup` bits
+  was kept, so the outcome doesn't depend on the order of the folders or on what was generated before.
+
+  Returns `(unchanged, to_generate, dropped, hashes)`, `dropped` are the `(key, kept key, distance)`
+  and `hashes` the perceptual hashes by the source, to be kept in the manifest.
+  '''
+  hashes: dict[str, int] = { key: int(entry['phash'], 16) for key, entry in unchanged.items() if 'phash' in entry }
+  missing = [ (key, path.join(argv.input, key)) for key in unchanged if key not in hashes ]
+  missing += [ (path.relpath(filepath, argv.input), filepath) for filepath, _ in to_generate ]
+  with ThreadPoolExecutor(argv.io_threads) as executor:
+    for (key, _), value in zip(missing, executor.map(get_perceptual_hash, [ filepath for _, filepath in missing ])):
+      hashes[key] = value
+
+  tree = BKTree()
+  kept: set[str] = set()
+  dropped: list[tuple[str, str, int]] = []
+  for key in sorted(hashes):
+    matches = tree.find(hashes[key], argv.dedup)
+    if len(matches) != 0:
+      distance, original = matches[0]
+      dropped.append((key, original, distance))
+      continue
+    tree.add(hashes[key], key)
+    kept.add(key)
+
+  unchanged = { key: entry for key, entry in unchanged.items() if key in kept }
+  for key, entry in unchanged.items():
+    entry['phash'] = f'{hashes[key]:016x}'
+  to_generate = [ (filepath, _type) for filepath, _type in to_generate if path.relpath(filepath, argv.input) in kept ]
+  return unchanged, to_generate, dropped, hashes
+
+def rebalance(argv: argparse.Namespace, previous: dict[str, dict], unchanged: dict[str, dict], generated: dict[str, dict], labels: dict[str, list[tuple]]):
+  '''
+  Moves the generated images into the splits chosen by `balanced_split`, the sources which already were
+  in the dataset keep their split. The labels aren't written yet, only their paths change.
+  '''
+  entries = { **unchanged, **generated }
+  # like the other types, the test split is left empty (see `RANDOM_TEST_RATIO`)
+  total = RANDOM_TRAIN_RATIO + RANDOM_VALID_RATIO
+  ratios = { 'train': RANDOM_TRAIN_RATIO / total, 'valid': RANDOM_VALID_RATIO / total }
+  splits = balanced_split(
+    { key: set(entry['entities']) for key, entry in entries.items() },
+    ratios, argv.seed,
+    { key: previous[key]['type'] for key in entries if key in previous }
+  )
+  for split in ratios:
+    if split not in splits.values():
+      print(f'\n[w] the {split} split is empty, there are too few images to balance')
+
+  for key, entry in generated.items():
+    split = splits[key]
+    if split == entry['type']:
+      continue
+    image_path = path.join(split, *path.normpath(entry['image']).split(os.sep)[1:])
+    label_path = path.join(split, *path.normpath(entry['label']).split(os.sep)[1:])
+    os.replace(path.join(argv.output, entry['image']), path.join(argv.output, image_path))
+    labels[label_path] = labels.pop(entry['label'])
+    entry.update(type=split, image=image_path, label=label_path)
+
+def write_label_index(argv: argparse.Namespace, names: dict[int, str], entries: dict[str, dict], labels: dict[str, list[tuple]], remapper: dict[int, int]):
+  '''
+  Writes the `labels.npz` of all the `entries`. The labels of the ones which weren't generated now
+  are taken from the previous index, or read from their label files if it's missing.
+  '''
+  previous = LabelIndex.load(argv.output) if path.exists(path.join(argv.output, INDEX_NAME)) else None
+  previous_images = { image: i for i, image in enumerate(previous.images) } if previous is not None else {}
+
+  samples = []
+  for entry in sorted(entries.values(), key=lambda entry: entry['image']):
+    if entry['label'] in labels:
+      found_labels = [ (remapper[int(v[0])], *v[1:]) for v in labels[entry['label']] ]
+    elif entry['image'] in previous_images:
+      found_labels = [ (v['class'], v['x'], v['y'], v['w'], v['h']) for v in previous.of_image(previous_images[entry['image']]) ]
+    else:
+      found_labels = read_label_file(path.join(argv.output, entry['label']))
+    samples.append((entry['image'], entry['type'], found_labels))
+  build_index(names, samples, argv.format).save(argv.output)
 
 def get_dataset_images(root: str, _type: str, seed: str):
   """
@@ -131,6 +556,11 @@ def get_dataset_images(root: str, _type: str, seed: str):
       randomizer.shuffle(f_files)
 
     for i in range(n_files):
+      if _type == 'balanced':
+        # only known once annotated, see `rebalance`
+        bucket.append((path.join(rootdir, f_files[i]), 'train'))
+        continue
+
       ratio = (i+1) / n_files
       if ratio <= RANDOM_TRAIN_RATIO:
         given_type = 'train'
@@ -142,101 +572,133 @@ def get_dataset_images(root: str, _type: str, seed: str):
       bucket.append((path.join(rootdir, f_files[i]), given_type))
   return bucket
 
-def get_label_files(root: str):
-  bucket = []
-  for rootdir, subdir, files in os.walk(root):
-    segments = rootdir.split(os.sep)
-
-    if segments[-1] != 'labels':
-      continue
-
-    for file in files:
-      if file.endswith('.txt'):
-        bucket.append(path.join(rootdir, file))
-  return bucket
-
-def remap_label(path: str, remapper: dict[int, int]):
-  buckets = []
-  with open(path, 'rt') as file:
-    for line in file:
-      segments = line.split(' ')
-      segments[0] = str(remapper[int(segments[0])])
-      buckets.append(' '.join(segments))
-  with open(path, 'wt') as file:
-    file.write(''.join(buckets))
-
-  return len(buckets)
-
-def remap_label_tuple(data: tuple[str, dict[int, int]]):
-  path, remapper = data
-  return remap_label(path, remapper)
-
 if __name__ == '__main__':
   argv = get_argv()
   entity_bidict, entity_json = get_entity_bidict(argv.entities)
+  params = { key: getattr(argv, key) for key in OUTPUT_ARGS }
 
   # list of files
   files: list[tuple[str, str]] = [ file for file in get_dataset_images(argv.input, argv.type, argv.seed) ]
-  n_files = len(files)
 
   # print(*files, sep='\n')
   # exit(1)
 
-  # ensure that output dir structure exists
-  os.makedirs(argv.output, exist_ok=False)
+  manifest = load_manifest(argv.output) if argv.incremental and path.exists(argv.output) else None
+  if manifest is None:
+    # ensure that output dir structure exists
+    os.makedirs(argv.output, exist_ok=False)
+    manifest = { 'version': MANIFEST_VERSION, 'mapping': {}, 'files': {} }
+  writers: dict[str, ShardWriter] = {}
   for folder in ['train', 'valid', 'test']:
+    if argv.shards is not None:
+      writers[folder] = ShardWriter(argv.output, folder, int(argv.shards * 1024 * 1024))
+      continue
     os.makedirs(path.join(argv.output, folder, 'images'), exist_ok=True)
     os.makedirs(path.join(argv.output, folder, 'labels'), exist_ok=True)
 
+  unchanged, to_generate, removed = get_changes(argv, files, manifest, params)
+  hashes: dict[str, int] = {}
+  if argv.dedup is not None:
+    previous = unchanged
+    unchanged, to_generate, dropped, hashes = deduplicate(argv, unchanged, to_generate)
+    removed += [ entry for key, entry in previous.items() if key not in unchanged ]
+    with open(path.join(argv.output, DUPLICATES_NAME), 'wt') as file:
+      json.dump([ { 'source': key, 'duplicateOf': original, 'distance': distance } for key, original, distance in dropped ], file, indent=2)
+    print(f'[i] dropped {len(dropped)} near-duplicates (see {DUPLICATES_NAME})')
+  print(f'[i] {len(unchanged)} unchanged, {len(to_generate)} to generate, {len(removed)} outdated')
+  for entry in removed:
+    remove_outputs(argv.output, entry)
+
   # lets get the show on the f-cking road
+  n_files = len(to_generate)
   counter = 0
-  pool = Pool(processes=argv.ncpu)
+  generated: dict[str, dict] = {}
+  labels: dict[str, list[tuple]] = {}
   unique_entities = set()
-  for name, found_entities in pool.imap_unordered( create_from_image_tuple, [ (_file, _type, argv) for _file, _type in files ]):
+  for name, found_entities, source_hash, image_path, label_path, found_labels, data in generate(argv, to_generate):
     counter += 1
     for ent in found_entities:
       unique_entities.add(ent)
+    key = path.relpath(name, argv.input)
+    generated[key] = {
+      'hash': source_hash,
+      'stat': get_source_stat(name),
+      'params': params,
+      'type': path.normpath(image_path).split(os.sep)[0],
+      'image': image_path,
+      'label': label_path,
+      'entities': sorted(found_entities)
+    }
+    if key in hashes:
+      generated[key]['phash'] = f'{hashes[key]:016x}'
+    if argv.shards is not None:
+      # the shards keep the raw entity IDs, the mapping to the classes is in their index
+      _type = path.normpath(image_path).split(os.sep)[0]
+      writers[_type].add(path.basename(image_path), data, labels_to_array(found_labels))
+    labels[label_path] = found_labels
 
     if counter == n_files or counter % 100 == 0:
       sys.stdout.write(f'\r[i] finished ({counter}/{n_files}) {name}')
 
-  print('\n[i] dataset creation is done, performing remapping IDs')
-
-  # create conversion remapping
-  remapper = dict()
-  for src, dst in zip(unique_entities, range(len(unique_entities))):
-    remapper[src] = dst
-
-  # remap the existing labels
-  label_files = get_label_files(argv.output)
-  n_files = len(label_files)
-  counter = 0
-  for cnt in pool.imap_unordered( remap_label_tuple, [ (path, remapper) for path in label_files ] ):
-    counter += 1
-    if counter == n_files or counter % 100 == 0:
-      sys.stdout.write(f'\r[i] remapped {cnt} ({counter}/{n_files})')
-
-  # write the intro yaml (if not existing)
+  print('\n[i] dataset creation is done, writing the labels')
+
+  # create conversion remapping, the classes of the previous runs keep their IDs so their labels stay valid
+  remapper: dict[int, int] = { int(src): dst for src, dst in manifest['mapping'].items() }
+  for src in sorted(unique_entities):
+    if src not in remapper:
+      remapper[src] = len(remapper)
+
+  class_names: dict[int, str] = {}
+  for idx, dst in sorted(remapper.items(), key=lambda item: item[1]):
+    if idx in entity_bidict:
+      class_names[dst] = entity_bidict[idx]
+    else:
+      class_names[dst] = 'UNKNOWN_ENTITY_CALL_THE_SCP'
+      print(f'\n[w] !!WARNING!! FOUND AN UNIDENTIFIED ENTITY !! (remapper={dst}, idx={idx})')
+
+  if argv.type == 'balanced':
+    rebalance(argv, manifest['files'], unchanged, generated, labels)
+  write_label_index(argv, class_names, { **unchanged, **generated }, labels, remapper)
+
+  if argv.shards is not None:
+    write_index(argv.output, class_names, remapper, { split: writer.close() for split, writer in writers.items() })
+    print('\n[i] finito 🤌')
+    exit(0)
+
+  # the labels are only written now, with their final class IDs
+  n_files = len(labels)
+  label_items = list(labels.items())
+  with ThreadPoolExecutor(argv.io_threads) as executor:
+    written = executor.map(
+      write_label,
+      [ path.join(argv.output, label_path) for label_path, _ in label_items ],
+      [ found_labels for _, found_labels in label_items ],
+      [ remapper ] * n_files
+    )
+    for counter, ((_, found_labels), _) in enumerate(zip(label_items, written), 1):
+      if counter == n_files or counter % 100 == 0:
+        sys.stdout.write(f'\r[i] written {len(found_labels)} ({counter}/{n_files})')
+
+  manifest['mapping'] = { str(src): dst for src, dst in remapper.items() }
+  manifest['files'] = { **unchanged, **generated }
+  save_manifest(argv.output, manifest)
+
+  # write the intro yaml, from the manifest so that it covers the previous runs as well
   data_path = path.join(argv.output, 'data.yaml')
-  if not path.exists(data_path) or True: # doesnt hurt much, right?
-    with open(data_path, 'w') as file:
-      names = ', '.join([ f'\'{ent}\'' for ent in entity_json ])
-      file.write('\n'.join([
-        f'train: train/images',
-        f'val: valid/images',
-        f'test: test/images',
-        f'',
-        f'names:',
-        f''
-        # f'nc: {len(entity_json)}',
-        # f'names: [{names}]'
-      ]))
-
-      for idx in unique_entities:
-        if idx in entity_bidict:
-          file.write(f'    {remapper[idx]}: {entity_bidict[idx]}\n')
-        else:
-          file.write(f'    {remapper[idx]}: UNKNOWN_ENTITY_CALL_THE_SCP\n')
-          print(f'\n[w] !!WARNING!! FOUND AN UNIDENTIFIED ENTITY !! (remapper={remapper[idx]}, idx={idx})')
+  with open(data_path, 'w') as file:
+    names = ', '.join([ f'\'{ent}\'' for ent in entity_json ])
+    file.write('\n'.join([
+      f'train: train/images',
+      f'val: valid/images',
+      f'test: test/images',
+      f'',
+      f'names:',
+      f''
+      # f'nc: {len(entity_json)}',
+      # f'names: [{names}]'
+    ]))
+
+    for dst, name in class_names.items():
+      file.write(f'    {dst}: {name}\n')
   
   print('\n[i] finito 🤌')
\ No newline at end of file
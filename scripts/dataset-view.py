@@ -1,44 +1,350 @@
 import os
 from os import path
 import sys
+import threading
+import collections
+import hashlib
+import json
+import time
 import yaml
+from labelindex import INDEX_NAME, LabelIndex
+from shards import INDEX_NAME as SHARDS_INDEX_NAME, ShardReader, ShardedDataset
 
 from PyQt6 import QtCore, QtGui, QtWidgets, uic
 from PyQt6.QtCore import Qt
 
-def read_dataset(dataset_path: str):
-  data_yaml = None
-  with open(path.join(dataset_path, 'data.yaml')) as file:
-    data_yaml = yaml.safe_load(file)
+# how many images before and after the selected one are rendered ahead
+PREFETCH_AROUND = 8
+# how much memory the rendered images may take
+CACHE_BYTES = 256 * 1024 * 1024
 
-  bucket = []
-  for (dirpath, dirnames, filenames) in os.walk(path.join(dataset_path)):
-    for filename in filenames:
-      if filename.endswith('.png') or filename.endswith('.jpeg') or filename.endswith('.jpg'):
-        bucket.append(path.join(dirpath, filename))
+IMAGE_EXTENSIONS = ('.png', '.jpeg', '.jpg')
+LISTING_VERSION = 1
+# the listings of the folder datasets, so that opening one again doesn't have to scan it
+LISTING_CACHE = path.join(os.environ.get('XDG_CACHE_HOME', path.join(path.expanduser('~'), '.cache')), 'peek-a-mob', 'dataset-view')
 
-  return data_yaml['names'], sorted(bucket)
+def get_listing_path(root: str):
+  return path.join(LISTING_CACHE, f'{hashlib.sha1(path.abspath(root).encode()).hexdigest()}.json')
+
+def load_listing(root: str) -> list[str] | None:
+  '''
+  Returns the cached images of the dataset, if none of its folders changed since (adding, removing or
+  renaming anything changes the modification time of its folder, so only the folders are checked).
+  '''
+  try:
+    with open(get_listing_path(root), 'rt') as file:
+      listing = json.load(file)
+    if listing.get('version') != LISTING_VERSION or listing.get('root') != path.abspath(root):
+      return None
+    for folder, mtime in listing['folders'].items():
+      if os.stat(path.join(root, folder)).st_mtime_ns != mtime:
+        return None
+    return listing['images']
+  except (OSError, ValueError, KeyError):
+    return None
+
+def save_listing(root: str, folders: dict[str, int], images: list[str]):
+  listing_path = get_listing_path(root)
+  try:
+    os.makedirs(LISTING_CACHE, exist_ok=True)
+    with open(f'{listing_path}.tmp', 'wt') as file:
+      json.dump({ 'version': LISTING_VERSION, 'root': path.abspath(root), 'folders': folders, 'images': images }, file)
+    os.replace(f'{listing_path}.tmp', listing_path)
+  except OSError as err:
+    print(f'[w] could not cache the listing of {root}: {err}', file=sys.stderr)
+
+class FolderSource:
+  '''
+  A dataset in the YOLO folder layout, the images are by their path relative to the `root`.
+  '''
+  def __init__(self, root: str):
+    self.root = root
+    with open(path.join(root, 'data.yaml')) as file:
+      self.names: dict[int, str] = yaml.safe_load(file)['names']
+
+  def scan(self, emit):
+    '''
+    Calls `emit` with the next images as they are found, in the order of their paths.
+    '''
+    images = load_listing(self.root)
+    if images is not None:
+      emit(images)
+      return
+
+    images = []
+    folders: dict[str, int] = {}
+    batch = []
+    last_emit = time.monotonic()
+    def walk(folder: str):
+      nonlocal batch, last_emit
+      # the time is taken before listing, so a change during the scan invalidates the listing
+      folders[folder] = os.stat(path.join(self.root, folder)).st_mtime_ns
+      with os.scandir(path.join(self.root, folder)) as iterator:
+        entries = sorted(iterator, key=lambda entry: entry.name)
+      for entry in entries:
+        relpath = entry.name if folder == '' else f'{folder}/{entry.name}'
+        if entry.is_dir():
+          walk(relpath)
+        elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+          batch.append(relpath)
+      if len(batch) != 0 and (len(batch) >= 4096 or time.monotonic() - last_emit > 0.1):
+        images.extend(batch)
+        emit(batch)
+        batch = []
+        last_emit = time.monotonic()
+
+    walk('')
+    if len(batch) != 0:
+      images.extend(batch)
+      emit(batch)
+    save_listing(self.root, folders, images)
+
+  def load(self, image: str) -> tuple[QtGui.QImage, list[tuple]]:
+    labels = []
+    label_path = get_label_path(path.join(self.root, image))
+    if path.exists(label_path):
+      with open(label_path, 'rt') as file:
+        for line in file.readlines():
+          labels.append(tuple([ float(f) for f in line.split() ]))
+    return QtGui.QImage(path.join(self.root, image)), labels
+
+class ShardSource:
+  '''
+  A dataset written by `dataset-gen.py --shards`, the images are named `<split>/images/<name>` as if they were exported.
+  '''
+  def __init__(self, root: str):
+    self.root = root
+    self.dataset = ShardedDataset(root)
+    self.names = self.dataset.names
+    # filled by the indexer's thread while the prefetcher's thread reads it
+    self.samples: dict[str, tuple[str, int]] = {}
+    self.samples_lock = threading.Lock()
+    self.readers: dict[str, ShardReader] = {}
+
+  def scan(self, emit):
+    for split, shards in self.dataset.splits.items():
+      for shard in shards:
+        with ShardReader(path.join(self.root, shard['file'])) as reader:
+          batch = [ f'{split}/images/{name}' for name in reader.names ]
+        with self.samples_lock:
+          for i, image in enumerate(batch):
+            self.samples[image] = (shard['file'], i)
+        emit(batch)
+
+  def load(self, image: str) -> tuple[QtGui.QImage, list[tuple]]:
+    # only called from the prefetcher's thread, so the readers aren't shared
+    with self.samples_lock:
+      shard, i = self.samples[image]
+    if shard not in self.readers:
+      self.readers[shard] = ShardReader(path.join(self.root, shard))
+    _, data, labels = self.readers[shard].read(i)
+    labels = [ (int(self.dataset.classes[v['class']]), float(v['x']), float(v['y']), float(v['w']), float(v['h'])) for v in labels ]
+    return QtGui.QImage.fromData(data), labels
+
+def open_source(root: str):
+  if path.exists(path.join(root, SHARDS_INDEX_NAME)):
+    return ShardSource(root)
+  return FolderSource(root)
+
+class Indexer(QtCore.QObject):
+  '''
+  Scans the source on a background thread, the images found are delivered to the UI thread through `found`.
+  '''
+  found = QtCore.pyqtSignal(list)
+  finished = QtCore.pyqtSignal()
+
+  def __init__(self, source):
+    super().__init__()
+    self.source = source
+    self.thread = threading.Thread(target=self.run, daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def run(self):
+    try:
+      self.source.scan(self.found.emit)
+    finally:
+      self.finished.emit()
+
+def get_label_path(image_path: str):
+  folder, filename = path.split(image_path)
+  return path.join(path.dirname(folder), 'labels', f'{path.splitext(filename)[0]}.txt')
+
+def render_annotated(canvas_ctx: QtGui.QImage, labels: list[tuple], names: dict, width: int, height: int) -> QtGui.QImage:
+  '''
+  Draws the `(class, cx, cy, w, h)` labels over the image and scales it to fit `width` and `height`.
+  Only touches a `QImage`, so it can run outside of the UI thread.
+  '''
+  if canvas_ctx.isNull():
+    return canvas_ctx
+  # the indexed and grayscale images can't be painted on in colour
+  canvas_ctx = canvas_ctx.convertToFormat(QtGui.QImage.Format.Format_RGB32)
+
+  painter = QtGui.QPainter(canvas_ctx)
+  pen = QtGui.QPen(QtGui.QColor(0xFF0000), 3.0)
+  pen2 = QtGui.QPen(QtGui.QColor(0x000000), 5.0)
+  pen3 = QtGui.QPen(QtGui.QColor(0xFFFFFF), 1.0)
+  brush = QtGui.QBrush(QtGui.QColor(128, 0, 0, 128))
+
+  counter = 0
+  for id, cx, cy, w, h in labels:
+    w = int(w * canvas_ctx.width())
+    h = int(h * canvas_ctx.height())
+    x = int((cx * canvas_ctx.width()) - w // 2)
+    y = int((cy * canvas_ctx.height()) - h // 2)
+
+    name = names.get(int(id), 'UNKNOWN')
+    painter.setPen(pen2)
+    painter.drawRect(x, y, w, h)
+    painter.setPen(pen)
+    painter.drawRect(x, y, w, h)
+    painter.setPen(pen3)
+    painter.drawRect(x, y, w, h)
+
+    painter.fillRect(x, y, w, h, brush)
+
+    painter.setPen(pen)
+    painter.setFont(QtGui.QFont("monospace", 8))
+    painter.drawText(x + 2, y + 12, f'[{counter}] {name}')
+    painter.drawText(16, 24 + 16 * counter, f'[{counter}] {name}')
+
+    counter += 1
+  painter.end()
+
+  return canvas_ctx.scaled(
+    max(1, width), max(1, height),
+    QtCore.Qt.AspectRatioMode.KeepAspectRatio,
+    QtCore.Qt.TransformationMode.SmoothTransformation
+  )
+
+class ImageListModel(QtCore.QAbstractListModel):
+  '''
+  The images of the dataset, or only its `rows` if they're set. Nothing is created per image,
+  the view only asks for the visible rows. The images are appended as they are found.
+  '''
+  def __init__(self):
+    super().__init__()
+    self.images: list[str] = []
+    self.rows: list[int] | None = None
+
+  def rowCount(self, parent=QtCore.QModelIndex()):
+    if parent.isValid():
+      return 0
+    return len(self.images) if self.rows is None else len(self.rows)
+
+  def data(self, index: QtCore.QModelIndex, role=Qt.ItemDataRole.DisplayRole):
+    if not index.isValid():
+      return None
+    if role == Qt.ItemDataRole.DisplayRole:
+      return '/'.join(self.image(index.row()).split('/')[-3:])
+    return None
+
+  def image(self, row: int) -> str:
+    return self.images[row if self.rows is None else self.rows[row]]
+
+  def append(self, images: list[str]):
+    if self.rows is not None:
+      self.images.extend(images)
+      return
+    self.beginInsertRows(QtCore.QModelIndex(), len(self.images), len(self.images) + len(images) - 1)
+    self.images.extend(images)
+    self.endInsertRows()
+
+  def set_rows(self, rows: list[int] | None):
+    self.beginResetModel()
+    self.rows = rows
+    self.endResetModel()
+
+class PixmapCache:
+  '''
+  The least recently used rendered images are dropped once they take more than `capacity` bytes.
+  '''
+  def __init__(self, capacity: int):
+    self.capacity = capacity
+    self.size = 0
+    self.pixmaps: collections.OrderedDict[tuple, QtGui.QPixmap] = collections.OrderedDict()
+
+  def get(self, key: tuple) -> QtGui.QPixmap | None:
+    pixmap = self.pixmaps.get(key)
+    if pixmap is not None:
+      self.pixmaps.move_to_end(key)
+    return pixmap
+
+  def put(self, key: tuple, pixmap: QtGui.QPixmap):
+    if key in self.pixmaps:
+      self.size -= self.nbytes(self.pixmaps.pop(key))
+    self.pixmaps[key] = pixmap
+    self.size += self.nbytes(pixmap)
+    while self.size > self.capacity and len(self.pixmaps) > 1:
+      _, dropped = self.pixmaps.popitem(last=False)
+      self.size -= self.nbytes(dropped)
+
+  def clear(self):
+    self.pixmaps.clear()
+    self.size = 0
+
+  @staticmethod
+  def nbytes(pixmap: QtGui.QPixmap):
+    return pixmap.width() * pixmap.height() * 4
+
+class Prefetcher(QtCore.QObject):
+  '''
+  Renders the requested images on a background thread and hands them back through `rendered`,
+  which is delivered on the UI thread. A new request replaces whatever wasn't rendered yet.
+  '''
+  rendered = QtCore.pyqtSignal(str, int, int, QtGui.QImage)
+
+  def __init__(self, render):
+    super().__init__()
+    self.render = render
+    self.pending: list[tuple[str, int, int]] = []
+    self.condition = threading.Condition()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def request(self, items: list[tuple[str, int, int]]):
+    with self.condition:
+      self.pending = list(items)
+      self.condition.notify()
+
+  def run(self):
+    while True:
+      with self.condition:
+        while len(self.pending) == 0:
+          self.condition.wait()
+        image_path, width, height = self.pending.pop(0)
+      # a broken image is left out, rather than stopping the rendering of the others
+      try:
+        image = self.render(image_path, width, height)
+      except Exception as err:
+        print(f'[w] could not render {image_path}: {err}', file=sys.stderr)
+        continue
+      self.rendered.emit(image_path, width, height, image)
 
 class ImageViewer(QtWidgets.QLabel):
+  resized = QtCore.pyqtSignal()
+
   def __init__(self, *args, **kwargs):
     QtWidgets.QLabel.__init__(self)
-    self.original_pixmap = None
+    self.shown_pixmap = None
     self.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
 
-  def setOrigPixmap(self, pixmap: QtGui.QPixmap):
-    self.original_pixmap = pixmap
-    self.repaint()
+  def setShownPixmap(self, pixmap: QtGui.QPixmap):
+    '''
+    Shows the pixmap as it is, it's already scaled to the size of the viewer.
+    '''
+    self.shown_pixmap = pixmap
+    self.setPixmap(pixmap)
 
-  def repaint(self):
-    if (self.original_pixmap is not None):
-      self.setPixmap(self.original_pixmap.scaled(
+  def resizeEvent(self, event):
+    # a quick preview until the image is rendered at the new size
+    if self.shown_pixmap is not None:
+      self.setPixmap(self.shown_pixmap.scaled(
         self.width(), self.height(),
         QtCore.Qt.AspectRatioMode.KeepAspectRatio)
       )
-
-  def resizeEvent(self, event):
-    # print(self.width(), self.height())
-    self.repaint()
+    self.resized.emit()
 
 class MainWindow(QtWidgets.QMainWindow):
   def __init__(self):
@@ -47,7 +353,16 @@ class MainWindow(QtWidgets.QMainWindow):
     if len(sys.argv) != 2: raise 'shinda'
     self.path = sys.argv[-1]
 
-    self.data = read_dataset(self.path)
+    self.source = open_source(self.path)
+    # written by dataset-gen.py (or labelindex.py), without it there's nothing to filter by
+    self.index = LabelIndex.load(self.path) if path.exists(path.join(self.path, INDEX_NAME)) else None
+    self.index_images = { str(image): i for i, image in enumerate(self.index.images) } if self.index is not None else {}
+    self.rows: dict[str, int] = {}
+
+    self.cache = PixmapCache(CACHE_BYTES)
+    self.current = None
+    self.prefetcher = Prefetcher(self.render)
+    self.prefetcher.rendered.connect(self.on_rendered)
 
     self.layout = QtWidgets.QHBoxLayout()
     self.widget = QtWidgets.QWidget()
@@ -57,17 +372,30 @@ class MainWindow(QtWidgets.QMainWindow):
     self.splitter = QtWidgets.QSplitter(self.widget)
     self.layout.addWidget(self.splitter)
 
-    self.list_widget = QtWidgets.QListWidget()
-    self.list_widget.setFont(QtGui.QFont('monospace'))
-    for image in self.data[1]:
-      item = QtWidgets.QListWidgetItem(
-        '/'.join(image.split('/')[-3:]),
-        parent=self.list_widget
-      )
-      item.data = image
-      self.list_widget.addItem(item)
-    self.list_widget.currentItemChanged.connect(self.change_canvas)
-    self.splitter.addWidget(self.list_widget)
+    self.sidebar = QtWidgets.QWidget()
+    self.sidebar_layout = QtWidgets.QVBoxLayout()
+    self.sidebar_layout.setContentsMargins(0, 0, 0, 0)
+    self.sidebar.setLayout(self.sidebar_layout)
+
+    self.class_filter = QtWidgets.QComboBox()
+    self.class_filter.addItem('all classes', None)
+    if self.index is not None:
+      for class_id, name in sorted(self.index.names.items()):
+        count = len(self.index.images_with(class_id))
+        if count != 0:
+          self.class_filter.addItem(f'{name} ({count})', class_id)
+    self.class_filter.setEnabled(False) # until all of the images are found
+    self.class_filter.currentIndexChanged.connect(self.change_filter)
+    self.sidebar_layout.addWidget(self.class_filter)
+
+    self.model = ImageListModel()
+    self.list_view = QtWidgets.QListView()
+    self.list_view.setFont(QtGui.QFont('monospace'))
+    self.list_view.setUniformItemSizes(True)
+    self.list_view.setModel(self.model)
+    self.list_view.selectionModel().currentChanged.connect(self.change_canvas)
+    self.sidebar_layout.addWidget(self.list_view)
+    self.splitter.addWidget(self.sidebar)
 
     self.canvas = ImageViewer()
     # self.canvas.setScaledContents(True)
@@ -77,49 +405,92 @@ class MainWindow(QtWidgets.QMainWindow):
     self.canvas.setPixmap(self.canvas_ctx)
     self.splitter.addWidget(self.canvas)
 
-  def change_canvas(self, i: QtWidgets.QListWidgetItem):
-    image_path = i.data
-    label_path = image_path.split(os.sep)
-    label_path[-2] = 'labels'
-    label_path[-1] = '.'.join(label_path[-1].split('.')[:-1]) + '.txt'
-    label_path = '/'.join(label_path)
-
-    self.canvas_ctx = QtGui.QPixmap(image_path)
-    painter = QtGui.QPainter(self.canvas_ctx)
-    pen = QtGui.QPen(QtGui.QColor(0xFF0000), 3.0)
-    pen2 = QtGui.QPen(QtGui.QColor(0x000000), 5.0)
-    pen3 = QtGui.QPen(QtGui.QColor(0xFFFFFF), 1.0)
-    brush = QtGui.QBrush(QtGui.QColor(128, 0, 0, 128))
-
-    counter = 0
-    with open(label_path, 'rt') as file:
-      for line in file.readlines():
-        id, cx, cy, w, h = [ float(f) for f in line.split() ]
-
-        w = int(w * self.canvas_ctx.width())
-        h = int(h * self.canvas_ctx.height())
-        x = int((cx * self.canvas_ctx.width()) - w // 2)
-        y = int((cy * self.canvas_ctx.height()) - h // 2)
-
-        name = self.data[0][int(id)]
-        painter.setPen(pen2)
-        painter.drawRect(x, y, w, h)
-        painter.setPen(pen)
-        painter.drawRect(x, y, w, h)
-        painter.setPen(pen3)
-        painter.drawRect(x, y, w, h)
-
-        painter.fillRect(x, y, w, h, brush)
-
-        painter.setPen(pen)
-        painter.setFont(QtGui.QFont("monospace", 8))
-        painter.drawText(x + 2, y + 12, f'[{counter}] {name}')
-        painter.drawText(16, 24 + 16 * counter, f'[{counter}] {name}')
-
-        counter += 1
-    painter.end()
-    self.canvas.setOrigPixmap(self.canvas_ctx)
-    # self.canvas.setPixmap(self.canvas_ctx)
+    # the images are rendered again for the new size once the resizing stops
+    self.resize_timer = QtCore.QTimer(self)
+    self.resize_timer.setSingleShot(True)
+    self.resize_timer.setInterval(150)
+    self.resize_timer.timeout.connect(self.on_resized)
+    self.canvas.resized.connect(self.resize_timer.start)
+
+    self.indexer = Indexer(self.source)
+    self.indexer.found.connect(self.on_found)
+    self.indexer.finished.connect(self.on_indexed)
+    self.started = time.monotonic()
+    self.statusBar().showMessage('scanning...')
+    self.indexer.start()
+
+  def on_found(self, images: list[str]):
+    for image in images:
+      self.rows[image] = len(self.rows)
+    self.model.append(images)
+    self.statusBar().showMessage(f'scanning... {len(self.rows)} images')
+    if not self.list_view.currentIndex().isValid() and self.model.rowCount() != 0:
+      self.list_view.setCurrentIndex(self.model.index(0))
+
+  def on_indexed(self):
+    self.statusBar().showMessage(f'{len(self.rows)} images, found in {time.monotonic() - self.started:.2f} s')
+    self.class_filter.setEnabled(self.index is not None)
+
+  def render(self, image: str, width: int, height: int) -> QtGui.QImage:
+    # runs on the prefetcher's thread
+    canvas_ctx, labels = self.source.load(image)
+    indexed = self.index_images.get(image)
+    if indexed is not None:
+      labels = [ (int(v['class']), float(v['x']), float(v['y']), float(v['w']), float(v['h'])) for v in self.index.of_image(indexed) ]
+    return render_annotated(canvas_ctx, labels, self.source.names, width, height)
+
+  def canvas_size(self):
+    return max(1, self.canvas.width()), max(1, self.canvas.height())
+
+  def prefetch(self, row: int):
+    '''
+    Requests the selected image and the ones around it which aren't rendered yet, the closest first.
+    '''
+    width, height = self.canvas_size()
+    rows = [ row ]
+    for offset in range(1, PREFETCH_AROUND + 1):
+      rows += [ row + offset, row - offset ]
+
+    items = []
+    for neighbour in rows:
+      if 0 <= neighbour < self.model.rowCount():
+        image_path = self.model.image(neighbour)
+        if self.cache.get((image_path, width, height)) is None:
+          items.append((image_path, width, height))
+    self.prefetcher.request(items)
+
+  def on_rendered(self, image_path: str, width: int, height: int, image: QtGui.QImage):
+    if (width, height) != self.canvas_size():
+      return
+    pixmap = QtGui.QPixmap.fromImage(image)
+    self.cache.put((image_path, width, height), pixmap)
+    if image_path == self.current:
+      self.canvas.setShownPixmap(pixmap)
+
+  def on_resized(self):
+    self.cache.clear()
+    if self.current is not None and self.list_view.currentIndex().isValid():
+      self.prefetch(self.list_view.currentIndex().row())
+
+  def change_filter(self):
+    class_id = self.class_filter.currentData()
+    if class_id is None:
+      self.model.set_rows(None)
+    else:
+      images = [ str(self.index.images[i]) for i in self.index.images_with(class_id) ]
+      self.model.set_rows(sorted([ self.rows[image] for image in images if image in self.rows ]))
+    if self.model.rowCount() != 0:
+      self.list_view.setCurrentIndex(self.model.index(0))
+
+  def change_canvas(self, current: QtCore.QModelIndex, previous: QtCore.QModelIndex = None):
+    if not current.isValid():
+      return
+    self.current = self.model.image(current.row())
+
+    pixmap = self.cache.get((self.current, *self.canvas_size()))
+    if pixmap is not None:
+      self.canvas.setShownPixmap(pixmap)
+    self.prefetch(current.row())
 
 app = QtWidgets.QApplication(sys.argv)
 window = MainWindow()
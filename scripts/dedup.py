@@ -0,0 +1,61 @@
+import cv2 as cv
+import numpy as np
+
+HASH_SIZE = 8
+
+def difference_hash(gray: np.ndarray) -> int:
+  '''
+  Returns the 64-bit difference hash of a grayscale image: it is shrunk to 9x8 and every bit says
+  whether a pixel is brighter than its right neighbour. Recompression, small shifts of brightness
+  and scaling barely change it, so similar images are a few bits apart.
+  '''
+  small = cv.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv.INTER_AREA)
+  bits = small[:, 1:] > small[:, :-1]
+  return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming(a: int, b: int) -> int:
+  return (a ^ b).bit_count()
+
+class BKTree:
+  '''
+  Burkhard-Keller tree of the hashes, finds every hash within a Hamming distance without comparing
+  against all of them. The children of a node are by their distance to it, so by the triangle
+  inequality only the children in `distance ± threshold` can have a match.
+  '''
+  def __init__(self):
+    self.root: list | None = None # [hash, key, {distance: child}]
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def add(self, value: int, key):
+    self.size += 1
+    if self.root is None:
+      self.root = [ value, key, {} ]
+      return
+
+    node = self.root
+    while True:
+      distance = hamming(value, node[0])
+      child = node[2].get(distance)
+      if child is None:
+        node[2][distance] = [ value, key, {} ]
+        return
+      node = child
+
+  def find(self, value: int, threshold: int) -> list[tuple[int, object]]:
+    '''
+    Returns the `(distance, key)` of every hash at most `threshold` bits away, closest first.
+    '''
+    found = []
+    stack = [ self.root ] if self.root is not None else []
+    while len(stack) != 0:
+      node = stack.pop()
+      distance = hamming(value, node[0])
+      if distance <= threshold:
+        found.append((distance, node[1]))
+      for child_distance, child in node[2].items():
+        if distance - threshold <= child_distance <= distance + threshold:
+          stack.append(child)
+    return sorted(found)
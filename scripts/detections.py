@@ -0,0 +1,488 @@
+import argparse
+import json
+import os
+import shutil
+import struct
+import numpy as np
+
+# first line of the binary format, followed by the `#$` metadata line and the chunks
+BINARY_MAGIC = b'#PAMD 1\n'
+CHUNK_HEADER = struct.Struct('<4sI')
+CHUNK_RECORDS = b'DETS'
+CHUNK_COMMENT = b'JSON'
+
+# first line of the tracks format, followed by the `#$` metadata line and one JSON track per line
+TRACKS_MAGIC = '#PAMT 1\n'
+
+# tracks which keep the same box this long still get a keyframe every once in a while
+MAX_KEYFRAME_DISTANCE = 600
+
+# one detection, `class` is the model's class ID, `(x, y)` is the top-left corner
+RECORD_DTYPE = np.dtype([
+  ('frame', '<u4'),
+  ('class', '<u2'),
+  ('confidence', '<f4'),
+  ('x', '<f4'),
+  ('y', '<f4'),
+  ('w', '<f4'),
+  ('h', '<f4')
+])
+
+def boxes_to_arrays(boxes):
+  '''
+  Converts the ultralytics `Boxes` of a single frame in one go into a tuple of numpy arrays:
+
+  `(classes, confidences, xywh)`
+
+  `xywh` is normalized, with `(x, y)` being the top-left corner of the bounding box.
+  '''
+  classes = boxes.cls.cpu().numpy().astype(np.uint16)
+  confidences = boxes.conf.cpu().numpy()
+  xywh = boxes.xywhn.cpu().numpy().astype(np.float64)
+  xywh[:, :2] -= xywh[:, 2:] / 2.0
+  return classes, confidences, xywh
+
+class CsvWriter:
+  '''
+  Writes the detections as the `time;class;confidence;x;y;w;h` CSV.
+
+  If `offset` is given, the existing file is cut at that offset and appended to, without the header.
+  '''
+  def __init__(self, path: str, metadata: dict, offset: int | None = None, state: dict | None = None):
+    self.frames = metadata['frames']
+    self.duration = metadata['video']['duration']
+    self.names = { int(k): v for k, v in metadata['names'].items() }
+
+    # the bytes handed to the file so far, as `tell()` on a text file flushes it
+    self.written = offset or 0
+    if offset is not None:
+      os.truncate(path, offset)
+      self.file = open(path, 'ab')
+    else:
+      self.file = open(path, 'wb')
+      self.put(f'#$ {json.dumps(metadata)}\n')
+      self.put(f'time;class;confidence;x;y;w;h\n')
+
+  def put(self, text: str):
+    data = text.encode()
+    self.file.write(data)
+    self.written += len(data)
+
+  def write(self, frame_pos: int, classes: np.ndarray, confidences: np.ndarray, xywh: np.ndarray):
+    if len(classes) == 0:
+      return
+    time = (frame_pos / self.frames) * self.duration
+    self.put(''.join([
+      f'{time};{self.names[cls]};{confidence};{x};{y};{w};{h}\n'
+      for cls, confidence, (x, y, w, h) in zip(classes.tolist(), confidences.tolist(), xywh.tolist())
+    ]))
+
+  def comment(self, data: dict):
+    self.put(f'#~ {json.dumps(data)}\n')
+
+  def flush(self) -> int:
+    '''
+    Returns the offset up to which the file is written.
+    '''
+    self.file.flush()
+    return self.written
+
+  def size(self) -> int:
+    '''
+    Returns how many bytes the file has, including the ones not flushed yet.
+    '''
+    return self.written
+
+  def state(self) -> dict | None:
+    '''
+    What has to be saved along with the flushed offset to continue writing later, nothing for the CSV.
+    '''
+    return None
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+class BinaryWriter:
+  '''
+  Writes the detections as fixed-width `RECORD_DTYPE` records into chunks,
+  the `#$` metadata line has the `names` of the class IDs.
+
+  If `offset` is given, the existing file is cut at that offset and appended to, without the header.
+  '''
+  def __init__(self, path: str, metadata: dict, offset: int | None = None, state: dict | None = None, chunk_size: int = 4096):
+    self.chunk_size = chunk_size
+    self.buffer = np.empty(chunk_size, RECORD_DTYPE)
+    self.count = 0
+
+    # the bytes handed to the file so far, without the records still in the buffer
+    self.written = offset or 0
+    if offset is not None:
+      os.truncate(path, offset)
+      self.file = open(path, 'ab')
+    else:
+      self.file = open(path, 'wb')
+      self.put(BINARY_MAGIC)
+      self.put(f'#$ {json.dumps(metadata)}\n'.encode())
+
+  def put(self, data: bytes):
+    self.file.write(data)
+    self.written += len(data)
+
+  def write(self, frame_pos: int, classes: np.ndarray, confidences: np.ndarray, xywh: np.ndarray):
+    n = len(classes)
+    if n == 0:
+      return
+    if self.count + n > self.chunk_size:
+      self.write_chunk()
+    if n > self.chunk_size:
+      self.buffer = np.empty(n, RECORD_DTYPE)
+      self.chunk_size = n
+
+    records = self.buffer[self.count:self.count + n]
+    records['frame'] = frame_pos
+    records['class'] = classes
+    records['confidence'] = confidences
+    records['x'] = xywh[:, 0]
+    records['y'] = xywh[:, 1]
+    records['w'] = xywh[:, 2]
+    records['h'] = xywh[:, 3]
+    self.count += n
+
+  def write_chunk(self):
+    if self.count == 0:
+      return
+    payload = self.buffer[:self.count].tobytes()
+    self.put(CHUNK_HEADER.pack(CHUNK_RECORDS, len(payload)))
+    self.put(payload)
+    self.count = 0
+
+  def comment(self, data: dict):
+    self.write_chunk()
+    payload = json.dumps(data).encode()
+    self.put(CHUNK_HEADER.pack(CHUNK_COMMENT, len(payload)))
+    self.put(payload)
+
+  def flush(self) -> int:
+    '''
+    Returns the offset up to which the file is written.
+    '''
+    self.write_chunk()
+    self.file.flush()
+    return self.written
+
+  def size(self) -> int:
+    '''
+    Returns how many bytes the file has, including the buffered records.
+    '''
+    if self.count == 0:
+      return self.written
+    return self.written + CHUNK_HEADER.size + self.count * RECORD_DTYPE.itemsize
+
+  def state(self) -> dict | None:
+    return None
+
+  def close(self):
+    self.flush()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+  '''
+  IoU matrix between the `(n, 4)` and `(m, 4)` arrays of top-left `xywh` boxes.
+  '''
+  ax1, ay1 = a[:, 0, None], a[:, 1, None]
+  ax2, ay2 = ax1 + a[:, 2, None], ay1 + a[:, 3, None]
+  bx1, by1 = b[None, :, 0], b[None, :, 1]
+  bx2, by2 = bx1 + b[None, :, 2], by1 + b[None, :, 3]
+
+  intersection = np.clip(np.minimum(ax2, bx2) - np.maximum(ax1, bx1), 0, None) * np.clip(np.minimum(ay2, by2) - np.maximum(ay1, by1), 0, None)
+  union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - intersection
+  return intersection / np.maximum(union, 1e-12)
+
+class TrackWriter:
+  '''
+  Links the boxes of the same class across consecutive frames by their IoU into tracks,
+  and writes every finished track as a JSON line:
+
+  `{ "class", "start", "end", "spans", "keyframes", "confidence": { "min", "max", "mean" } }`
+
+  `spans` are the inclusive `[start, end]` frame ranges where the track was seen, `keyframes` are
+  `[frame, x, y, w, h]` boxes, and the boxes in between are within `track_tolerance` of the linear
+  interpolation between them. The tracking options are taken from `metadata['argv']`.
+
+  Flushing doesn't finish the tracks, the ones still going are only written once they end (or on `close`).
+  To continue later, `state()` has to be saved along with the flushed offset and given back as `state`.
+  '''
+  def __init__(self, path: str, metadata: dict, offset: int | None = None, state: dict | None = None):
+    self.frames = metadata['frames']
+    self.duration = metadata['video']['duration']
+    self.iou = metadata['argv'].get('track_iou', 0.3)
+    self.gap = metadata['argv'].get('track_gap', 5)
+    self.tolerance = metadata['argv'].get('track_tolerance', 0.005)
+    self.active: list[dict] = state['active'] if state is not None else []
+
+    # the bytes handed to the file so far, as `tell()` on a text file flushes it
+    self.written = offset or 0
+    if offset is not None:
+      os.truncate(path, offset)
+      self.file = open(path, 'ab')
+    else:
+      self.file = open(path, 'wb')
+      self.put(TRACKS_MAGIC)
+      self.put(f'#$ {json.dumps(metadata)}\n')
+
+  def put(self, text: str):
+    data = text.encode()
+    self.file.write(data)
+    self.written += len(data)
+
+  def write(self, frame_pos: int, classes: np.ndarray, confidences: np.ndarray, xywh: np.ndarray):
+    # tracks which weren't seen for too long are done
+    for track in [ track for track in self.active if frame_pos - track['last'] > self.gap ]:
+      self.finish(track)
+
+    n = len(classes)
+    if n == 0:
+      return
+
+    matched = [ False ] * n
+    if len(self.active) != 0:
+      ious = box_iou(np.array([ track['box'] for track in self.active ]), xywh)
+      ious[np.array([ track['class'] for track in self.active ])[:, None] != classes[None, :]] = 0.0
+
+      # greedily pair the best overlapping tracks and boxes first
+      taken = set()
+      for t, b in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+        if ious[t, b] < self.iou:
+          break
+        if t in taken or matched[b]:
+          continue
+        taken.add(t)
+        matched[b] = True
+        self.extend(self.active[t], frame_pos, float(confidences[b]), xywh[b].tolist())
+
+    for b in range(n):
+      if not matched[b]:
+        self.active.append({
+          'class': int(classes[b]),
+          'last': frame_pos,
+          'box': xywh[b].tolist(),
+          'spans': [[frame_pos, frame_pos]],
+          'keyframes': [[frame_pos, *xywh[b].tolist()]],
+          'pending': [],
+          # min, max, sum and count, as the whole history would bloat the checkpoints
+          'confidence': [float(confidences[b]), float(confidences[b]), float(confidences[b]), 1]
+        })
+
+  def extend(self, track: dict, frame_pos: int, confidence: float, box: list[float]):
+    if track['spans'][-1][1] == frame_pos - 1:
+      track['spans'][-1][1] = frame_pos
+    else:
+      track['spans'].append([frame_pos, frame_pos])
+    track['last'] = frame_pos
+    track['box'] = box
+    low, high, total, count = track['confidence']
+    track['confidence'] = [min(low, confidence), max(high, confidence), total + confidence, count + 1]
+
+    # the boxes since the last keyframe have to stay close to the line between it and the newest box,
+    # otherwise the box before the newest one becomes a keyframe
+    pending = track['pending']
+    pending.append([frame_pos, *box])
+    if len(pending) > 1:
+      keyframe = np.array(track['keyframes'][-1])
+      newest = np.array(pending[-1])
+      between = np.array(pending[:-1])
+      t = (between[:, 0] - keyframe[0]) / (newest[0] - keyframe[0])
+      expected = keyframe[1:] + t[:, None] * (newest[1:] - keyframe[1:])
+      if np.abs(between[:, 1:] - expected).max() > self.tolerance or len(pending) > MAX_KEYFRAME_DISTANCE:
+        track['keyframes'].append(pending[-2])
+        track['pending'] = [pending[-1]]
+
+  def finish(self, track: dict):
+    self.active.remove(track)
+    if len(track['pending']) != 0:
+      track['keyframes'].append(track['pending'][-1])
+
+    low, high, total, count = track['confidence']
+    self.put(json.dumps({
+      'class': track['class'],
+      'start': (track['spans'][0][0] / self.frames) * self.duration,
+      'end': (track['last'] / self.frames) * self.duration,
+      'spans': track['spans'],
+      'keyframes': [ [ keyframe[0], *[ round(v, 6) for v in keyframe[1:] ] ] for keyframe in track['keyframes'] ],
+      'confidence': {
+        'min': low,
+        'max': high,
+        'mean': total / count
+      }
+    }) + '\n')
+
+  def comment(self, data: dict):
+    self.put(f'#~ {json.dumps(data)}\n')
+
+  def flush(self) -> int:
+    '''
+    Returns the offset up to which the file is written, the active tracks aren't in it yet.
+    '''
+    self.file.flush()
+    return self.written
+
+  def size(self) -> int:
+    '''
+    Returns how many bytes the file has, including the ones not flushed yet but not the active tracks.
+    '''
+    return self.written
+
+  def state(self) -> dict | None:
+    return { 'active': self.active }
+
+  def close(self):
+    for track in list(self.active):
+      self.finish(track)
+    self.flush()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def concatenate(sources: list[str], destination: str):
+  '''
+  Joins the outputs of consecutive frame ranges into one, keeping only the header of the first one.
+  All the formats start with exactly two header lines, the rest is copied as is.
+  '''
+  with open(destination, 'wb') as dst:
+    for idx, src in enumerate(sources):
+      with open(src, 'rb') as file:
+        if idx != 0:
+          file.readline()
+          file.readline()
+        shutil.copyfileobj(file, dst)
+
+WRITERS = {
+  'csv': CsvWriter,
+  'binary': BinaryWriter,
+  'tracks': TrackWriter
+}
+
+def read_binary(path: str) -> tuple[dict, np.ndarray, list[dict]]:
+  '''
+  Reads the whole binary file, returns the metadata, all the records and the comments.
+  '''
+  with open(path, 'rb') as file:
+    if file.readline() != BINARY_MAGIC:
+      raise Exception(f'"{path}" is not a binary detection file')
+
+    line = file.readline()
+    if not line.startswith(b'#$'):
+      raise Exception(f'"{path}" has no metadata header!')
+    metadata = json.loads(line[2:])
+
+    chunks = []
+    comments = []
+    while len(header := file.read(CHUNK_HEADER.size)) == CHUNK_HEADER.size:
+      tag, length = CHUNK_HEADER.unpack(header)
+      payload = file.read(length)
+      if len(payload) != length:
+        break # cut off while writing, the rest is garbage anyway
+      if tag == CHUNK_RECORDS:
+        chunks.append(np.frombuffer(payload, RECORD_DTYPE))
+      elif tag == CHUNK_COMMENT:
+        comments.append(json.loads(payload))
+
+  records = np.concatenate(chunks) if len(chunks) != 0 else np.empty(0, RECORD_DTYPE)
+  return metadata, records, comments
+
+def read_tracks(path: str) -> tuple[dict, list[dict], list[dict]]:
+  '''
+  Reads the whole tracks file, returns the metadata, all the tracks and the comments.
+  '''
+  with open(path, 'rt') as file:
+    if file.readline() != TRACKS_MAGIC:
+      raise Exception(f'"{path}" is not a tracks file')
+
+    line = file.readline()
+    if not line.startswith('#$'):
+      raise Exception(f'"{path}" has no metadata header!')
+    metadata = json.loads(line[2:])
+
+    tracks = []
+    comments = []
+    for line in file:
+      if line.startswith('#~'):
+        comments.append(json.loads(line[2:]))
+      elif line.strip() != '':
+        tracks.append(json.loads(line))
+  return metadata, tracks, comments
+
+def expand_track(track: dict) -> np.ndarray:
+  '''
+  Expands the track back into `RECORD_DTYPE` records, one for every frame it was seen in,
+  with the boxes interpolated between the keyframes and the mean confidence.
+  '''
+  frames = np.concatenate([ np.arange(start, end + 1) for start, end in track['spans'] ])
+  keyframes = np.array(track['keyframes'], dtype=np.float64)
+
+  records = np.empty(len(frames), RECORD_DTYPE)
+  records['frame'] = frames
+  records['class'] = track['class']
+  records['confidence'] = track['confidence']['mean']
+  for idx, key in enumerate([ 'x', 'y', 'w', 'h' ]):
+    records[key] = np.interp(frames, keyframes[:, 0], keyframes[:, idx + 1])
+  return records
+
+def records_to_csv(metadata: dict, records: np.ndarray, comments: list[dict], dst: str):
+  with CsvWriter(dst, metadata) as writer:
+    if len(records) == 0:
+      return
+    # records are in frame order, so each frame is a contiguous run
+    frames, starts = np.unique(records['frame'], return_index=True)
+    ends = np.append(starts[1:], len(records))
+    for frame_pos, start, end in zip(frames.tolist(), starts.tolist(), ends.tolist()):
+      chunk = records[start:end]
+      writer.write(
+        frame_pos,
+        chunk['class'],
+        chunk['confidence'],
+        np.stack([ chunk['x'], chunk['y'], chunk['w'], chunk['h'] ], axis=1)
+      )
+    for comment in comments:
+      writer.comment(comment)
+
+def to_csv(src: str, dst: str):
+  '''
+  Derives the CSV from a binary or tracks file. The values of the binary file are the same up
+  to the float32 precision, the tracks are expanded back to a row for every frame they were seen in.
+  '''
+  with open(src, 'rb') as file:
+    magic = file.readline()
+
+  if magic == BINARY_MAGIC:
+    records_to_csv(*read_binary(src), dst)
+  elif magic == TRACKS_MAGIC.encode():
+    metadata, tracks, comments = read_tracks(src)
+    records = np.concatenate([ expand_track(track) for track in tracks ]) if len(tracks) != 0 else np.empty(0, RECORD_DTYPE)
+    records_to_csv(metadata, records[np.argsort(records['frame'], kind='stable')], comments, dst)
+  else:
+    raise Exception(f'"{src}" is neither a binary nor a tracks file')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='converts the binary or tracks output of analyze-youtube.py into the CSV')
+  parser.add_argument('input', help='binary or tracks file')
+  parser.add_argument('-o', '--output', help='where to write the CSV', required=True)
+  argv = parser.parse_args()
+
+  to_csv(argv.input, argv.output)
@@ -0,0 +1,225 @@
+import argparse
+import os
+import random
+import sys
+from os import path
+import numpy as np
+import yaml
+
+INDEX_NAME = 'labels.npz'
+INDEX_VERSION = 1
+
+SPLITS = [ 'train', 'valid', 'test' ]
+
+# one bounding box of one image, `class` is the class ID of the data.yaml
+LABEL_DTYPE = np.dtype([
+  ('image', '<u4'),
+  ('class', '<u2'),
+  ('x', '<f4'),
+  ('y', '<f4'),
+  ('w', '<f4'),
+  ('h', '<f4')
+])
+
+class LabelIndex:
+  '''
+  Every label of a dataset in one array, read from its `labels.npz` in milliseconds instead of opening
+  every label file. The labels are sorted by their class, `labels[class_offsets[c]:class_offsets[c + 1]]`
+  are the ones of the class `c`. `by_image[image_offsets[i]:image_offsets[i + 1]]` are the indices of
+  the labels of the image `i`, whose path (relative to the dataset) is `images[i]` and split `SPLITS[splits[i]]`.
+  '''
+  def __init__(self, names: dict[int, str], images: list[str], splits: np.ndarray, labels: np.ndarray, format: str = 'center'):
+    self.names = names
+    self.images = np.asarray(images, dtype=str)
+    self.splits = np.asarray(splits, dtype=np.uint8)
+    self.format = format
+
+    self.labels = labels[np.lexsort((labels['image'], labels['class']))]
+    self.class_offsets = np.searchsorted(self.labels['class'], np.arange(max(names.keys(), default=-1) + 2))
+    self.by_image = np.argsort(self.labels['image'], kind='stable').astype(np.uint32)
+    self.image_offsets = np.searchsorted(self.labels['image'][self.by_image], np.arange(len(self.images) + 1))
+
+  @staticmethod
+  def load(root: str):
+    with np.load(path.join(root, INDEX_NAME)) as data:
+      if int(data['version']) != INDEX_VERSION:
+        raise Exception(f'Unsupported label index version {int(data['version'])} in "{root}"')
+      index = LabelIndex.__new__(LabelIndex)
+      index.names = { i: str(name) for i, name in enumerate(data['names']) }
+      index.format = str(data['format'])
+      for key in [ 'images', 'splits', 'labels', 'class_offsets', 'by_image', 'image_offsets' ]:
+        setattr(index, key, data[key])
+    return index
+
+  def save(self, root: str):
+    '''
+    Replaces the `labels.npz` of the dataset atomically.
+    '''
+    names = [ self.names.get(i, '') for i in range(max(self.names.keys(), default=-1) + 1) ]
+    with open(path.join(root, f'{INDEX_NAME}.tmp'), 'wb') as file:
+      np.savez(
+        file,
+        version=INDEX_VERSION, format=self.format, names=np.asarray(names, dtype=str),
+        images=self.images, splits=self.splits, labels=self.labels,
+        class_offsets=self.class_offsets, by_image=self.by_image, image_offsets=self.image_offsets
+      )
+    os.replace(path.join(root, f'{INDEX_NAME}.tmp'), path.join(root, INDEX_NAME))
+
+  def __len__(self):
+    return len(self.images)
+
+  def of_class(self, class_id: int) -> np.ndarray:
+    if class_id + 1 >= len(self.class_offsets):
+      return self.labels[0:0]
+    return self.labels[self.class_offsets[class_id]:self.class_offsets[class_id + 1]]
+
+  def of_image(self, image: int) -> np.ndarray:
+    return self.labels[self.by_image[self.image_offsets[image]:self.image_offsets[image + 1]]]
+
+  def images_with(self, class_id: int) -> np.ndarray:
+    '''
+    Returns the sorted indices of the images with at least one `class_id` in them.
+    '''
+    return np.unique(self.of_class(class_id)['image'])
+
+  def stats(self) -> list[dict]:
+    '''
+    Returns the number of boxes and images of every class, and the quartiles of the sizes of its boxes.
+    '''
+    result = []
+    for class_id, name in sorted(self.names.items()):
+      labels = self.of_class(class_id)
+      quartiles = lambda values: [ float(v) for v in np.percentile(values, [ 25, 50, 75 ]) ] if len(values) != 0 else None
+      result.append({
+        'class': class_id,
+        'name': name,
+        'boxes': len(labels),
+        'images': len(np.unique(labels['image'])),
+        'splits': { split: int(np.count_nonzero(self.splits[labels['image']] == i)) for i, split in enumerate(SPLITS) },
+        'width': quartiles(labels['w']),
+        'height': quartiles(labels['h'])
+      })
+    return result
+
+def build_index(names: dict[int, str], samples: list[tuple[str, str, list[tuple]]], format: str = 'center') -> LabelIndex:
+  '''
+  Builds the index from the `(image path, split, labels)` of every image, the labels are `(class, x, y, w, h)`.
+  The images should be sorted by their path, as `dataset-gen.py` and `scan_dataset` do.
+  '''
+  images = []
+  splits = []
+  counts = []
+  rows = []
+  for image, split, labels in samples:
+    images.append(image)
+    splits.append(SPLITS.index(split))
+    counts.append(len(labels))
+    rows += [ (int(class_id), float(x), float(y), float(w), float(h)) for class_id, x, y, w, h in labels ]
+
+  labels = np.zeros(len(rows), LABEL_DTYPE)
+  if len(rows) != 0:
+    columns = np.array(rows, np.float64)
+    labels['image'] = np.repeat(np.arange(len(images)), counts)
+    labels['class'] = columns[:, 0]
+    for i, key in enumerate([ 'x', 'y', 'w', 'h' ], start=1):
+      labels[key] = columns[:, i]
+  return LabelIndex(names, images, np.array(splits, np.uint8), labels, format)
+
+def read_label_file(filepath: str) -> list[tuple]:
+  if not path.exists(filepath):
+    return []
+  with open(filepath, 'rt') as file:
+    return [ tuple(line.split()) for line in file if len(line.strip()) != 0 ]
+
+def scan_dataset(root: str) -> LabelIndex:
+  '''
+  Builds the index of a dataset in the YOLO folder layout by reading all of its label files,
+  for the datasets generated before the index existed.
+  '''
+  with open(path.join(root, 'data.yaml')) as file:
+    names = { int(k): v for k, v in yaml.safe_load(file)['names'].items() }
+
+  samples = []
+  for split in SPLITS:
+    folder = path.join(root, split, 'images')
+    if not path.isdir(folder):
+      continue
+    for filename in sorted(os.listdir(folder)):
+      label_path = path.join(root, split, 'labels', f'{path.splitext(filename)[0]}.txt')
+      samples.append((f'{split}/images/{filename}', split, read_label_file(label_path)))
+  return build_index(names, sorted(samples))
+
+def balanced_split(classes: dict[str, set[int]], ratios: dict[str, float], seed: str, fixed: dict[str, str] = {}) -> dict[str, str]:
+  '''
+  Assigns a split to every image (by its key, with the set of classes in it) so that every class is
+  spread among the splits in the given ratios, not just the images. The images of the rarest classes
+  are placed first, each into the split which is the furthest below its share of the rarest class
+  in the image. The `fixed` images keep their split and only count towards the shares. A split with
+  a share which is still empty then takes the last placed image of the largest split, if it can spare one.
+
+  The result only depends on the keys, their classes and the seed.
+  '''
+  class_totals: dict[int, int] = {}
+  for image_classes in classes.values():
+    for class_id in image_classes:
+      class_totals[class_id] = class_totals.get(class_id, 0) + 1
+
+  counts = { split: {} for split in ratios }
+  totals = { split: 0 for split in ratios }
+  def place(key: str, split: str, step: int = 1):
+    totals[split] += step
+    for class_id in classes[key]:
+      counts[split][class_id] = counts[split].get(class_id, 0) + step
+
+  assigned: dict[str, str] = {}
+  for key, split in fixed.items():
+    if key in classes:
+      assigned[key] = split
+      place(key, split)
+
+  order = sorted([ key for key in classes if key not in assigned ])
+  random.Random(seed).shuffle(order)
+  # the images without any labels go last, they only even out the sizes of the splits
+  order.sort(key=lambda key: min([ class_totals[c] for c in classes[key] ], default=sys.maxsize))
+
+  for key in order:
+    rarest = min(classes[key], key=lambda c: (class_totals[c], c), default=None)
+    def deficit(split: str):
+      class_deficit = 0.0 if rarest is None else ratios[split] * class_totals[rarest] - counts[split].get(rarest, 0)
+      return (class_deficit, ratios[split] * len(classes) - totals[split])
+    split = max(ratios, key=deficit) # the first of the ties, in the order of `ratios`
+    assigned[key] = split
+    place(key, split)
+
+  # with only a few images, every one of them can fall below the share of the smaller splits
+  for split in ratios:
+    if ratios[split] <= 0 or totals[split] != 0:
+      continue
+    largest = max(ratios, key=lambda other: totals[other])
+    movable = [ key for key in reversed(order) if assigned[key] == largest ]
+    if totals[largest] < 2 or len(movable) == 0:
+      continue
+    place(movable[0], largest, -1)
+    assigned[movable[0]] = split
+    place(movable[0], split)
+  return assigned
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=f'prints the statistics of a dataset from its {INDEX_NAME}, building it from the label files if it is missing')
+  parser.add_argument('dataset', help='folder with the data.yaml')
+  parser.add_argument('-r', '--rebuild', help=f'read the label files even if there is a {INDEX_NAME}', action='store_true')
+  argv = parser.parse_args()
+
+  if argv.rebuild or not path.exists(path.join(argv.dataset, INDEX_NAME)):
+    print(f'[i] reading the label files of {argv.dataset}', file=sys.stderr)
+    index = scan_dataset(argv.dataset)
+    index.save(argv.dataset)
+  else:
+    index = LabelIndex.load(argv.dataset)
+
+  print(f'{len(index)} images, {len(index.labels)} boxes ({', '.join([ f'{split} {np.count_nonzero(index.splits == i)}' for i, split in enumerate(SPLITS) ])})')
+  print(f'{'class':>5} {'name':<24} {'boxes':>7} {'images':>7} {'train':>7} {'valid':>7} {'test':>7} {'median w':>9} {'median h':>9}')
+  for stat in index.stats():
+    median_w = f'{stat['width'][1]:.4f}' if stat['width'] is not None else '-'
+    median_h = f'{stat['height'][1]:.4f}' if stat['height'] is not None else '-'
+    print(f'{stat['class']:>5} {stat['name']:<24} {stat['boxes']:>7} {stat['images']:>7} {stat['splits']['train']:>7} {stat['splits']['valid']:>7} {stat['splits']['test']:>7} {median_w:>9} {median_h:>9}')
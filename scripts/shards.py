@@ -0,0 +1,238 @@
+import argparse
+import io
+import json
+import os
+import sys
+import tarfile
+from os import path
+import numpy as np
+
+INDEX_NAME = 'shards.json'
+INDEX_VERSION = 1
+
+# one bounding box, `class` is the raw entity ID (see `mapping` in the index), `(x, y)` is as generated
+LABEL_DTYPE = np.dtype([
+  ('class', '<u2'),
+  ('x', '<f4'),
+  ('y', '<f4'),
+  ('w', '<f4'),
+  ('h', '<f4')
+])
+
+# where the data of an image is in the shard and which labels are its, `labels:labels+count`
+SAMPLE_DTYPE = np.dtype([
+  ('offset', '<u8'),
+  ('size', '<u4'),
+  ('labels', '<u4'),
+  ('count', '<u4')
+])
+
+SPLITS = [ 'train', 'valid', 'test' ]
+
+def labels_to_array(labels: list[tuple]) -> np.ndarray:
+  '''
+  Converts the `(entity_id, x, y, w, h)` tuples of a sample into a `LABEL_DTYPE` array.
+  '''
+  array = np.zeros(len(labels), LABEL_DTYPE)
+  for i, (entity_id, x, y, w, h) in enumerate(labels):
+    array[i] = (int(entity_id), float(x), float(y), float(w), float(h))
+  return array
+
+class ShardWriter:
+  '''
+  Writes the samples of one split into uncompressed tar shards of about `max_bytes` each
+  (the images are already encoded), named `<split>-00000.tar` and so on. Each shard has
+  its images in order, then `labels.npy` with all of their labels, `index.npy` with the
+  `SAMPLE_DTYPE` of every image and `names.txt` with their file names.
+  '''
+  def __init__(self, root: str, split: str, max_bytes: int):
+    self.root = root
+    self.split = split
+    self.max_bytes = max_bytes
+    self.shards: list[dict] = []
+    self.tar = None
+
+  def open(self):
+    filename = f'{self.split}-{len(self.shards):05d}.tar'
+    self.tar = tarfile.open(path.join(self.root, filename), 'w', format=tarfile.GNU_FORMAT)
+    self.shards.append({ 'file': filename, 'samples': 0, 'bytes': 0 })
+    self.samples: list[tuple[int, int, int, int]] = []
+    self.names: list[str] = []
+    self.labels: list[np.ndarray] = []
+    self.label_count = 0
+
+  def add_member(self, name: str, data: bytes) -> int:
+    '''
+    Appends a file to the shard, returns the offset of its data.
+    '''
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    self.tar.addfile(info, io.BytesIO(data))
+    # the data ends padded to the next block, right where the tar is now
+    return self.tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+  def add(self, name: str, data: bytes, labels: np.ndarray):
+    if self.tar is not None and self.tar.offset + len(data) > self.max_bytes and len(self.samples) != 0:
+      self.close_shard()
+    if self.tar is None:
+      self.open()
+
+    offset = self.add_member(f'images/{name}', data)
+    self.samples.append((offset, len(data), self.label_count, len(labels)))
+    self.names.append(name)
+    self.labels.append(labels)
+    self.label_count += len(labels)
+
+  def close_shard(self):
+    for name, array in [
+      ('labels.npy', np.concatenate(self.labels) if len(self.labels) != 0 else np.zeros(0, LABEL_DTYPE)),
+      ('index.npy', np.array(self.samples, SAMPLE_DTYPE))
+    ]:
+      buffer = io.BytesIO()
+      np.save(buffer, array)
+      self.add_member(name, buffer.getvalue())
+    self.add_member('names.txt', '\n'.join(self.names).encode())
+
+    self.shards[-1]['samples'] = len(self.samples)
+    self.shards[-1]['bytes'] = self.tar.offset
+    self.tar.close()
+    self.tar = None
+
+  def close(self) -> list[dict]:
+    '''
+    Finishes the last shard, returns the list of shards for the index.
+    '''
+    if self.tar is not None:
+      self.close_shard()
+    return self.shards
+
+def write_index(root: str, names: dict[int, str], mapping: dict[int, int], splits: dict[str, list[dict]]):
+  '''
+  Writes the `shards.json` of the dataset, `names` are by the class ID and `mapping` maps the raw entity IDs to them.
+  '''
+  with open(path.join(root, INDEX_NAME), 'wt') as file:
+    json.dump({
+      'version': INDEX_VERSION,
+      'names': { str(k): v for k, v in names.items() },
+      'mapping': { str(k): v for k, v in mapping.items() },
+      'splits': splits
+    }, file, indent=2)
+
+class ShardReader:
+  '''
+  Reads one shard, the images are read directly at their offsets. The labels have the raw entity IDs.
+  '''
+  def __init__(self, filepath: str):
+    self.path = filepath
+    with tarfile.open(filepath, 'r') as tar:
+      self.labels = np.load(io.BytesIO(tar.extractfile('labels.npy').read()))
+      self.samples = np.load(io.BytesIO(tar.extractfile('index.npy').read()))
+      self.names = tar.extractfile('names.txt').read().decode().split('\n')
+    self.file = open(filepath, 'rb')
+
+  def __len__(self):
+    return len(self.samples)
+
+  def read(self, index: int) -> tuple[str, bytes, np.ndarray]:
+    '''
+    Returns the `(name, data, labels)` of the sample, `data` is the encoded image.
+    '''
+    sample = self.samples[index]
+    self.file.seek(int(sample['offset']))
+    data = self.file.read(int(sample['size']))
+    return self.names[index], data, self.labels[sample['labels']:sample['labels'] + sample['count']]
+
+  def __iter__(self):
+    # the samples are in the order of the shard, so this is one sequential read
+    for index in range(len(self)):
+      yield self.read(index)
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+class ShardedDataset:
+  '''
+  A dataset written by `dataset-gen.py --shards`, the labels it returns have the class IDs.
+  '''
+  def __init__(self, root: str):
+    self.root = root
+    with open(path.join(root, INDEX_NAME), 'rt') as file:
+      index = json.load(file)
+    if index.get('version') != INDEX_VERSION:
+      raise Exception(f'Unsupported shards version {index.get('version')} in "{root}"')
+
+    self.names = { int(k): v for k, v in index['names'].items() }
+    self.splits: dict[str, list[dict]] = index['splits']
+
+    # lookup table from the raw entity IDs to the class IDs
+    mapping = { int(k): v for k, v in index['mapping'].items() }
+    self.classes = np.zeros(max(mapping.keys(), default=0) + 1, np.uint16)
+    for src, dst in mapping.items():
+      self.classes[src] = dst
+
+  def __len__(self):
+    return sum([ shard['samples'] for shards in self.splits.values() for shard in shards ])
+
+  def iter_split(self, split: str):
+    '''
+    Yields the `(name, data, labels)` of every sample in the split.
+    '''
+    for shard in self.splits.get(split, []):
+      with ShardReader(path.join(self.root, shard['file'])) as reader:
+        for name, data, labels in reader:
+          labels = labels.copy()
+          labels['class'] = self.classes[labels['class']]
+          yield name, data, labels
+
+def write_data_yaml(filepath: str, names: dict[int, str]):
+  with open(filepath, 'w') as file:
+    file.write('\n'.join([
+      f'train: train/images',
+      f'val: valid/images',
+      f'test: test/images',
+      f'',
+      f'names:',
+      f''
+    ]))
+    for idx, name in sorted(names.items()):
+      file.write(f'    {idx}: {name}\n')
+
+def export(root: str, destination: str):
+  '''
+  Unpacks the sharded dataset into the YOLO folder layout, which `train.py` expects.
+  '''
+  dataset = ShardedDataset(root)
+  os.makedirs(destination, exist_ok=False)
+  counter = 0
+  total = len(dataset)
+  for split in SPLITS:
+    os.makedirs(path.join(destination, split, 'images'), exist_ok=True)
+    os.makedirs(path.join(destination, split, 'labels'), exist_ok=True)
+
+    for name, data, labels in dataset.iter_split(split):
+      with open(path.join(destination, split, 'images', name), 'wb') as file:
+        file.write(data)
+      with open(path.join(destination, split, 'labels', f'{path.splitext(name)[0]}.txt'), 'w') as file:
+        file.write('\n'.join([
+          f'{label['class']} {label['x']:.8g} {label['y']:.8g} {label['w']:.8g} {label['h']:.8g}' for label in labels
+        ]))
+
+      counter += 1
+      if counter == total or counter % 100 == 0:
+        sys.stdout.write(f'\r[i] exported ({counter}/{total}) {name}')
+
+  write_data_yaml(path.join(destination, 'data.yaml'), dataset.names)
+  print()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='exports a dataset generated with `dataset-gen.py --shards` back to the YOLO folder layout')
+  parser.add_argument('input', help=f'folder with the shards and the {INDEX_NAME}')
+  parser.add_argument('-o', '--output', help='output folder, must not exist yet', required=True)
+  argv = parser.parse_args()
+  export(argv.input, argv.output)
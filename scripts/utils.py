@@ -45,19 +45,152 @@ def get_modifiers_from_filename(name: str):
   
   return namedtuple('Modifier', ['is_single', 'morph_close_ksize', 'erode_ksize', 'dilate_ksize'])(is_single, morph_close_ksize, erode_ksize, dilate_ksize)
 
-def annotate_file(src_image: str, format: Literal['bbox', 'center'], debug_draw: bool = False, area_threshold = 0.0) -> tuple[cv.typing.MatLike, list[tuple[int, float, float, float, float]]]:
+def get_morphology_kernels(modifier):
   '''
-  Returns the cropped top-left quadrant and a list of entities represented as tuples in the following format:
+  Returns the structuring elements of the close, erode and dilate steps of the `modifier`.
+  '''
+  return (
+    cv.getStructuringElement(cv.MORPH_RECT, (modifier.morph_close_ksize, modifier.morph_close_ksize)),
+    cv.getStructuringElement(cv.MORPH_RECT, (modifier.erode_ksize, modifier.erode_ksize)),
+    cv.getStructuringElement(cv.MORPH_RECT, (modifier.dilate_ksize, modifier.dilate_ksize))
+  )
 
-  `(entity_id, pos_x, pos_y, width, height)`
+def get_entity_bounds(entities: np.ndarray):
+  '''
+  Finds the bounding box and the pixel count of every non-zero ID in the `entities` image in one pass.
+  Returns the arrays `(ids, x0, y0, x1, y1, areas)` sorted by the ID, the bounds are inclusive.
+  '''
+  flat = entities.reshape(-1)
+  pixels = np.flatnonzero(flat)
+  ids = flat[pixels]
 
-  `pos_x` and `pos_y` change based on what the `format` is.
+  # stable sort keeps the pixels of each ID in raster order (and is a radix sort for uint16)
+  order = np.argsort(ids, kind='stable')
+  ids = ids[order]
+  ys, xs = np.divmod(pixels[order], entities.shape[1])
+
+  starts = np.flatnonzero(np.diff(ids, prepend=0))
+  ends = np.append(starts[1:], len(ids))
+  if len(starts) == 0:
+    empty = np.zeros(0, np.int64)
+    return ids[starts], empty, empty, empty, empty, empty
+
+  return (
+    ids[starts],
+    np.minimum.reduceat(xs, starts), ys[starts],
+    np.maximum.reduceat(xs, starts), ys[ends - 1],
+    ends - starts
+  )
+
+def find_entity_contours(entities: np.ndarray, modifier) -> list[tuple[int, list]]:
+  '''
+  Returns the external contours of every ID in the `entities` image, after closing, eroding
+  and dilating its mask as set by the `modifier`, as a list of `(id, contours)` sorted by the ID.
+
+  The morphology is only done on a crop around each ID with enough margin around it,
+  so that the contours are the same as if the whole image was processed.
+  '''
+  kernel_m, kernel_e, kernel_d = get_morphology_kernels(modifier)
+  height, width = entities.shape
+
+  # closing spreads the mask by up to m pixels, erosion then looks up to e/m pixels further
+  # and the dilation spreads it by up to d pixels, all of which has to stay within the crop
+  margin = modifier.morph_close_ksize + max(modifier.morph_close_ksize, modifier.erode_ksize, modifier.dilate_ksize) + 1
+
+  found = []
+  for id, x0, y0, x1, y1, _ in zip(*get_entity_bounds(entities)):
+    cx0, cy0 = max(0, x0 - margin), max(0, y0 - margin)
+    cx1, cy1 = min(width, x1 + margin + 1), min(height, y1 + margin + 1)
+
+    mask = np.where(entities[cy0:cy1, cx0:cx1] == id, np.uint8(255), np.uint8(0))
+    mask = cv.morphologyEx(mask, cv.MORPH_CLOSE, kernel_m)
+    mask = cv.erode(mask, kernel_e)
+    mask = cv.dilate(mask, kernel_d)
+
+    contours, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE, offset=(int(cx0), int(cy0)))
+    found.append((int(id), list(contours)))
+  return found
+
+def find_entity_contours_per_id(entities: np.ndarray, modifier) -> list[tuple[int, list]]:
+  '''
+  Same as `find_entity_contours`, but processes the whole image for every ID.
+  Much slower, kept as the reference to check the other one against.
+  '''
+  kernel_m, kernel_e, kernel_d = get_morphology_kernels(modifier)
+
+  found = []
+  for id in np.unique(entities):
+    if id == 0: continue
+    mask = np.where(entities == id, np.uint8(255), np.uint8(0))
+    mask = cv.morphologyEx(mask, cv.MORPH_CLOSE, kernel_m)
+    mask = cv.erode(mask, kernel_e)
+    mask = cv.dilate(mask, kernel_d)
+
+    contours, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    found.append((int(id), list(contours)))
+  return found
+
+class BitplaneDecoder:
+  '''
+  Turns the TR/BL/BR bitplane quadrants into the image of 9-bit entity IDs, where every
+  non-zero channel is one bit (TR's red being the highest and BR's blue the lowest).
+
+  The buffers are kept between the images of the same size, so keep one decoder per
+  worker (it's not thread-safe) and copy the result if it has to outlive the next `decode`.
+  '''
+  # weights of the B, G and R channels of the quadrant
+  WEIGHTS = np.array([[1, 2, 4]], np.float32)
+
+  def __init__(self):
+    self.shape = None
+
+  def allocate(self, height: int, width: int):
+    self.shape = (height, width)
+    self.binary = np.empty((height, width, 3), np.uint8)
+    self.high = np.empty((height, width), np.uint8)
+    self.low = np.empty((height, width), np.uint8)
+    self.lowest = np.empty((height, width), np.uint8)
+    self.entities = np.empty((height, width), np.uint16)
+
+  def bits(self, bitplane: np.ndarray, weights: np.ndarray, out: np.ndarray):
+    # every channel becomes 0/1, then the three are summed with their weights in one pass
+    cv.threshold(bitplane, 0, 1, cv.THRESH_BINARY, dst=self.binary)
+    cv.transform(self.binary, weights, dst=out)
+
+  def decode(self, bitplane1: np.ndarray, bitplane2: np.ndarray, bitplane3: np.ndarray) -> np.ndarray:
+    if self.shape != bitplane1.shape[:2]:
+      self.allocate(*bitplane1.shape[:2])
+
+    self.bits(bitplane1, self.WEIGHTS, self.high)       # bits 6-8
+    self.bits(bitplane2, self.WEIGHTS * 8, self.low)    # bits 3-5
+    self.bits(bitplane3, self.WEIGHTS, self.lowest)     # bits 0-2
+    cv.add(self.low, self.lowest, dst=self.low)
+
+    np.left_shift(self.high, 6, out=self.entities, dtype=np.uint16)
+    np.bitwise_or(self.entities, self.low, out=self.entities)
+    return self.entities
+
+def decode_bitplanes_per_channel(bitplane1: np.ndarray, bitplane2: np.ndarray, bitplane3: np.ndarray) -> np.ndarray:
+  '''
+  Same as `BitplaneDecoder.decode`, one channel at a time. Kept as the reference to check it against.
+  '''
+  entities = np.zeros(bitplane1.shape[:2], np.uint16)
+  for bitplane, shift in ((bitplane1, 6), (bitplane2, 3), (bitplane3, 0)):
+    for channel in range(3):
+      entities += np.sign(bitplane[:, :, channel], dtype=np.uint16) * (1 << (shift + channel))
+  return entities
+
+# used by annotate_file, each worker process gets its own
+bitplane_decoder = BitplaneDecoder()
+
+def split_quadrants(image: np.ndarray, name: str = ''):
+  '''
+  Returns the views of the TL (rgb), TR, BL and BR quadrants of the screenshot.
   '''
-  image = cv.imread(src_image, flags=cv.IMREAD_COLOR)
   height, width, channels = image.shape
 
   if (width % 2 != 0) or (height % 2 != 0):
-    print(f'\nWARNING: One of the image\'s dimension ({width}x{height}) is not divisible by two!\n\t{src_image}')
+    print(f'\nWARNING: One of the image\'s dimension ({width}x{height}) is not divisible by two!\n\t{name}')
 
   offset_x = width % 2
   offset_y = height % 2
@@ -66,39 +199,32 @@ def annotate_file(src_image: str, format: Literal['bbox', 'center'], debug_draw:
   bitplane1 = image[                   0:height//2 , width//2 + offset_x:width   ] # TR
   bitplane2 = image[height//2 + offset_y:height    ,                   0:width//2] # BL (haha)
   bitplane3 = image[height//2 + offset_y:height    , width//2 + offset_x:width   ] # BR
+  return rgb, bitplane1, bitplane2, bitplane3
 
-  b_height, b_width, b_channels = bitplane1.shape
+def annotate_file(src_image: str, format: Literal['bbox', 'center'], debug_draw: bool = False, area_threshold = 0.0, image: np.ndarray | None = None, decoder: BitplaneDecoder | None = None) -> tuple[cv.typing.MatLike, list[tuple[int, float, float, float, float]]]:
+  '''
+  Returns the cropped top-left quadrant and a list of entities represented as tuples in the following format:
 
-  entities = np.zeros((b_height, b_width), np.uint16)
-  entities += np.sign(bitplane1[:, :, 2], dtype=np.uint16) * (1 << 8)
-  entities += np.sign(bitplane1[:, :, 1], dtype=np.uint16) * (1 << 7)
-  entities += np.sign(bitplane1[:, :, 0], dtype=np.uint16) * (1 << 6)
-  entities += np.sign(bitplane2[:, :, 2], dtype=np.uint16) * (1 << 5)
-  entities += np.sign(bitplane2[:, :, 1], dtype=np.uint16) * (1 << 4)
-  entities += np.sign(bitplane2[:, :, 0], dtype=np.uint16) * (1 << 3)
-  entities += np.sign(bitplane3[:, :, 2], dtype=np.uint16) * (1 << 2)
-  entities += np.sign(bitplane3[:, :, 1], dtype=np.uint16) * (1 << 1)
-  entities += np.sign(bitplane3[:, :, 0], dtype=np.uint16) * (1 << 0)
-
-  unique_entities = np.unique(entities)
-  entities_bucket = list()
+  `(entity_id, pos_x, pos_y, width, height)`
 
-  modifier = get_modifiers_from_filename('.'.join(os.path.basename(src_image).split('.')[:-1]))
+  `pos_x` and `pos_y` change based on what the `format` is. If the screenshot was already
+  read, pass it as `image`, the `src_image` is then only used for its modifiers.
+  '''
+  if image is None:
+    image = cv.imread(src_image, flags=cv.IMREAD_COLOR)
 
-  for id in unique_entities:
-    if id == 0: continue
-    mask = np.where(entities == id, np.uint8(255), np.uint8(0))
+  rgb, bitplane1, bitplane2, bitplane3 = split_quadrants(image, src_image)
+  b_height, b_width, b_channels = bitplane1.shape
 
-    kernel_m = cv.getStructuringElement(cv.MORPH_RECT, (modifier.morph_close_ksize, modifier.morph_close_ksize))
-    kernel_e = cv.getStructuringElement(cv.MORPH_RECT, (modifier.erode_ksize, modifier.erode_ksize))
-    kernel_d = cv.getStructuringElement(cv.MORPH_RECT, (modifier.dilate_ksize, modifier.dilate_ksize))
-    mask = cv.morphologyEx(mask, cv.MORPH_CLOSE, kernel_m)
-    mask = cv.erode(mask, kernel_e)
-    mask = cv.dilate(mask, kernel_d)
+  entities = (decoder or bitplane_decoder).decode(bitplane1, bitplane2, bitplane3)
 
-    contours, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+  entities_bucket = list()
+
+  modifier = get_modifiers_from_filename('.'.join(os.path.basename(src_image).split('.')[:-1]))
 
+  for id, contours in find_entity_contours(entities, modifier):
     if modifier.is_single:
+      if len(contours) == 0: continue
       contours = [np.vstack(contours)]
 
     for cnt in contours:
@@ -149,64 +275,111 @@ def annotate_file(src_image: str, format: Literal['bbox', 'center'], debug_draw:
   
   return rgb, entities_bucket
 
-def annotate_layer_file(tifFile: str, format: Literal['bbox', 'center'], debug_draw: bool = False, area_threshold = 0.0) -> tuple[cv.typing.MatLike, list[tuple[int, float, float, float, float]]]:
-  ret, images = cv.imreadmulti(tifFile)
-  entities_bucket = []
-
-  if not ret:
-    raise Exception('Could not open the file')
-
-  id = None
+def get_layer_id(tifFile: str) -> int:
+  '''
+  Returns the entity ID of a layered tif from the `i<ID>` segment of its name.
+  '''
   for segment in tifFile.split('.'):
     if len(segment) == 0:
       continue
     header = segment[0]
     if header != 'i':
       continue
+    return int(segment[1:])
+  raise Exception(f'No ID found in the filename')
 
-    id = int(segment[1:])
-    break
+def add_layer_entities(entities_bucket: list, mask: np.ndarray, id: int, background: np.ndarray, format: Literal['bbox', 'center'], debug_draw: bool = False):
+  '''
+  Appends a box for every blob of non-zero pixels in the `mask` of a layer.
+  '''
+  b_width = background.shape[1]
+  b_height = background.shape[0]
 
-  if id is None:
-    raise Exception(f'No ID found in the filename')
+  contours, _ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+  for cnt in contours:
+    x, y, w, h = cv.boundingRect(cnt)
 
-  layerCount = len(images)
+    if debug_draw:
+      color = (0, 255, 0)
+      cv.rectangle(background, (x,y), (x+w, y+h), color, 1)
+      cv.putText(
+        background,
+        f'id={id}', (x, y - 4),
+        fontFace=cv.FONT_HERSHEY_SIMPLEX,
+        fontScale=0.4,
+        color=color,
+        thickness=1,
+        lineType=cv.LINE_AA
+      )
+
+    if format == 'bbox':
+      entities_bucket.append((
+        id,
+        x / b_width, y / b_height,
+        w / b_width, y / b_height
+      ))
+    elif format == 'center':
+      entities_bucket.append((
+        id,
+        (x + w/2) / b_width, (y + h/2) / b_height,
+        w / b_width, h / b_height
+      ))
+
+def annotate_layer_file(tifFile: str, format: Literal['bbox', 'center'], debug_draw: bool = False, area_threshold = 0.0) -> tuple[cv.typing.MatLike, list[tuple[int, float, float, float, float]]]:
+  '''
+  Returns the first page of the tif and the boxes of the entities in its other pages (layers), in the same format as `annotate_file`.
+
+  The layers are read one page at a time and dropped as soon as their boxes are found, their channels
+  are summed into one reused mask, so only the background and a single layer are in memory at once.
+  '''
+  layerCount = cv.imcount(tifFile)
+  if layerCount == 0:
+    raise Exception('Could not open the file')
+
+  id = get_layer_id(tifFile)
   if layerCount <= 1:
     raise Exception(f'Not enough layers!')
-  
-  background = images[0]
-  b_width = background.shape[1]
-  b_height = background.shape[0]
 
+  ret, pages = cv.imreadmulti(tifFile, 0, 1)
+  if not ret:
+    raise Exception('Could not open the file')
+  background = pages[0]
+  mask = np.empty(background.shape[0:2], np.uint8)
+
+  entities_bucket = []
   for idx in range(1, layerCount):
-    contours, _ = cv.findContours(np.sign(images[idx][:,:,0] + images[idx][:,:,1] + images[idx][:,:,2]), cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
-    for cnt in contours:
-      x, y, w, h = cv.boundingRect(cnt)
+    ret, pages = cv.imreadmulti(tifFile, idx, 1)
+    if not ret:
+      raise Exception(f'Could not read the layer {idx}')
+    layer = pages[0]
+    del pages
 
-      if debug_draw:
-        color = (0, 255, 0)
-        cv.rectangle(background, (x,y), (x+w, y+h), color, 1)
-        cv.putText(
-          background,
-          f'id={id}', (x, y - 4),
-          fontFace=cv.FONT_HERSHEY_SIMPLEX,
-          fontScale=0.4,
-          color=color,
-          thickness=1,
-          lineType=cv.LINE_AA
-        )
+    # wraps around like the sum of the uint8 channels always did, findContours treats non-zero as the blob
+    np.add(layer[:,:,0], layer[:,:,1], out=mask)
+    np.add(mask, layer[:,:,2], out=mask)
+    del layer
+    add_layer_entities(entities_bucket, mask, id, background, format, debug_draw)
 
-      if format == 'bbox':
-        entities_bucket.append((
-          id,
-          x / b_width, y / b_height,
-          w / b_width, y / b_height
-        ))
-      elif format == 'center':
-        entities_bucket.append((
-          id,
-          (x + w/2) / b_width, (y + h/2) / b_height,
-          w / b_width, h / b_height
-        ))
+  return background, entities_bucket
+
+def annotate_layer_file_all_pages(tifFile: str, format: Literal['bbox', 'center'], debug_draw: bool = False, area_threshold = 0.0) -> tuple[cv.typing.MatLike, list[tuple[int, float, float, float, float]]]:
+  '''
+  Same as `annotate_layer_file`, but reads all of the layers at once. Kept as the reference to check it against.
+  '''
+  ret, images = cv.imreadmulti(tifFile)
+  entities_bucket = []
+
+  if not ret:
+    raise Exception('Could not open the file')
+
+  id = get_layer_id(tifFile)
+
+  layerCount = len(images)
+  if layerCount <= 1:
+    raise Exception(f'Not enough layers!')
+  
+  background = images[0]
+  for idx in range(1, layerCount):
+    add_layer_entities(entities_bucket, np.sign(images[idx][:,:,0] + images[idx][:,:,1] + images[idx][:,:,2]), id, background, format, debug_draw)
 
   return background, entities_bucket
\ No newline at end of file
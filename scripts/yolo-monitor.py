@@ -1,11 +1,20 @@
 import argparse
+import collections
+import math
+import queue
+import sys
+import threading
 import time
 from os import path
 import os
 import cv2
 from ultralytics import YOLO
 import numpy as np
-import mss
+from capture import ScreenCapture
+from dedup import HASH_SIZE, difference_hash, hamming
+
+# the encoders of the saved frames, with the parameter their --save-quality goes to
+SAVE_FORMATS = { 'png': None, 'jpg': cv2.IMWRITE_JPEG_QUALITY, 'webp': cv2.IMWRITE_WEBP_QUALITY }
 
 def get_argv():
   parser = argparse.ArgumentParser()
@@ -24,12 +33,172 @@ def get_argv():
   parser.add_argument('--conf', default=0.8, type=float)
   parser.add_argument('--iou', default=0.5, type=float)
   parser.add_argument('--imgsz', default=640, type=int)
-  parser.add_argument('-r', '--rate', default=60, help='framerate', type=float)
+  parser.add_argument('-r', '--rate', default=60, help='framerate of the capture, 0 to capture as fast as possible', type=float)
   parser.add_argument('-o', '--output', type=str, default=None, help='where to save frames where things were detected')
-  return parser.parse_args()
+  parser.add_argument('--save-format', help='encoding of the saved frames', choices=list(SAVE_FORMATS.keys()), default='png')
+  parser.add_argument('--save-quality', help='quality of the jpg and webp frames, 0-100 (over 100 is lossless webp)', default=90, type=int)
+  parser.add_argument('--save-raw-only', help='only save the captured frames, without the annotated ones', action='store_true', default=False)
+  parser.add_argument('--save-rate', help='save at most this many frames per second, 0 for no limit', default=0, type=float)
+  parser.add_argument('--save-class-rate', help='save a frame only if one of its classes was saved less often than this many times per second, 0 for no limit', default=0, type=float)
+  parser.add_argument('--save-dedup', help='skip the frames whose perceptual hash is at most this many bits away from the last saved one, -1 to save them all', default=-1, type=int)
+  parser.add_argument('--save-queue', help='how many frames may wait to be written, the ones over it are dropped', default=32, type=int)
+  parser.add_argument(
+    '--region',
+    help='only capture this part of the monitor, relative to its top left corner (for eg. the game window)',
+    nargs=4,
+    type=int,
+    metavar=('LEFT', 'TOP', 'WIDTH', 'HEIGHT'),
+    default=None
+  )
+  parser.add_argument('--downscale', help='shrink the screen captures to --imgsz right after grabbing them', action='store_true', default=False)
+  argv = parser.parse_args()
+  if argv.webcam and (argv.region is not None or argv.downscale):
+    parser.error('--region and --downscale only apply to the screen capture')
+  return argv
+
+class LatestFrame:
+  '''
+  Hands the newest item from one thread to another. An item which is replaced before it was taken
+  is dropped (and counted), so the consumer never works through a backlog of old frames.
+  '''
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.item = None
+    self.dropped = 0
+
+  def put(self, item):
+    '''
+    Returns the item it replaced, if there was one.
+    '''
+    with self.condition:
+      replaced = self.item
+      if replaced is not None:
+        self.dropped += 1
+      self.item = item
+      self.condition.notify()
+      return replaced
+
+  def take(self, timeout: float):
+    '''
+    Returns the newest item, or None if there was none within `timeout` seconds.
+    '''
+    with self.condition:
+      if self.item is None:
+        self.condition.wait(timeout)
+      item, self.item = self.item, None
+      return item
+
+class RateMeter:
+  '''
+  Counts the events of a stage, and their rate and durations over the last second.
+  '''
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.count = 0
+    self.events: collections.deque[tuple[float, float]] = collections.deque()
+
+  def add(self, duration: float = 0.0):
+    now = time.perf_counter()
+    with self.lock:
+      self.count += 1
+      self.events.append((now, duration))
+      while self.events[0][0] < now - 1.0:
+        self.events.popleft()
+
+  def rate(self) -> tuple[float, float]:
+    '''
+    Returns the events per second and the mean duration of the last second.
+    '''
+    with self.lock:
+      if len(self.events) == 0:
+        return 0.0, 0.0
+      span = max(self.events[-1][0] - self.events[0][0], 1e-6)
+      rate = (len(self.events) - 1) / span if len(self.events) > 1 else 0.0
+      return rate, sum([ duration for _, duration in self.events ]) / len(self.events)
+
+class FrameSaver:
+  '''
+  Writes the frames with detections into `root` on a background thread. The limits are checked before anything is
+  copied: a frame is skipped if it's over `rate` (frames per second), if every class in it was saved within the
+  last `1 / class_rate` seconds, or if it's at most `dedup` bits away from the last saved frame. When the writer
+  falls `queue_size` frames behind, the next ones are dropped, so the inference never waits for the disk.
+  '''
+  def __init__(self, root: str, format: str = 'png', quality: int = 90, raw_only: bool = False, rate: float = 0, class_rate: float = 0, dedup: int = -1, queue_size: int = 32):
+    self.root = root
+    self.format = format
+    self.params = [ SAVE_FORMATS[format], quality ] if SAVE_FORMATS[format] is not None else []
+    self.raw_only = raw_only
+    self.rate = rate
+    self.class_rate = class_rate
+    self.dedup = dedup
+
+    self.last_saved = -math.inf
+    self.class_saved: dict[int, float] = {}
+    self.last_hash: int | None = None
+    self.saved = 0
+    self.skipped = 0
+    self.duplicates = 0
+    self.dropped = 0
 
-def detect_and_label(frame, yoloModel: YOLO, save: str | None=None):
-  saved_image = False
+    self.queue = queue.Queue(max(1, queue_size))
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def offer(self, frame: np.ndarray, labelled: np.ndarray, classes: set[int]):
+    '''
+    Queues the captured frame and its annotated version, unless one of the limits says otherwise.
+    Only to be called from one thread.
+    '''
+    now = time.monotonic()
+    if self.rate > 0 and now - self.last_saved < 1.0 / self.rate:
+      self.skipped += 1
+      return
+    if self.class_rate > 0 and all([ now - self.class_saved.get(c, -math.inf) < 1.0 / self.class_rate for c in classes ]):
+      self.skipped += 1
+      return
+
+    frame_hash = None
+    if self.dedup >= 0:
+      # shrinking the colour frame first is much cheaper than converting all of it to gray
+      small = cv2.resize(frame, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+      frame_hash = difference_hash(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+      if self.last_hash is not None and hamming(frame_hash, self.last_hash) <= self.dedup:
+        self.duplicates += 1
+        return
+
+    if self.queue.full():
+      self.dropped += 1
+      return
+    # the captured frame is reused and the overlay is drawn over the annotated one, so both are copied
+    images = [ ('raw', frame.copy()) ] + ([ ('annotated', labelled.copy()) ] if not self.raw_only else [])
+    self.queue.put_nowait((time.time(), images))
+
+    self.last_saved = now
+    for c in classes:
+      self.class_saved[c] = now
+    self.last_hash = frame_hash
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      ctime, images = item
+      for kind, image in images:
+        filepath = path.join(self.root, f'monitor_{ctime}_{kind}.{self.format}')
+        if not cv2.imwrite(filepath, image, self.params):
+          print(f'[w] could not write {filepath}', file=sys.stderr)
+      self.saved += 1
+
+  def close(self):
+    '''
+    Waits until the queued frames are written.
+    '''
+    self.queue.put(None)
+    self.thread.join()
+
+def detect_and_label(frame, yoloModel: YOLO, saver: FrameSaver | None=None):
+  labelled = frame
   for result in yoloModel.predict(
     source=frame,
     verbose=False,
@@ -38,35 +207,101 @@ def detect_and_label(frame, yoloModel: YOLO, save: str | None=None):
     imgsz=argv.imgsz,
     stream=True
   ):
-    if save is not None:
-      if not saved_image and int(result.boxes.shape[0]) != 0:
-        ctime = time.time()
-        cv2.imwrite(path.join(save, f'monitor_{ctime}_raw.png'), frame)
-        frame = result.plot()
-        cv2.imwrite(path.join(save, f'monitor_{ctime}_annotated.png'), frame)
-        saved_image = True
-      else:
-        frame = result.plot()
-    else:
-      frame = result.plot()
-
-    cv2.rectangle(
-      frame,
-      (0, 0),
-      (175, 24),
-      (0, 0, 0, 128),
-      thickness=cv2.FILLED
-    )
+    labelled = result.plot()
+    if saver is not None and int(result.boxes.shape[0]) != 0:
+      saver.offer(frame, labelled, set([ int(c) for c in result.boxes.cls.tolist() ]))
+  return labelled
+
+def draw_stats(frame, lines: list[str]):
+  cv2.rectangle(
+    frame,
+    (0, 0),
+    (max([ cv2.getTextSize(line, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)[0][0] for line in lines ]) + 8, 8 + 18 * len(lines)),
+    (0, 0, 0, 128),
+    thickness=cv2.FILLED
+  )
+  for i, line in enumerate(lines):
     cv2.putText(
       frame,
-      f'{(1.0 / diff_this_frame):.1f} FPS ({(diff_this_frame*1000):.2f}ms)', (4, 16),
+      line, (4, 18 + 18 * i),
       fontFace=cv2.FONT_HERSHEY_SIMPLEX,
       fontScale=0.5,
       color=(0, 255, 0),
       thickness=1,
       lineType=cv2.LINE_AA
     )
-  return frame
+
+def capture_frames(frames: LatestFrame, free: queue.SimpleQueue, meter: RateMeter, info: dict, stopped: threading.Event):
+  '''
+  Grabs frames at `--rate` and hands them over with the time they were taken. If the capture falls
+  behind, it continues from now instead of catching up. The frames are read into the buffers given
+  back through `free` (or replaced before the inference took them), so only a few are ever allocated.
+  '''
+  # the capture is opened in this thread, mss can't be used from another thread than its own
+  if argv.webcam:
+    capture = cv2.VideoCapture(argv.monitor)
+    capture.set(cv2.CAP_PROP_BUFFERSIZE, 1) # otherwise the webcam queues up old frames
+    if not capture.isOpened():
+      return
+  else:
+    capture = ScreenCapture(argv.monitor, argv.region, argv.imgsz if argv.downscale else None)
+
+  s_interval = 1.0 / argv.rate if argv.rate > 0 else 0.0
+  next_frame = time.perf_counter()
+  buffer = None
+  while not stopped.is_set():
+    delay = next_frame - time.perf_counter()
+    if delay > 0:
+      time.sleep(delay)
+    next_frame = max(next_frame + s_interval, time.perf_counter())
+
+    if buffer is None:
+      try:
+        buffer = free.get_nowait()
+      except queue.Empty:
+        pass
+
+    start = time.perf_counter()
+    ret, frame = capture.read(buffer)
+    if not ret:
+      break
+    meter.add(time.perf_counter() - start)
+    if frame is not buffer:
+      info['allocated'] += 1
+    info['size'] = (frame.shape[1], frame.shape[0])
+    info['copied'] = capture.copied if not argv.webcam else frame.nbytes
+
+    replaced = frames.put((start, frame))
+    buffer = replaced[1] if replaced is not None else None
+  capture.release()
+
+def infer_frames(yoloModel: YOLO, frames: LatestFrame, free: queue.SimpleQueue, annotated: LatestFrame, meter: RateMeter, saver: FrameSaver | None, stopped: threading.Event):
+  while not stopped.is_set():
+    item = frames.take(0.1)
+    if item is None:
+      continue
+    captured, frame = item
+    start = time.perf_counter()
+    labelled = detect_and_label(frame, yoloModel, saver)
+    meter.add(time.perf_counter() - start)
+    # the plot is a copy, the captured frame can be reused
+    free.put(frame)
+    annotated.put((captured, labelled))
+
+def run_thread(target, errors: list, stopped: threading.Event, *args) -> threading.Thread:
+  '''
+  Starts `target` on a thread which stops the others when it ends, the exception it raised is in `errors`.
+  '''
+  def run():
+    try:
+      target(*args)
+    except Exception as err:
+      errors.append(err)
+    finally:
+      stopped.set()
+  thread = threading.Thread(target=run, daemon=True)
+  thread.start()
+  return thread
 
 if __name__ == '__main__':
   argv = get_argv()
@@ -78,38 +313,67 @@ if __name__ == '__main__':
   cv2.namedWindow('player', cv2.WINDOW_GUI_NORMAL)
   cv2.setNumThreads(16)
 
-  s_interval = 1.0 / argv.rate
-
-  if argv.webcam:
-    capture = cv2.VideoCapture(argv.monitor)
-    condition = capture.isOpened()
-  else:
-    capture = mss.mss()
-    monitor = capture.monitors[argv.monitor]
-    condition = True
-
+  saver = None
   if argv.output:
     os.makedirs(argv.output, exist_ok=True)
+    saver = FrameSaver(
+      argv.output, argv.save_format, argv.save_quality, argv.save_raw_only,
+      argv.save_rate, argv.save_class_rate, argv.save_dedup, argv.save_queue
+    )
 
-  last_frame = time.time()
-  while condition:
-    current_time = time.time()
-    diff_this_frame = current_time - last_frame
-    if argv.rate > 0 and (diff_this_frame > s_interval):
-      last_frame = current_time
-    else:
-      time.sleep(s_interval - diff_this_frame)
-      continue
+  # the capture and the inference run on their own threads and only ever pass on their newest frame,
+  # the window is updated from this one (the GUI of opencv has to stay on the main thread)
+  frames = LatestFrame()
+  free = queue.SimpleQueue()
+  capture_info = { 'size': (0, 0), 'copied': 0, 'allocated': 0 }
+  annotated = LatestFrame()
+  captures, inferences, displays = RateMeter(), RateMeter(), RateMeter()
+  latencies = collections.deque(maxlen=1000)
+  stopped = threading.Event()
+  errors = []
+  threads = [
+    run_thread(capture_frames, errors, stopped, frames, free, captures, capture_info, stopped),
+    run_thread(infer_frames, errors, stopped, yoloModel, frames, free, annotated, inferences, saver, stopped)
+  ]
+
+  while not stopped.is_set():
+    item = annotated.take(0.01)
+    if item is not None:
+      captured, frame = item
+      capture_fps, capture_time = captures.rate()
+      inference_fps, inference_time = inferences.rate()
+      display_fps, _ = displays.rate()
+      latency = np.mean(list(latencies)[-30:]) if len(latencies) != 0 else 0.0
+      stats = [
+        f'{display_fps:.1f} FPS ({(latency*1000):.2f}ms latency)',
+        f'capture {capture_fps:.1f} FPS ({(capture_time*1000):.2f}ms) {capture_info['size'][0]}x{capture_info['size'][1]}',
+        f'{(capture_info['copied']/2**20):.1f} MiB copied per frame, {capture_info['allocated']} allocated',
+        f'inference {inference_fps:.1f} FPS ({(inference_time*1000):.2f}ms)',
+        f'dropped {frames.dropped} + {annotated.dropped}'
+      ]
+      if saver is not None:
+        stats.append(f'saved {saver.saved} ({saver.queue.qsize()} queued), skipped {saver.skipped} + {saver.duplicates}, dropped {saver.dropped}')
+      draw_stats(frame, stats)
+      cv2.imshow('player', frame)
+      latencies.append(time.perf_counter() - captured)
+      displays.add()
 
     key = cv2.waitKey(1) & 0xFF
     if key == ord('q'):
       break
 
-    if argv.webcam:
-      ret, frame = capture.read()
-    else:
-      frame = np.asarray(capture.grab(monitor))[:,:,:3]
-
-    cv2.imshow('player', detect_and_label(frame, yoloModel, save=argv.output))
+  stopped.set()
+  for thread in threads:
+    thread.join()
+  cv2.destroyAllWindows()
+  if saver is not None:
+    saver.close()
 
-  cv2.destroyAllWindows()
\ No newline at end of file
+  if len(latencies) != 0:
+    print(f'[i] captured {captures.count}, inferred {inferences.count}, displayed {displays.count} frames ({capture_info['allocated']} frames allocated)', file=sys.stderr)
+    print(f'[i] dropped {frames.dropped} before the inference and {annotated.dropped} before the display', file=sys.stderr)
+    print(f'[i] capture to display latency: median {(np.median(latencies)*1000):.1f}ms, p95 {(np.percentile(latencies, 95)*1000):.1f}ms (of the last {len(latencies)} frames)', file=sys.stderr)
+  if saver is not None:
+    print(f'[i] saved {saver.saved} frames, skipped {saver.skipped} over the rate limits and {saver.duplicates} duplicates, dropped {saver.dropped} with the queue full', file=sys.stderr)
+  if len(errors) != 0:
+    raise errors[0]
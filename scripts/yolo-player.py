@@ -17,6 +17,13 @@ def get_argv():
     type=int,
     default=0
   )
+  parser.add_argument(
+    '--decoder',
+    help='opencv decodes the full frames, ffmpeg (has to be in PATH) scales them down to --imgsz while decoding',
+    choices=[ 'opencv', 'ffmpeg' ],
+    default='opencv'
+  )
+  parser.add_argument('--imgsz', default=640, type=int)
   return parser.parse_args()
 
 if __name__ == '__main__':
@@ -24,13 +31,14 @@ if __name__ == '__main__':
 
   import cv2
   from ultralytics import YOLO
+  from capture import open_capture
 
   # init the model
   yoloModel = YOLO(argv.model)
 
   # create a cv2 dumb video player
   cv2.namedWindow('player', cv2.WINDOW_NORMAL)
-  capture = cv2.VideoCapture(argv.filename)
+  capture = open_capture(argv.filename, argv.decoder, argv.imgsz)
   vWidth = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
   vHeight = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
   vFrames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -57,7 +65,7 @@ if __name__ == '__main__':
       
       ret, frame = capture.read()
       if ret:
-        results = yoloModel.predict(source=frame, verbose=False)
+        results = yoloModel.predict(source=frame, imgsz=argv.imgsz, verbose=False)
         cv2.imshow('player', results[0].plot())
       isDirty = False
 